@@ -13,6 +13,15 @@ class NGIObject(object):
             subitem = self._subitems[name] = self._subitem_type(name, dirname)
         return subitem
 
+    def merge(self, other):
+        """Add the subitems of other (e.g. the samples of the same project
+        found in another flowcell) to this object, recursively."""
+        for other_subitem in other:
+            try:
+                self._subitems[other_subitem.name].merge(other_subitem)
+            except KeyError:
+                self._subitems[other_subitem.name] = other_subitem
+
     def __iter__(self):
         return iter(self._subitems.values())
 
@@ -61,6 +70,9 @@ class NGISeqRun(NGIObject):
     def __iter__(self):
         return iter(self._subitems)
 
+    def merge(self, other):
+        self.add_fastq_files([fastq for fastq in other if fastq not in self._subitems])
+
     def add_fastq_files(self, fastq):
         if type(fastq) == list:
             self._subitems.extend(fastq)
@@ -3,22 +3,32 @@
 
 from __future__ import print_function
 
-import glob
+import collections
+import json
 import os
 import re
 import sys
 
+from multiprocessing.pool import ThreadPool
+
 from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.conductor.plan import SetupPlan
+from ngi_pipeline.conductor.registry import get_workflow_registry
 from ngi_pipeline.conductor.launchers import launch_analysis_for_seqruns
-from ngi_pipeline.database.classes import CharonSession, CharonError
-from ngi_pipeline.database.communicate import get_project_id_from_name
+from ngi_pipeline.database.classes import CharonError
+from ngi_pipeline.database.communicate import get_project_id_from_name, \
+                                              get_projects_from_names
 from ngi_pipeline.database.filesystem import create_charon_entries_from_project
+from ngi_pipeline.database.instrumentation import charon_stage
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
-from ngi_pipeline.utils.filesystem import do_rsync, do_symlink, safe_makedir
+from ngi_pipeline.utils.filesystem import make_directories, safe_makedir, \
+                                         scan_directory
 from ngi_pipeline.utils.parsers import determine_library_prep_from_fcid, \
                                        determine_libprep_from_uppsala_samplesheet, \
+                                       get_fcid_libprep_index, \
                                        parse_lane_from_filename
+from ngi_pipeline.utils.staging import plan_staging, stage_files
 
 LOG = minimal_logger(__name__)
 
@@ -54,6 +64,8 @@ def process_demultiplexed_flowcell(demux_fcid_dir_path, restrict_to_projects=Non
 def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
                                     restrict_to_samples=None,
                                     restart_failed_jobs=False,
+                                    max_workers=None,
+                                    plan_only=False,
                                     config=None, config_file_path=None):
     """Sort demultiplexed Illumina flowcells into projects and launch their analysis.
 
@@ -63,23 +75,63 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
     :param list restrict_to_samples: A list of samples; analysis will be
                                      restricted to these. Optional.
     :param bool restart_failed_jobs: Restart jobs marked as "FAILED" in Charon.
+    :param int max_workers: The number of flowcells to set up at the same time
+                            (default analysis.flowcell_workers in the config, or 1)
+    :param bool plan_only: Only work out what would be done, changing nothing
     :param dict config: The parsed NGI configuration file; optional.
     :param str config_file_path: The path to the NGI configuration file; optional.
+
+    :returns: What was (or, with plan_only, would be) done
+    :rtype: SetupPlan
     """
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
+    if not plan_only:
+        # Stop before anything is set up if the analyses could not be launched
+        get_workflow_registry(config)
+    if not max_workers:
+        max_workers = int(config.get("analysis", {}).get("flowcell_workers", 1))
     demux_fcid_dirs_set = set(demux_fcid_dirs)
+    staging_strategy = config["analysis"].get("staging_strategy", "symlink")
     # Sort/copy each raw demux FC into project/sample/fcid format -- "analysis-ready"
-    projects_to_analyze = dict()
-    for demux_fcid_dir in demux_fcid_dirs_set:
+    def setup_flowcell(demux_fcid_dir):
+        # Each flowcell is planned separately, so that they can be set up in parallel
+        fc_plan = SetupPlan(staging_strategy=staging_strategy)
         # These will be a bunch of Project objects each containing Samples, FCIDs, lists of fastq files
-        projects_to_analyze = setup_analysis_directory_structure(demux_fcid_dir,
-                                                                 projects_to_analyze,
-                                                                 restrict_to_projects,
-                                                                 restrict_to_samples,
-                                                                 create_files=True,
-                                                                 config=config)
-    if not projects_to_analyze:
+        fc_plan.add_projects(setup_analysis_directory_structure(demux_fcid_dir, {},
+                                                  restrict_to_projects,
+                                                  restrict_to_samples,
+                                                  create_files=True,
+                                                  # Failed jobs are restarted from
+                                                  # flowcells set up before as well
+                                                  incremental=not restart_failed_jobs,
+                                                  plan=fc_plan,
+                                                  config=config))
+        return fc_plan
+    if max_workers > 1 and len(demux_fcid_dirs_set) > 1:
+        LOG.info("Setting up {} flowcells, {} at a time".format(len(demux_fcid_dirs_set),
+                                                               max_workers))
+        pool = ThreadPool(min(max_workers, len(demux_fcid_dirs_set)))
+        try:
+            plans = pool.map(setup_flowcell, demux_fcid_dirs_set)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        plans = map(setup_flowcell, demux_fcid_dirs_set)
+    # Collect the samples split across flowcells into one project object
+    # here, in this thread only
+    plan = SetupPlan(staging_strategy=staging_strategy)
+    for fc_plan in plans:
+        plan.merge(fc_plan)
+    for project in plan.projects.values():
+        if UPPSALA_PROJECT_RE.match(project.project_id):
+            plan.charon_projects.add(project.project_id)
+    if plan_only:
+        LOG.info("Plan for flowcells {}: {}".format(", ".join(demux_fcid_dirs_set),
+                                                   plan.summary()))
+        return plan
+    if not plan.projects:
         if restrict_to_projects:
             error_message = ("No projects found to process; the specified flowcells "
                              "({fcid_dirs}) do not contain the specified project(s) "
@@ -93,26 +145,19 @@ def process_demultiplexed_flowcells(demux_fcid_dirs, restrict_to_projects=None,
                              "information.".format(",".join(demux_fcid_dirs_set)))
         LOG.info(error_message)
         sys.exit("Quitting: " + error_message)
-    else:
-        # Don't need the dict functionality anymore; revert to list
-        projects_to_analyze = projects_to_analyze.values()
-    for project in projects_to_analyze:
-        if UPPSALA_PROJECT_RE.match(project.project_id):
-            LOG.info('Creating Charon records for Uppsala project "{}" if they are missing'.format(project))
-            create_charon_entries_from_project(project)
-    # The automatic analysis that occurs after flowcells are delivered is
-    # only at the flowcell level. Another intermittent check determines if
-    # conditions are met for sample-level analysis to proceed and launches
-    # that if so.
-    launch_analysis_for_seqruns(projects_to_analyze, restart_failed_jobs)
+    execute_setup_plan(plan, restart_failed_jobs=restart_failed_jobs, config=config)
+    return plan
 
 
 ### FIXME rework so that the creation of the NGIObjects and the actual creation of files are different functions?
+@charon_stage("setup_analysis")
 @with_ngi_config
 def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
                                        restrict_to_projects=None, restrict_to_samples=None,
                                        create_files=True,
                                        ign_only=True,
+                                       incremental=True,
+                                       plan=None,
                                        config=None, config_file_path=None):
     """
     Copy and sort files from their CASAVA-demultiplexed flowcell structure
@@ -124,8 +169,14 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
     :param set projects_to_analyze: A dict (of Project objects, or empty)
     :param bool create_files: Alter the filesystem (as opposed to just parsing flowcells) (default True)
     :param bool ign_only: Only process IGN projects (default True)
+    :param bool incremental: Leave out the samples whose fastq files were all set up
+                             and their seqruns launched by an earlier run, and
+                             are unchanged since (default True); files set up
+                             before are not staged again either way
     :param list restrict_to_projects: Specific projects within the flowcell to process exclusively
     :param list restrict_to_samples: Specific samples within the flowcell to process exclusively
+    :param SetupPlan plan: Add the directories, fastq files and manifest entries
+                           to this plan instead of creating them (optional)
 
     :returns: A list of NGIProject objects that need to be run through the analysis pipeline
     :rtype: list
@@ -136,7 +187,6 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
     LOG.info("Setting up analysis for demultiplexed data in source folder \"{}\"".format(fc_dir))
     if not restrict_to_projects: restrict_to_projects = []
     if not restrict_to_samples: restrict_to_samples = []
-    if ign_only: charon_session = CharonSession()
     analysis_top_dir = os.path.abspath(config["analysis"]["top_dir"])
     if not os.path.exists(analysis_top_dir):
         error_msg = "Error: Analysis top directory {} does not exist".format(analysis_top_dir)
@@ -144,48 +194,71 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
         raise OSError(error_msg)
     if not os.path.exists(fc_dir):
         LOG.error("Error: Flowcell directory {} does not exist".format(fc_dir))
-        return []
+        return projects_to_analyze
     # Map the directory structure for this flowcell
     try:
         fc_dir_structure = parse_casava_directory(fc_dir)
     except RuntimeError as e:
         LOG.error("Error when processing flowcell dir \"{}\": {}".format(fc_dir, e))
-        return []
+        return projects_to_analyze
     fc_full_id = fc_dir_structure['fc_full_id']
+    # What earlier runs set up from this flowcell: the libprep of each fastq
+    # file, its size and mtime at the time and whether its seqrun was launched
+    manifest_path = os.path.join(analysis_top_dir, "flowcell_manifests",
+                                 "{}.json".format(fc_full_id))
+    manifest = load_flowcell_manifest(manifest_path) if create_files else {}
+    incremental = incremental and create_files
+    # The directories, fastq files and manifest entries are all collected
+    # first and then created together (or left to the caller's plan)
+    execute_plan = plan is None
+    if execute_plan:
+        plan = SetupPlan(staging_strategy=config["analysis"].get("staging_strategy",
+                                                                 "symlink"))
+    # Whether "staging" the files copies them
+    copied = plan.staging_strategy == "copy" or \
+             (plan.staging_strategy == "hardlink" and
+              os.stat(fc_dir).st_dev != os.stat(analysis_top_dir).st_dev)
     if not fc_dir_structure.get('projects'):
         LOG.warn("No projects found in specified flowcell directory \"{}\"".format(fc_dir))
+    # If specific projects are specified, skip those that do not match
+    fc_projects = [project for project in fc_dir_structure.get('projects', [])
+                   if not restrict_to_projects or
+                      project['project_name'] in restrict_to_projects]
+    # The Charon documents of the projects, fetched together up front; this
+    # requires Charon access
+    if ign_only:
+        # We can't determine if Uppsala projects are IGN as we have no
+        # data for Uppsala projects in Charon; process all of them
+        project_docs = get_projects_from_names([project['project_name'] for project in fc_projects
+                                                if not UPPSALA_PROJECT_RE.match(project['project_name'])])
+    else:
+        project_docs = {}
     # Iterate over the projects in the flowcell directory
-    for project in fc_dir_structure.get('projects', []):
+    for project in fc_projects:
         project_name = project['project_name']
-        # If specific projects are specified, skip those that do not match
-        if ign_only:
-            if not UPPSALA_PROJECT_RE.match(project_name):
-                # We can't determine if Uppsala projects are IGN as we have no
-                # data for Uppsala projects in Charon; process all of them
-                try:
-                    project_bpa = charon_session.project_get(project_name).get("best_practice_analysis")
-                except (CharonError, RuntimeError, ValueError) as e:
-                    LOG.warn('Could not retrieve project id from Charon (record missing?). '
-                     'Probably  project {} is not an IGN (no mixed flowcells)'.format(project_name))
-                    continue
-                if not project_bpa == "IGN":
-                    # If this is not an IGN project, skip it
-                    continue
-        if restrict_to_projects and project_name not in restrict_to_projects:
-            LOG.debug("Skipping project {}".format(project_name))
-            continue
-        try:
-            # This requires Charon access -- maps e.g. "Y.Mom_14_01" to "P123"
-            project_id = get_project_id_from_name(project_name)
-        except (CharonError, RuntimeError, ValueError) as e:
-            LOG.warn('Could not retrieve project id from Charon (record missing?). '
-                     'Using project name ("{}") as project id'.format(project_name))
-            project_id = project_name
+        project_doc = project_docs.get(project_name)
+        if ign_only and not UPPSALA_PROJECT_RE.match(project_name):
+            if project_doc is None:
+                LOG.warn('Could not retrieve project id from Charon (record missing?). '
+                 'Probably  project {} is not an IGN (no mixed flowcells)'.format(project_name))
+                continue
+            if not project_doc.get("best_practice_analysis") == "IGN":
+                # If this is not an IGN project, skip it
+                continue
+        if project_doc and project_doc.get("projectid"):
+            project_id = project_doc["projectid"]
+        else:
+            try:
+                # This requires Charon access -- maps e.g. "Y.Mom_14_01" to "P123"
+                project_id = get_project_id_from_name(project_name)
+            except (CharonError, RuntimeError, ValueError) as e:
+                LOG.warn('Could not retrieve project id from Charon (record missing?). '
+                         'Using project name ("{}") as project id'.format(project_name))
+                project_id = project_name
         LOG.info("Setting up project {}".format(project.get("project_name")))
-        # Create a project directory if it doesn't already exist, including
-        # intervening "DATA" directory
+        # The project directory, including the intervening "DATA" directory
         project_dir = os.path.join(analysis_top_dir, "DATA", project_name)
-        if create_files: safe_makedir(project_dir, 0770)
+        plan.directories.add(project_dir)
         try:
             project_obj = projects_to_analyze[project_dir]
         except KeyError:
@@ -201,86 +274,224 @@ def setup_analysis_directory_structure(fc_dir, projects_to_analyze,
             if restrict_to_samples and sample_name not in restrict_to_samples:
                 LOG.debug("Skipping sample {}: not in specified samples {}".format(sample_name, ", ".join(restrict_to_samples)))
                 continue
+            # Get the Library Prep ID for each file
+            pattern = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
+            fastq_files = filter(pattern.match, sample.get('files', []))
+            src_sample_dir = os.path.join(fc_dir_structure['fc_dir'],
+                                          project['data_dir'],
+                                          project['project_dir'],
+                                          sample['sample_dir'])
+            # The files already set up by an earlier run, unchanged since
+            unchanged_files = {}
+            for fq_file in fastq_files:
+                manifest_entry = manifest.get(os.path.join(src_sample_dir, fq_file))
+                if manifest_entry and \
+                        manifest_entry['size'] == sample['file_stats'][fq_file]['size'] and \
+                        manifest_entry['mtime'] == sample['file_stats'][fq_file]['mtime'] and \
+                        os.path.lexists(os.path.join(project_dir, sample_name,
+                                                     manifest_entry['libprep_name'],
+                                                     fc_full_id, fq_file)):
+                    unchanged_files[fq_file] = manifest_entry
+            if incremental and fastq_files and len(unchanged_files) == len(fastq_files) and \
+                    all(entry.get('launched') for entry in unchanged_files.values()):
+                LOG.debug("Skipping sample {}: no new or changed fastq files since "
+                          "the last run".format(sample_name))
+                continue
             LOG.info("Setting up sample {}".format(sample_name))
-            # Create a directory for the sample if it doesn't already exist
+            # The directory for the sample
             sample_dir = os.path.join(project_dir, sample_name)
-            if create_files: safe_makedir(sample_dir, 0770)
+            plan.directories.add(sample_dir)
             # This will only create a new sample object if it doesn't already exist in the project
             sample_obj = project_obj.add_sample(name=sample_name, dirname=sample_name)
-            # Get the Library Prep ID for each file
-            pattern = re.compile(".*\.(fastq|fq)(\.gz|\.gzip|\.bz2)?$")
-            fastq_files = filter(pattern.match, sample.get('files', []))
             # For each fastq file, create the libprep and seqrun objects
             # and add the fastq file to the seqprep object
             # Note again that these objects only get created if they don't yet exist;
             # if they do exist, the existing object is returned
+            new_fastq_files = collections.defaultdict(list)
+            # The seqrun -> libprep map of the sample is fetched from Charon
+            # once, when the first new file needs it
+            fcid_index = None
             for fq_file in fastq_files:
-                # Requires Charon access
-                try:
-                    libprep_name = determine_library_prep_from_fcid(project_id, sample_name, fc_full_id)
-                except ValueError:
-                    # This flowcell has not got library prep information in Charon and
-                    # is probably an Uppsala project; if so, we can parse the libprep name
-                    # from the SampleSheet.csv
+                if fq_file in unchanged_files:
+                    libprep_name = unchanged_files[fq_file]['libprep_name']
+                    # Already staged; the entry is only updated once the
+                    # seqrun is launched
+                    plan.add_manifest_entry(manifest_path, os.path.join(src_sample_dir, fq_file),
+                                            dict(unchanged_files[fq_file],
+                                                 seqrun_name=fc_full_id, launched=False))
+                else:
+                    if fcid_index is None:
+                        # Requires Charon access
+                        try:
+                            fcid_index = get_fcid_libprep_index(project_id, sample_name)
+                        except ValueError as e:
+                            LOG.warn(e)
+                            fcid_index = {}
                     try:
-                        if fc_dir_structure['samplesheet_path']:
-                            lane_num = parse_lane_from_filename(fq_file)
-                            # This throws a ValueError if it can't find anything
-                            libprep_name = determine_libprep_from_uppsala_samplesheet(
-                                                fc_dir_structure['samplesheet_path'],
-                                                project_id=project_id,
-                                                sample_id=sample_name,
-                                                seqrun_id=fc_full_id,
-                                                lane_num=lane_num)
-                        else:
-                            raise ValueError()
+                        libprep_name = determine_library_prep_from_fcid(project_id, sample_name,
+                                                                        fc_full_id, fcid_index)
                     except ValueError:
-                        LOG.error('Project "{}" / sample "{}" / fastq "{}" '
-                                  'has no libprep information in Charon and it '
-                                  'could not be determined from the SampleSheet.csv. '
-                                  'Skipping.'.format(project_name,
-                                                     sample_name,
-                                                     fq_file))
-                        continue
+                        # This flowcell has not got library prep information in Charon and
+                        # is probably an Uppsala project; if so, we can parse the libprep name
+                        # from the SampleSheet.csv
+                        try:
+                            if fc_dir_structure['samplesheet_path']:
+                                lane_num = parse_lane_from_filename(fq_file)
+                                # This throws a ValueError if it can't find anything
+                                libprep_name = determine_libprep_from_uppsala_samplesheet(
+                                                    fc_dir_structure['samplesheet_path'],
+                                                    project_id=project_id,
+                                                    sample_id=sample_name,
+                                                    seqrun_id=fc_full_id,
+                                                    lane_num=lane_num)
+                            else:
+                                raise ValueError()
+                        except ValueError:
+                            LOG.error('Project "{}" / sample "{}" / fastq "{}" '
+                                      'has no libprep information in Charon and it '
+                                      'could not be determined from the SampleSheet.csv. '
+                                      'Skipping.'.format(project_name,
+                                                         sample_name,
+                                                         fq_file))
+                            continue
+                    new_fastq_files[libprep_name].append(fq_file)
                 libprep_object = sample_obj.add_libprep(name=libprep_name,
                                                         dirname=libprep_name)
                 libprep_dir = os.path.join(sample_dir, libprep_name)
-                if create_files: safe_makedir(libprep_dir, 0770)
+                plan.directories.add(libprep_dir)
                 seqrun_object = libprep_object.add_seqrun(name=fc_full_id,
                                                           dirname=fc_full_id)
                 seqrun_dir = os.path.join(libprep_dir, fc_full_id)
-                if create_files: safe_makedir(seqrun_dir, 0770)
+                plan.directories.add(seqrun_dir)
                 seqrun_object.add_fastq_files(fq_file)
-            if fastq_files and create_files:
-                # rsync the source files to the sample directory
+            if new_fastq_files and create_files:
+                # Plan the staging of the new source files; they are all staged
+                # together once the whole flowcell has been gone through
                 #    src: flowcell/data/project/sample
                 #    dst: project/sample/libprep/flowcell_run
-                src_sample_dir = os.path.join(fc_dir_structure['fc_dir'],
-                                              project['data_dir'],
-                                              project['project_dir'],
-                                              sample['sample_dir'])
-                for libprep_obj in sample_obj:
-                    for seqrun_obj in libprep_obj:
-                        src_fastq_files = [os.path.join(src_sample_dir, fastq_file) for
-                                           fastq_file in seqrun_obj.fastq_files]
-                        seqrun_dst_dir = os.path.join(project_obj.base_path, project_obj.dirname,
-                                                      sample_obj.dirname, libprep_obj.dirname,
-                                                      seqrun_obj.dirname)
-                        LOG.info("Copying fastq files from {} to {}...".format(src_sample_dir, seqrun_dir))
-                        #try:
-                        ## FIXME this exception should be handled somehow when rsync fails
-                        do_symlink(src_fastq_files, seqrun_dir)
-                        #do_rsync(src_fastq_files, seqrun_dir)
-                        #except subprocess.CalledProcessError as e:
-                        #    ## TODO Here the rsync has failed
-                        #    ##      should we delete this libprep from the sample object in this case?
-                        #    ##      this could be an issue downstream if e.g. Piper expects these files
-                        #    ##      and they are missing
-                        #    LOG.warn('Error when performing rsync for "{}/{}/{}": '
-                        #              '{}'.format(project, sample, libprep, e,))
+                for libprep_name, libprep_fastq_files in new_fastq_files.items():
+                    seqrun_dst_dir = os.path.join(sample_dir, libprep_name, fc_full_id)
+                    for fq_file in libprep_fastq_files:
+                        src_fastq_file = os.path.join(src_sample_dir, fq_file)
+                        file_stats = sample['file_stats'][fq_file]
+                        plan.add_link(src_fastq_file, os.path.join(seqrun_dst_dir, fq_file),
+                                      file_stats['size'], copied)
+                        plan.add_manifest_entry(manifest_path, src_fastq_file, {
+                                'size': file_stats['size'],
+                                'mtime': file_stats['mtime'],
+                                'project_name': project_name,
+                                'project_id': project_id,
+                                'sample_name': sample_name,
+                                'libprep_name': libprep_name,
+                                'seqrun_name': fc_full_id,
+                                'launched': False})
+        if incremental and not project_obj.samples:
+            # Nothing new to analyze for this project on this flowcell
+            del projects_to_analyze[project_dir]
+    if create_files and execute_plan:
+        execute_setup_plan(plan, launch=False, config=config)
     return projects_to_analyze
 
 
+@with_ngi_config
+def execute_setup_plan(plan, launch=True, restart_failed_jobs=False,
+                       config=None, config_file_path=None):
+    """Carry out a SetupPlan: create the directories, stage the fastq files,
+    record them in the flowcell manifests and, if launch is set, create the
+    missing Charon records and launch the seqrun analyses. The files are
+    recorded as launched only once their seqrun has been launched or is
+    reported as running or done, so that the next run retries the others
+    (e.g. those left for later by the scheduler) without staging them again.
+
+    :param SetupPlan plan: The plan, e.g. from process_demultiplexed_flowcells
+    :param bool launch: Also create the Charon records and launch the analyses (default True)
+    :param bool restart_failed_jobs: Restart jobs marked as "FAILED" in Charon.
+    :param dict config: The parsed NGI configuration file; optional.
+    :param str config_file_path: The path to the NGI configuration file; optional.
+
+    :returns: The outcome of the staging
+    :rtype: StagingReport
+    """
+    make_directories(plan.directories, 0770)
+    # Files staged since the plan was made are left alone
+    staging_tasks, staging_skipped = plan_staging((src, dst) for src, dst, _, _ in plan.links)
+    LOG.info("Staging {} fastq files".format(len(staging_tasks)))
+    staging_report = stage_files(staging_tasks,
+                                 strategy=plan.staging_strategy,
+                                 max_workers=config["analysis"].get("staging_workers"),
+                                 checksum=config["analysis"].get("staging_checksum", False),
+                                 skipped=staging_skipped)
+    # Files that failed are left out of the manifest and retried next time;
+    # those staged by an earlier run have no link in the plan
+    staged_files = set(task.src for task in staging_report.staged + staging_report.skipped)
+    linked_files = set(src for src, _, _, _ in plan.links)
+    for manifest_path, entries in plan.manifests.items():
+        manifest = load_flowcell_manifest(manifest_path)
+        manifest.update((src, entry) for src, entry in entries.items()
+                        if src in staged_files or src not in linked_files)
+        write_flowcell_manifest(manifest_path, manifest)
+    if launch and plan.projects:
+        projects_to_analyze = plan.projects.values()
+        for project in projects_to_analyze:
+            if project.project_id in plan.charon_projects:
+                LOG.info('Creating Charon records for Uppsala project "{}" if they are missing'.format(project))
+                create_charon_entries_from_project(project)
+        # The automatic analysis that occurs after flowcells are delivered is
+        # only at the flowcell level. Another intermittent check determines if
+        # conditions are met for sample-level analysis to proceed and launches
+        # that if so.
+        launched = launch_analysis_for_seqruns(projects_to_analyze, restart_failed_jobs,
+                                               config=config)
+        mark_seqruns_launched(plan.manifests,
+                              set((obj_dict["project"].project_id, obj_dict["sample"].name,
+                                   obj_dict["libprep"].name, obj_dict["seqrun"].name)
+                                  for obj_dict in launched))
+    return staging_report
+
+
+def mark_seqruns_launched(manifests, seqruns):
+    """Record in the flowcell manifests that the fastq files of the seqruns
+    were launched, so that later runs leave them out.
+
+    :param dict manifests: manifest path -> {src fastq file: manifest entry}, as in SetupPlan
+    :param set seqruns: (project id, sample id, libprep id, seqrun id) tuples
+    """
+    for manifest_path, entries in manifests.items():
+        manifest = load_flowcell_manifest(manifest_path)
+        launched_files = [src for src, entry in entries.items()
+                          if src in manifest and
+                             (entry['project_id'], entry['sample_name'],
+                              entry['libprep_name'], entry['seqrun_name']) in seqruns]
+        if not launched_files:
+            continue
+        for src in launched_files:
+            manifest[src]['launched'] = True
+        write_flowcell_manifest(manifest_path, manifest)
+
+
+def load_flowcell_manifest(manifest_path):
+    """Load the record of the fastq files set up from a flowcell, keyed by
+    source path; an empty dict if there is none (or it cannot be read)."""
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)["files"]
+    except IOError:
+        return {}
+    except (ValueError, KeyError) as e:
+        LOG.warn('Ignoring unreadable flowcell manifest "{}": {}'.format(manifest_path, e))
+        return {}
+
+
+def write_flowcell_manifest(manifest_path, manifest):
+    """Write the manifest of a flowcell (see load_flowcell_manifest); the file
+    is replaced in one step so that it is never left half-written."""
+    safe_makedir(os.path.dirname(manifest_path), 0770)
+    tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({"files": manifest}, f, indent=4, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+
 def parse_casava_directory(fc_dir):
     """
     Traverse a CASAVA-1.8-generated directory structure and return a dictionary
@@ -323,34 +534,50 @@ def parse_casava_directory(fc_dir):
     fc_dir = os.path.abspath(fc_dir)
     LOG.info("Parsing flowcell directory \"{}\"...".format(fc_dir))
     fc_full_id = os.path.basename(fc_dir)
+    fc_parent_dir = os.path.dirname(fc_dir) + "/"
+    # Each directory is listed once and the fastq files are stat'ed as they
+    # are listed, instead of globbing each level of the tree separately
+    try:
+        fc_entries = scan_directory(fc_dir)
+    except OSError as e:
+        raise RuntimeError('Could not read flowcell directory "{}": {}'.format(fc_dir, e))
+    samplesheet_path = None
+    for fc_entry in fc_entries:
+        if fc_entry.name == "SampleSheet.csv" and not fc_entry.is_dir:
+            samplesheet_path = fc_entry.path
     # "Unaligned*" because SciLifeLab dirs are called "Unaligned_Xbp"
     # (where "X" is the index length) and there is also an "Unaligned" folder
-    unaligned_dir_pattern = os.path.join(fc_dir,"Unaligned*")
-    # e.g. 131030_SN7001362_0103_BC2PUYACXX/Unaligned_16bp/Project_J__Bjorkegren_13_02/
-    project_dir_pattern = os.path.join(unaligned_dir_pattern,"Project_*")
-    for project_dir in glob.glob(project_dir_pattern):
-        LOG.info("Parsing project directory \"{}\"...".format(project_dir.split(os.path.split(fc_dir)[0] + "/")[1]))
-        project_samples = []
-        try:
-            samplesheet_path = os.path.abspath(glob.glob(os.path.join(project_dir, "../../SampleSheet.csv"))[0])
-        except IndexError:
-            samplesheet_path = None
-        sample_dir_pattern = os.path.join(project_dir,"Sample_*")
-        # e.g. <Project_dir>/Sample_P680_356F_dual56/
-        for sample_dir in glob.glob(sample_dir_pattern):
-            LOG.info("Parsing samples directory \"{}\"...".format(sample_dir.split(os.path.split(fc_dir)[0] + "/")[1]))
-            fastq_file_pattern = os.path.join(sample_dir,"*.fastq.gz")
-            fastq_files = [os.path.basename(file) for file in glob.glob(fastq_file_pattern)]
-            sample_name = os.path.basename(sample_dir).replace("Sample_","").replace('__','.')
-            project_samples.append({'sample_dir': os.path.basename(sample_dir),
-                                    'sample_name': sample_name,
-                                    'files': fastq_files,
-                                   })
-        project_name = os.path.basename(project_dir).replace("Project_","").replace('__','.')
-        projects.append({'data_dir': os.path.relpath(os.path.dirname(project_dir),fc_dir),
-                         'project_dir': os.path.basename(project_dir),
-                         'project_name': project_name,
-                         'samples': project_samples})
+    unaligned_dirs = [e for e in fc_entries if e.is_dir and e.name.startswith("Unaligned")]
+    for unaligned_dir in unaligned_dirs:
+        # e.g. 131030_SN7001362_0103_BC2PUYACXX/Unaligned_16bp/Project_J__Bjorkegren_13_02/
+        for project_dir in scan_directory(unaligned_dir.path, "Project_*"):
+            if not project_dir.is_dir:
+                continue
+            LOG.info("Parsing project directory \"{}\"...".format(project_dir.path.split(fc_parent_dir)[1]))
+            project_samples = []
+            # e.g. <Project_dir>/Sample_P680_356F_dual56/
+            for sample_dir in scan_directory(project_dir.path, "Sample_*"):
+                if not sample_dir.is_dir:
+                    continue
+                LOG.debug("Parsing samples directory \"{}\"...".format(sample_dir.path.split(fc_parent_dir)[1]))
+                fastq_files = []
+                file_stats = {}
+                for file_entry in scan_directory(sample_dir.path, "*.fastq.gz", stat_files=True):
+                    if not file_entry.is_dir:
+                        fastq_files.append(file_entry.name)
+                        file_stats[file_entry.name] = {'size': file_entry.size,
+                                                       'mtime': file_entry.mtime}
+                sample_name = sample_dir.name.replace("Sample_","").replace('__','.')
+                project_samples.append({'sample_dir': sample_dir.name,
+                                        'sample_name': sample_name,
+                                        'files': fastq_files,
+                                        'file_stats': file_stats,
+                                       })
+            project_name = project_dir.name.replace("Project_","").replace('__','.')
+            projects.append({'data_dir': unaligned_dir.name,
+                             'project_dir': project_dir.name,
+                             'project_name': project_name,
+                             'samples': project_samples})
     return {'fc_dir'    : fc_dir,
             'fc_full_id': fc_full_id,
             'projects': projects,
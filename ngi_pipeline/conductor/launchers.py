@@ -2,16 +2,22 @@
 
 from __future__ import print_function
 
-import importlib
 import os
 
+from multiprocessing.pool import ThreadPool
+
 from ngi_pipeline.conductor.classes import NGIProject
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.conductor.registry import get_workflow_registry
+from ngi_pipeline.conductor.scheduling import LaunchScheduler
+from ngi_pipeline.database.classes import AsyncCharonSession, CharonError, \
+                                          get_charon_session
 from ngi_pipeline.database.filesystem import recreate_project_from_db
+from ngi_pipeline.database.instrumentation import charon_stage
 ## FIXME this is engine-specific
-from ngi_pipeline.engines.piper_ngi.local_process_tracking import update_charon_with_local_jobs_status
+from ngi_pipeline.engines.piper_ngi.local_process_tracking import count_running_analyses_local, \
+                                                             update_charon_with_local_jobs_status
 from ngi_pipeline.log.loggers import minimal_logger
-from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.classes import resource_limited, with_ngi_config
 
 
 LOG = minimal_logger(__name__)
@@ -32,8 +38,11 @@ def launch_analysis_for_seqruns(projects_to_analyze, restart_failed_jobs=False,
     :param bool restart_failed_jobs: Restart jobs marked as "FAILED" in Charon
     :param dict config: The parsed NGI configuration file; optional/has default.
     :param str config_file_path: The path to the NGI configuration file; optional/has default.
+
+    :returns: The seqruns launched or already running or done (see launch_analysis)
+    :rtype: list
     """
-    launch_analysis(level="seqrun", projects_to_analyze=projects_to_analyze,
+    return launch_analysis(level="seqrun", projects_to_analyze=projects_to_analyze,
                     restart_failed_jobs=restart_failed_jobs, config=config,
                     config_file_path=config_file_path)
 
@@ -50,56 +59,89 @@ def launch_analysis_for_samples(projects_to_analyze, restart_failed_jobs=False,
     :param bool restart_failed_jobs: Restart jobs marked as "FAILED" in Charon
     :param dict config: The parsed NGI configuration file; optional/has default.
     :param str config_file_path: The path to the NGI configuration file; optional/has default.
+
+    :returns: The samples launched or already running or done (see launch_analysis)
+    :rtype: list
     """
-    launch_analysis(level="sample", projects_to_analyze=projects_to_analyze,
+    return launch_analysis(level="sample", projects_to_analyze=projects_to_analyze,
                     restart_failed_jobs=restart_failed_jobs, config=config,
                     config_file_path=config_file_path)
 
+@charon_stage("launch_analysis")
 @with_ngi_config
 def launch_analysis(level, projects_to_analyze, restart_failed_jobs=False,
-                    config=None, config_file_path=None):
+                    max_workers=None, config=None, config_file_path=None):
     """Launch the appropriate seqrun (flowcell-level) analysis for each fastq
     file in the project.
 
+    The Charon status of all the seqruns or samples is checked up front (see
+    filter_by_charon_status) and their analyses launched in a pool of
+    max_workers threads; the engine steps that need it are further limited
+    by analysis.launch_limits in the config (e.g. {"setupfilecreator": 8, "piper": 4}).
+    They are launched in order of priority, taking turns between projects,
+    and those over the in-flight limits are left for a later run (see
+    conductor.scheduling and analysis.scheduling in the config).
+
     :param list projects_to_analyze: The list of projects (Project objects) to analyze
+    :param int max_workers: The number of analyses launched at the same time
+                            (default analysis.launch_workers in the config, or 1)
     :param dict config: The parsed NGI configuration file; optional/has default.
     :param str config_file_path: The path to the NGI configuration file; optional/has default.
+
+    The engines' analyze_seqrun and analyze_seqruns return the seqruns
+    they launched, as (project, sample, libprep, seqrun) tuples.
+
+    :returns: The analyses launched, or that Charon reports as already running
+              or done, as dicts with the "project", "sample" and (for seqruns)
+              "libprep" and "seqrun" objects; the others (left for later,
+              failed or skipped) still need launching
+    :rtype: list
     """
+    # Fails here, before anything is launched, if a workflow is misconfigured
+    workflow_registry = get_workflow_registry(config)
+    if not max_workers:
+        max_workers = int(config.get("analysis", {}).get("launch_workers", 1))
+    resource_limited.set_limits(config.get("analysis", {}).get("launch_limits") or {})
     # Update Charon with the local state of all the jobs we're running
     update_charon_with_local_jobs_status()
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
+    # This is weird
+    objects_to_process = []
+    # Get information from Charon regarding which workflows to run
+    fetch_errors = {}
+    project_docs = charon_session.projects_get((project.project_id for project
+                                                in projects_to_analyze),
+                                               errors=fetch_errors)
     for project in projects_to_analyze:
-        # Get information from Charon regarding which workflows to run
+        if project.project_id in fetch_errors:
+            LOG.error('Skipping project "{}": could not fetch it from Charon: '
+                      '{}'.format(project, fetch_errors[project.project_id]))
+            continue
         try:
-            # E.g. "NGI" for NGI DNA Samples
-            workflow = charon_session.project_get(project.project_id)["pipeline"]
-        except (KeyError, CharonError) as e:
-            # Workflow missing from Charon?
-            LOG.error('Skipping project "{}" because of error: {}'.format(project, e))
+            project_doc = project_docs[project.project_id]
+        except KeyError:
+            LOG.error('Skipping project "{}": not found in Charon'.format(project))
             continue
         try:
-            analysis_engine_module_name = config["analysis"]["workflows"][workflow]["analysis_engine"]
+            # E.g. "NGI" for NGI DNA Samples
+            workflow = project_doc["pipeline"]
         except KeyError:
-            error_msg = ("No analysis engine for workflow \"{}\" specified "
-                         "in configuration file. Skipping this workflow "
-                         "for project {}".format(workflow, project))
-            LOG.error(error_msg)
-            raise RuntimeError(error_msg)
-        # Import the adapter module specified in the config file (e.g. piper_ngi)
+            LOG.error('Skipping project "{}": no workflow ("pipeline") set for '
+                      'it in Charon'.format(project))
+            continue
         try:
-            analysis_module = importlib.import_module(analysis_engine_module_name)
-        except ImportError as e:
-            error_msg = ('Skipping project "{}" workflow "{}": couldn\'t import '
-                         'module "{}": {}'.format(project, workflow, analysis_engine_module_name, e))
-            LOG.error(error_msg)
-            # Next project
+            # The adapter module specified in the config file (e.g. piper_ngi)
+            analysis_module = workflow_registry.get_engine(workflow)
+        except KeyError as e:
+            LOG.error('Skipping project "{}": {}'.format(project, e.args[0]))
             continue
 
-        # This is weird
-        objects_to_process = []
         if level == "sample":
             for sample in project:
-                objects_to_process.append({"project": project, "sample": sample})
+                objects_to_process.append({"project": project, "sample": sample,
+                                           "project_doc": project_doc,
+                                           "workflow": workflow,
+                                           "analysis_module": analysis_module})
         elif level == "seqrun":
             for sample in project:
                 for libprep in sample:
@@ -107,86 +149,219 @@ def launch_analysis(level, projects_to_analyze, restart_failed_jobs=False,
                         objects_to_process.append({"project": project,
                                                    "sample": sample,
                                                    "libprep": libprep,
-                                                   "seqrun": seqrun})
-        # Still weird and not so great
+                                                   "seqrun": seqrun,
+                                                   "project_doc": project_doc,
+                                                   "workflow": workflow,
+                                                   "analysis_module": analysis_module})
+
+    # The analyses that need no launching: those already running or done
+    settled = []
+    objects_to_process = filter_by_charon_status(level, objects_to_process,
+                                                 restart_failed_jobs, charon_session,
+                                                 running_or_done=settled)
+    scheduler = LaunchScheduler.from_config(config, running=count_running_analyses_local())
+    objects_to_process, deferred = scheduler.schedule(objects_to_process, charon_session)
+    if deferred:
+        LOG.info("Leaving {} {} analyses for a later run: too many already "
+                 "running".format(len(deferred), level))
+    if level == "seqrun":
+        objects_to_process = batch_seqruns_by_flowcell(objects_to_process)
+    # Still weird and not so great
+    def launch(obj_dict):
+        if "batch" in obj_dict:
+            LOG.info('Attempting to launch seqrun analysis for {} seqruns of flowcell '
+                     '"{}", workflow "{}"'.format(len(obj_dict["batch"]), obj_dict["seqrun"],
+                                                  obj_dict["workflow"]))
+            try:
+                launched_seqruns = obj_dict["analysis_module"].analyze_seqruns(
+                        [(seqrun_dict["project"], seqrun_dict["sample"],
+                          seqrun_dict["libprep"], seqrun_dict["seqrun"])
+                         for seqrun_dict in obj_dict["batch"]])
+            except Exception as e:
+                LOG.error('Cannot process the {} seqruns of flowcell "{}" / workflow '
+                          '"{}": {}'.format(len(obj_dict["batch"]), obj_dict["seqrun"],
+                                            obj_dict["workflow"], e))
+                return None
+            # The engine leaves out the seqruns it failed to launch
+            return [seqrun_dict for seqrun_dict in obj_dict["batch"]
+                    if (seqrun_dict["project"], seqrun_dict["sample"],
+                        seqrun_dict["libprep"], seqrun_dict["seqrun"]) in launched_seqruns]
+        project = obj_dict.get("project")
+        sample = obj_dict.get("sample")
+        libprep = obj_dict.get("libprep")
+        seqrun = obj_dict.get("seqrun")
+        workflow = obj_dict["workflow"]
+        analysis_module = obj_dict["analysis_module"]
+        try:
+            # The engines themselves know which sub-workflows
+            # they need to execute for a given level. For example,
+            # with DNA Variant Calling on the sequencing run
+            # level, we need to execute basic alignment and QC.
+            if level == "seqrun":
+                LOG.info('Attempting to launch seqrun analysis for '
+                         'project "{}" / sample "{}" / libprep "{}" '
+                         '/ seqrun "{}", workflow "{}"'.format(project,
+                                                               sample,
+                                                               libprep,
+                                                               seqrun,
+                                                               workflow))
+                if not analysis_module.analyze_seqrun(project=project,
+                                                      sample=sample,
+                                                      libprep=libprep,
+                                                      seqrun=seqrun):
+                    # Failed; the engine has logged why
+                    return None
+            else: # sample level
+                LOG.info('Attempting to launch sample analysis for '
+                         'project "{}" / sample "{}" / workflow '
+                         '"{}"'.format(project, sample, workflow))
+                analysis_module.analyze_sample(project=project,
+                                               sample=sample)
+            return [obj_dict]
+        except Exception as e:
+            # Left for a later run; the other launches go ahead
+            LOG.error('Cannot process project "{}" / sample "{}" / '
+                      'libprep "{}" / seqrun "{}" / workflow '
+                      '"{}" : {}'.format(project, sample, libprep,
+                                         seqrun, workflow, e))
+            return None
+
+    if max_workers > 1 and len(objects_to_process) > 1:
+        LOG.info("Launching {} {} analyses, {} at a time".format(len(objects_to_process),
+                                                              level, max_workers))
+        pool = ThreadPool(min(max_workers, len(objects_to_process)))
+        try:
+            # One at a time, so that they start in order of priority
+            for launched in pool.imap(launch, objects_to_process, chunksize=1):
+                settled.extend(launched or [])
+        finally:
+            pool.close()
+            pool.join()
+    else:
         for obj_dict in objects_to_process:
-            project = obj_dict.get("project")
-            sample = obj_dict.get("sample")
-            libprep = obj_dict.get("libprep")
-            seqrun = obj_dict.get("seqrun")
+            settled.extend(launch(obj_dict) or [])
+    return settled
+
+
+def batch_seqruns_by_flowcell(objects_to_process):
+    """Put together the seqruns of each flowcell whose engine can launch
+    several at once (e.g. as one SLURM array job), i.e. has analyze_seqruns.
 
+    :param list objects_to_process: Dicts with the "project", "sample",
+                                    "libprep", "seqrun", "workflow" and
+                                    "analysis_module"
+
+    :returns: The dicts of the other seqruns, and a dict per flowcell and
+              workflow with its seqrun dicts as "batch", in the order given
+    :rtype: list
+    """
+    batched, batches = [], {}
+    for obj_dict in objects_to_process:
+        if not hasattr(obj_dict["analysis_module"], "analyze_seqruns"):
+            batched.append(obj_dict)
+            continue
+        batch_key = (obj_dict["seqrun"].name, obj_dict["workflow"])
+        if batch_key not in batches:
+            batches[batch_key] = {"seqrun": obj_dict["seqrun"].name,
+                                  "workflow": obj_dict["workflow"],
+                                  "analysis_module": obj_dict["analysis_module"],
+                                  "batch": []}
+            batched.append(batches[batch_key])
+        batches[batch_key]["batch"].append(obj_dict)
+    return batched
+
+
+def filter_by_charon_status(level, objects_to_process, restart_failed_jobs=False,
+                            charon_session=None, running_or_done=None):
+    """Check the Charon status of each seqrun or sample and keep those whose
+    analysis should be launched: not running or done, and not failed unless
+    restart_failed_jobs is set. The statuses are read from the seqrun listing
+    of each libprep, or the sample listing of each project, all fetched
+    concurrently, rather than with a request per seqrun or sample.
+
+    :param str level: "seqrun" or "sample"
+    :param list objects_to_process: Dicts with the "project", "sample" and
+                                    (for seqruns) "libprep" and "seqrun" objects
+    :param bool restart_failed_jobs: Keep the seqruns or samples marked as "FAILED"
+    :param CharonSession charon_session: The session to use (default the shared one)
+    :param list running_or_done: Add the objects that Charon reports as running
+                                 or done to this list (optional)
+
+    :returns: The objects to launch the analysis of
+    :rtype: list
+    """
+    charon_session = charon_session or get_charon_session()
+    if level == "seqrun":
+        def listing_key(obj_dict):
+            return (obj_dict["project"].project_id, obj_dict["sample"].name,
+                    obj_dict["libprep"].name)
+        get_listing, listing_name = "libprep_get_seqruns", "seqruns"
+        id_field, status_field = "seqrunid", "alignment_status"
+    else:
+        def listing_key(obj_dict):
+            return (obj_dict["project"].project_id,)
+        get_listing, listing_name = "project_get_samples", "samples"
+        id_field, status_field = "sampleid", "status"
+    listing_keys = set(listing_key(obj_dict) for obj_dict in objects_to_process)
+    with AsyncCharonSession(charon_session) as async_session:
+        pending = [(key, getattr(async_session, get_listing)(*key)) for key in listing_keys]
+    # listing key -> {seqrun or sample id: status}
+    statuses = {}
+    for key, result in pending:
+        try:
+            statuses[key] = dict((doc[id_field], doc.get(status_field))
+                                 for doc in result.get()[listing_name])
+        except (CharonError, KeyError) as e:
+            LOG.warn('Unable to get the {} of {} from Charon: {}'.format(listing_name,
+                                                                         "/".join(key), e))
+            statuses[key] = {}
+
+    objects_to_launch = []
+    for obj_dict in objects_to_process:
+        project = obj_dict.get("project")
+        sample = obj_dict.get("sample")
+        libprep = obj_dict.get("libprep")
+        seqrun = obj_dict.get("seqrun")
+        charon_reported_status = statuses[listing_key(obj_dict)].get(
+                seqrun.name if level == "seqrun" else sample.name)
+        if not charon_reported_status:
+            LOG.warn('Unable to get required information from Charon for '
+                      'sample "{}" / project "{}" -- forcing it to new'.format(sample, project))
             try:
                 if level == "seqrun":
-                    charon_reported_status = charon_session.seqrun_get(project.project_id,
-                                                                       sample, libprep,
-                                                                       seqrun)['alignment_status']
-                else: # sample-level
-                    charon_reported_status = charon_session.sample_get(project.project_id,
-                                                                       sample)['status']
-            except (CharonError, KeyError) as e:
-                LOG.warn('Unable to get required information from Charon for '
-                          'sample "{}" / project "{}" -- forcing it to new: {}'.format(sample, project, e))
-                if level == "seqrun":
-                    charon_session.seqrun_update(project.project_id, sample.name, libprep.name, seqrun.name, alignment_status="NEW")
-                    charon_reported_status = charon_session.seqrun_get(project.project_id,
-                                                                       sample, libprep,
-                                                                       seqrun)['alignment_status']
+                    charon_session.seqrun_update(project.project_id, sample.name, libprep.name,
+                                                 seqrun.name, alignment_status="NEW")
                 else:
                     charon_session.sample_update(project.project_id, sample.name, status="NEW")
-                    charon_reported_status = charon_session.sample_get(project.project_id,
-                                                                       sample)['status']
+            except CharonError as e:
+                LOG.error('Could not set project "{}" / sample "{}" to "NEW" in Charon; '
+                          'skipping it: {}'.format(project, sample, e))
+                continue
+            charon_reported_status = "NEW"
 
-            # Check Charon to ensure this hasn't already been processed
-            if charon_reported_status in ("RUNNING", "DONE"):
+        # Check Charon to ensure this hasn't already been processed
+        if charon_reported_status in ("RUNNING", "DONE"):
+            if level == "seqrun":
+                LOG.info('Charon reports seqrun analysis for project "{}" / sample "{}" '
+                         '/ libprep "{}" / seqrun "{}" does not need processing '
+                         ' (already "{}")'.format(project, sample, libprep, seqrun,
+                                                  charon_reported_status))
+            else: # Sample
+                LOG.info('Charon reports seqrun analysis for project "{}" / sample "{}" '
+                         'does not need processing '
+                         ' (already "{}")'.format(project, sample, charon_reported_status))
+            if running_or_done is not None:
+                running_or_done.append(obj_dict)
+            continue
+        elif charon_reported_status == "FAILED":
+            if not restart_failed_jobs:
                 if level == "seqrun":
-                    LOG.info('Charon reports seqrun analysis for project "{}" / sample "{}" '
-                             '/ libprep "{}" / seqrun "{}" does not need processing '
-                             ' (already "{}")'.format(project, sample, libprep, seqrun,
-                                                      charon_reported_status))
+                    LOG.error('FAILED:  Project "{}" / sample "{}" / library "{}" '
+                              '/ flowcell "{}": Charon reports FAILURE, manual '
+                              'investigation needed!'.format(project, sample, libprep, seqrun))
                 else: # Sample
-                    LOG.info('Charon reports seqrun analysis for project "{}" / sample "{}" '
-                             'does not need processing '
-                             ' (already "{}")'.format(project, sample, charon_reported_status))
-                continue
-            elif charon_reported_status == "FAILED":
-                if not restart_failed_jobs:
-                    if level == "seqrun":
-                        LOG.error('FAILED:  Project "{}" / sample "{}" / library "{}" '
-                                  '/ flowcell "{}": Charon reports FAILURE, manual '
-                                  'investigation needed!'.format(project, sample, libprep, seqrun))
-                    else: # Sample
-                        LOG.error('FAILED:  Project "{}" / sample "{}" Charon reports FAILURE, manual '
-                                  'investigation needed!'.format(project, sample, libprep, seqrun))
-                    continue
-            try:
-                # The engines themselves know which sub-workflows
-                # they need to execute for a given level. For example,
-                # with DNA Variant Calling on the sequencing run
-                # level, we need to execute basic alignment and QC.
-                if level == "seqrun":
-                    LOG.info('Attempting to launch seqrun analysis for '
-                             'project "{}" / sample "{}" / libprep "{}" '
-                             '/ seqrun "{}", workflow "{}"'.format(project,
-                                                                   sample,
-                                                                   libprep,
-                                                                   seqrun,
-                                                                   workflow))
-                    analysis_module.analyze_seqrun(project=project,
-                                                   sample=sample,
-                                                   libprep=libprep,
-                                                   seqrun=seqrun)
-                else: # sample level
-                    LOG.info('Attempting to launch sample analysis for '
-                             'project "{}" / sample "{}" / workflow '
-                             '"{}"'.format(project, sample, workflow))
-                    analysis_module.analyze_sample(project=project,
-                                                   sample=sample)
-
-            except Exception as e:
-                raise
-                LOG.error('Cannot process project "{}" / sample "{}" / '
-                          'libprep "{}" / seqrun "{}" / workflow '
-                          '"{}" : {}'.format(project, sample, libprep,
-                                             seqrun, workflow, e))
-                set_new_seqrun_status = "FAILED"
+                    LOG.error('FAILED:  Project "{}" / sample "{}" Charon reports FAILURE, manual '
+                              'investigation needed!'.format(project, sample, libprep, seqrun))
                 continue
+        objects_to_launch.append(obj_dict)
+    return objects_to_launch
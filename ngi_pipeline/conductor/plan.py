@@ -0,0 +1,181 @@
+"""What setting up demultiplexed flowcells would do, worked out in advance.
+
+A SetupPlan holds the directories to create, the fastq files to stage, the
+flowcell manifest entries to record, the Charon records to create and the
+seqrun analyses to launch. It is built by process_demultiplexed_flowcells
+with plan_only=True, can be saved to and loaded from JSON for operators to
+review, and is carried out by execute_setup_plan.
+"""
+import json
+
+from ngi_pipeline.conductor.classes import NGIProject
+
+
+class SetupPlan(object):
+    """The changes to make for a set of flowcells."""
+    def __init__(self, staging_strategy="symlink"):
+        """
+        :param str staging_strategy: How the fastq files will be staged (see utils.staging)
+        """
+        self.staging_strategy = staging_strategy
+        self.directories = set()
+        # [src, dst, size in bytes, whether the data is copied]
+        self.links = []
+        # manifest path -> {src fastq file: manifest entry}
+        self.manifests = {}
+        # project dir -> NGIProject, with the seqruns to analyze
+        self.projects = {}
+        # The ids of the projects whose Charon records are created if missing
+        self.charon_projects = set()
+
+    def add_link(self, src, dst, size, copied=False):
+        self.links.append([src, dst, size, copied])
+
+    def add_manifest_entry(self, manifest_path, src, entry):
+        self.manifests.setdefault(manifest_path, {})[src] = entry
+
+    def add_projects(self, projects):
+        """Add NGIProjects, merging those already in the plan.
+
+        :param dict projects: project dir -> NGIProject
+        """
+        for project_dir, project_obj in projects.items():
+            try:
+                self.projects[project_dir].merge(project_obj)
+            except KeyError:
+                self.projects[project_dir] = project_obj
+
+    def merge(self, other):
+        """Add the changes of another plan (e.g. for another flowcell) to this one."""
+        self.directories.update(other.directories)
+        self.links.extend(other.links)
+        for manifest_path, entries in other.manifests.items():
+            self.manifests.setdefault(manifest_path, {}).update(entries)
+        self.add_projects(other.projects)
+        self.charon_projects.update(other.charon_projects)
+
+    @property
+    def jobs(self):
+        """The seqrun analyses that would be launched, unless Charon reports
+        them as already running or done."""
+        return [{"project": project.project_id, "sample": sample.name,
+                 "libprep": libprep.name, "seqrun": seqrun.name}
+                for project in self.projects.values()
+                for sample in project for libprep in sample for seqrun in libprep]
+
+    @property
+    def charon_records(self):
+        """The Charon records that would be created if they are missing."""
+        records = []
+        for project in self.projects.values():
+            if project.project_id not in self.charon_projects:
+                continue
+            records.append({"type": "project", "projectid": project.project_id})
+            for sample in project:
+                records.append({"type": "sample", "projectid": project.project_id,
+                                "sampleid": sample.name})
+                for libprep in sample:
+                    records.append({"type": "libprep", "projectid": project.project_id,
+                                    "sampleid": sample.name, "libprepid": libprep.name})
+                    for seqrun in libprep:
+                        records.append({"type": "seqrun", "projectid": project.project_id,
+                                        "sampleid": sample.name, "libprepid": libprep.name,
+                                        "seqrunid": seqrun.name})
+        return records
+
+    def estimate(self):
+        """Estimate the cost of carrying out the plan.
+
+        The Charon calls are a rough count: a POST per record, a GET of the
+        workflow of each project and a GET and an update of each job's status.
+
+        :returns: The bytes staged, the bytes of those copied rather than
+                  linked, and the Charon calls
+        :rtype: dict
+        """
+        return {"files": len(self.links),
+                "bytes": sum(link[2] for link in self.links),
+                "bytes_moved": sum(link[2] for link in self.links if link[3]),
+                "directories": len(self.directories),
+                "charon_calls": (len(self.charon_records) + len(self.projects) +
+                                 2 * len(self.jobs))}
+
+    def summary(self):
+        estimate = self.estimate()
+        return ("{} projects: {} directories, {} fastq files to {} ({:.1f} GB, "
+                "{:.1f} GB of it copied), {} Charon records, {} jobs, about {} "
+                "Charon calls".format(len(self.projects), estimate["directories"],
+                                      estimate["files"], self.staging_strategy,
+                                      estimate["bytes"] / 1e9,
+                                      estimate["bytes_moved"] / 1e9,
+                                      len(self.charon_records), len(self.jobs),
+                                      estimate["charon_calls"]))
+
+    def to_dict(self):
+        return {"staging_strategy": self.staging_strategy,
+                "directories": sorted(self.directories),
+                "links": self.links,
+                "manifests": self.manifests,
+                "projects": dict((project_dir, _project_to_dict(project))
+                                 for project_dir, project in self.projects.items()),
+                "charon_projects": sorted(self.charon_projects),
+                # For reading only; not loaded
+                "charon_records": self.charon_records,
+                "jobs": self.jobs,
+                "estimate": self.estimate()}
+
+    @classmethod
+    def from_dict(cls, plan_dict):
+        plan = cls(staging_strategy=plan_dict["staging_strategy"])
+        plan.directories = set(plan_dict["directories"])
+        plan.links = plan_dict["links"]
+        plan.manifests = plan_dict["manifests"]
+        plan.projects = dict((project_dir, _project_from_dict(project))
+                             for project_dir, project in plan_dict["projects"].items())
+        plan.charon_projects = set(plan_dict["charon_projects"])
+        return plan
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :raises IOError: If the file cannot be read
+        :raises ValueError: If it does not hold a plan
+        """
+        with open(path) as f:
+            try:
+                return cls.from_dict(json.load(f))
+            except (KeyError, TypeError) as e:
+                raise ValueError("{} is not a setup plan: {}".format(path, e))
+
+
+def _project_to_dict(project):
+    return {"name": project.name, "dirname": project.dirname,
+            "project_id": project.project_id, "base_path": project.base_path,
+            "samples": dict((sample.name, {
+                "dirname": sample.dirname,
+                "libpreps": dict((libprep.name, {
+                    "dirname": libprep.dirname,
+                    "seqruns": dict((seqrun.name, {
+                        "dirname": seqrun.dirname,
+                        "fastq_files": list(seqrun.fastq_files)})
+                        for seqrun in libprep)})
+                    for libprep in sample)})
+                for sample in project)}
+
+
+def _project_from_dict(project_dict):
+    project = NGIProject(name=project_dict["name"], dirname=project_dict["dirname"],
+                         project_id=project_dict["project_id"],
+                         base_path=project_dict["base_path"])
+    for sample_name, sample_dict in project_dict["samples"].items():
+        sample = project.add_sample(name=sample_name, dirname=sample_dict["dirname"])
+        for libprep_name, libprep_dict in sample_dict["libpreps"].items():
+            libprep = sample.add_libprep(name=libprep_name, dirname=libprep_dict["dirname"])
+            for seqrun_name, seqrun_dict in libprep_dict["seqruns"].items():
+                seqrun = libprep.add_seqrun(name=seqrun_name, dirname=seqrun_dict["dirname"])
+                seqrun.add_fastq_files([str(f) for f in seqrun_dict["fastq_files"]])
+    return project
@@ -0,0 +1,113 @@
+"""The analysis engines of the workflows in the config, loaded once per run.
+
+Each workflow in analysis.workflows names the module that runs it:
+
+    analysis:
+        workflows:
+            NGI:
+                analysis_engine: ngi_pipeline.engines.piper_ngi
+
+The registry imports these modules and checks that they provide the engine
+interface when it is built, so that a misconfigured workflow stops the run
+at the start rather than failing project by project part-way through it.
+"""
+import importlib
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# The functions every analysis engine must provide
+ENGINE_FUNCTIONS = ("analyze_seqrun", "analyze_sample", "get_subtasks_for_level")
+ANALYSIS_LEVELS = ("seqrun", "sample")
+
+# engine module names -> WorkflowRegistry, for the configs seen so far
+_registries = {}
+
+
+def get_workflow_registry(config):
+    """The registry for the workflows in the config, built on first use.
+
+    :param dict config: The parsed NGI configuration file
+
+    :returns: The registry
+    :rtype: WorkflowRegistry
+
+    :raises RuntimeError: If a workflow's engine is missing or cannot be loaded
+    """
+    workflows_config = config.get("analysis", {}).get("workflows") or {}
+    try:
+        key = tuple(sorted((workflow, workflow_config["analysis_engine"])
+                           for workflow, workflow_config in workflows_config.items()))
+    except (KeyError, TypeError):
+        # Reported by WorkflowRegistry
+        key = None
+    if key is None or key not in _registries:
+        registry = WorkflowRegistry(workflows_config)
+        _registries[key] = registry
+    return _registries[key]
+
+
+class WorkflowRegistry(object):
+    """Maps workflow names (the "pipeline" of the Charon project) to their
+    analysis engine modules."""
+    def __init__(self, workflows_config):
+        """
+        :param dict workflows_config: workflow name -> {"analysis_engine": module name}
+
+        :raises RuntimeError: If a workflow's engine is missing or cannot be loaded
+        """
+        self.engines = {}
+        # workflow -> level -> the engine's subtasks at that level
+        self.subtasks = {}
+        errors = []
+        for workflow, workflow_config in sorted(workflows_config.items()):
+            try:
+                self.engines[workflow], self.subtasks[workflow] = \
+                        self._load_engine(workflow, workflow_config)
+            except ValueError as e:
+                errors.append(str(e))
+        if errors:
+            error_msg = "Misconfigured workflows: {}".format("; ".join(errors))
+            LOG.error(error_msg)
+            raise RuntimeError(error_msg)
+        LOG.debug("Loaded analysis engines for workflows {}".format(", ".join(sorted(self.engines))))
+
+    def __contains__(self, workflow):
+        return workflow in self.engines
+
+    def get_engine(self, workflow):
+        """The analysis engine module of a workflow.
+
+        :raises KeyError: If the workflow is not in the config
+        """
+        try:
+            return self.engines[workflow]
+        except KeyError:
+            raise KeyError('No analysis engine for workflow "{}" specified in '
+                           'configuration file'.format(workflow))
+
+    @staticmethod
+    def _load_engine(workflow, workflow_config):
+        try:
+            module_name = workflow_config["analysis_engine"]
+        except (KeyError, TypeError):
+            raise ValueError('workflow "{}" has no analysis_engine'.format(workflow))
+        try:
+            engine = importlib.import_module(module_name)
+        except ImportError as e:
+            raise ValueError('workflow "{}": couldn\'t import module "{}": '
+                             '{}'.format(workflow, module_name, e))
+        missing = [function for function in ENGINE_FUNCTIONS
+                   if not callable(getattr(engine, function, None))]
+        if missing:
+            raise ValueError('workflow "{}": module "{}" has no {}'.format(workflow, module_name,
+                                                                          ", ".join(missing)))
+        subtasks = {}
+        for level in ANALYSIS_LEVELS:
+            try:
+                subtasks[level] = engine.get_subtasks_for_level(level=level)
+            except NotImplementedError as e:
+                raise ValueError('workflow "{}": module "{}" has no subtasks for '
+                                 'level "{}": {}'.format(workflow, module_name, level, e))
+        return engine, subtasks
@@ -0,0 +1,179 @@
+"""Decide in which order analyses are launched, and how many.
+
+The analyses are ordered by a priority made up of the urgency of the
+project's deadline, how far the sample is from its target coverage and how
+long ago the data was sequenced, each weighted in the config. The projects
+take turns, so that one large project does not hold back all the others:
+the first analysis of every project goes before the second of any. Analyses
+beyond the number allowed in flight, overall or per project, are left for
+a later run: their seqruns are not recorded as launched in the flowcell
+manifest (see conductor.flowcell) and their samples stay NEW in Charon, so
+the next run over the flowcells or samples launches them. In the config:
+
+    analysis:
+        scheduling:
+            max_in_flight: 200
+            max_per_project: 50
+            deadline_field: deadline
+            deadline_horizon: 30
+            target_coverage: 28.4
+            priority_weights:
+                deadline: 1.0
+                coverage_gap: 1.0
+                age: 0.1
+"""
+import collections
+import datetime
+
+from ngi_pipeline.database.classes import AsyncCharonSession, CharonError
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+DEFAULT_PRIORITY_WEIGHTS = {"deadline": 1.0, "coverage_gap": 1.0, "age": 0.1}
+
+
+class LaunchScheduler(object):
+    """Orders the analyses to launch and holds back those over the limits."""
+    def __init__(self, max_in_flight=None, max_per_project=None, priority_weights=None,
+                 deadline_field="deadline", deadline_horizon=30, target_coverage=28.4,
+                 running=None, today=None):
+        """
+        :param int max_in_flight: The number of analyses allowed to run at a time (default no limit)
+        :param int max_per_project: The same, per project (default no limit)
+        :param dict priority_weights: The weight of the "deadline" (per day within
+                                      deadline_horizon), "coverage_gap" (per X of
+                                      coverage missing) and "age" (per day since
+                                      sequencing) in the priority
+        :param str deadline_field: The field of the Charon project holding its deadline (YYYY-MM-DD)
+        :param int deadline_horizon: Days before its deadline that a project starts to get ahead
+        :param float target_coverage: The coverage a sample is analyzed to
+        :param dict running: project id -> number of analyses already running
+        :param datetime.date today: The date to count from (default today)
+        """
+        self.max_in_flight = max_in_flight
+        self.max_per_project = max_per_project
+        self.priority_weights = dict(DEFAULT_PRIORITY_WEIGHTS)
+        self.priority_weights.update(priority_weights or {})
+        self.deadline_field = deadline_field
+        self.deadline_horizon = deadline_horizon
+        self.target_coverage = target_coverage
+        self.running = collections.Counter(running or {})
+        self.today = today or datetime.date.today()
+
+    @classmethod
+    def from_config(cls, config, running=None):
+        scheduling_config = config.get("analysis", {}).get("scheduling") or {}
+        return cls(max_in_flight=scheduling_config.get("max_in_flight"),
+                   max_per_project=scheduling_config.get("max_per_project"),
+                   priority_weights=scheduling_config.get("priority_weights"),
+                   deadline_field=scheduling_config.get("deadline_field", "deadline"),
+                   deadline_horizon=scheduling_config.get("deadline_horizon", 30),
+                   target_coverage=scheduling_config.get("target_coverage", 28.4),
+                   running=running)
+
+    def schedule(self, objects_to_process, charon_session=None):
+        """Order the analyses and split off those over the limits.
+
+        :param list objects_to_process: Dicts with the "project", "sample" and
+                                        (for seqruns) "libprep" and "seqrun"
+                                        objects, and optionally the Charon
+                                        "project_doc"
+        :param CharonSession charon_session: Used to fetch the sample coverages,
+                                             if they count towards the priority
+
+        :returns: The analyses to launch, in order, and those left for later
+        :rtype: tuple of lists
+        """
+        coverages = {}
+        if self.priority_weights["coverage_gap"] and charon_session:
+            coverages = self._get_sample_coverages(set(obj_dict["project"].project_id
+                                                       for obj_dict in objects_to_process),
+                                                   charon_session)
+        by_project = collections.defaultdict(list)
+        for obj_dict in objects_to_process:
+            priority = self.priority(obj_dict, coverages.get((obj_dict["project"].project_id,
+                                                              obj_dict["sample"].name)))
+            by_project[obj_dict["project"].project_id].append((priority, obj_dict))
+        # The n-th analysis of each project goes before the n+1-th of any
+        ranked = []
+        for project_analyses in by_project.values():
+            project_analyses.sort(key=lambda analysis: -analysis[0])
+            for rank, (priority, obj_dict) in enumerate(project_analyses):
+                ranked.append((rank, -priority, obj_dict))
+        ranked.sort(key=lambda analysis: analysis[:2])
+        to_launch, deferred = [], []
+        in_flight = sum(self.running.values())
+        for _, _, obj_dict in ranked:
+            project_id = obj_dict["project"].project_id
+            if (self.max_in_flight and in_flight >= self.max_in_flight) or \
+                    (self.max_per_project and self.running[project_id] >= self.max_per_project):
+                deferred.append(obj_dict)
+                continue
+            to_launch.append(obj_dict)
+            in_flight += 1
+            self.running[project_id] += 1
+        return to_launch, deferred
+
+    def priority(self, obj_dict, sample_coverage=None):
+        """The priority of an analysis; higher goes first.
+
+        :param dict obj_dict: The analysis, as passed to schedule
+        :param float sample_coverage: The sample's total autosomal coverage so far
+        """
+        priority = 0.0
+        deadline = _parse_date((obj_dict.get("project_doc") or {}).get(self.deadline_field))
+        if deadline:
+            days_left = (deadline - self.today).days
+            priority += self.priority_weights["deadline"] * \
+                        max(0, self.deadline_horizon - days_left)
+        if sample_coverage is not None:
+            priority += self.priority_weights["coverage_gap"] * \
+                        max(0.0, self.target_coverage - sample_coverage)
+        if obj_dict.get("seqrun"):
+            seqruns = [obj_dict["seqrun"]]
+        else:
+            seqruns = [seqrun for libprep in obj_dict["sample"] for seqrun in libprep]
+        run_dates = filter(None, (_parse_run_date(seqrun.name) for seqrun in seqruns))
+        if run_dates:
+            priority += self.priority_weights["age"] * (self.today - min(run_dates)).days
+        return priority
+
+    def _get_sample_coverages(self, project_ids, charon_session):
+        """(project id, sample id) -> total autosomal coverage, from the
+        sample listing of each project."""
+        coverages = {}
+        if len(project_ids) > 1:
+            with AsyncCharonSession(charon_session) as async_session:
+                pending = [(project_id, async_session.project_get_samples(project_id))
+                           for project_id in project_ids]
+            get_samples = lambda result: result.get()
+        else:
+            # Not worth a pool of threads
+            pending = [(project_id, project_id) for project_id in project_ids]
+            get_samples = charon_session.project_get_samples
+        for project_id, result in pending:
+            try:
+                for sample in get_samples(result)["samples"]:
+                    coverage = sample.get("total_autosomal_coverage")
+                    if coverage is not None:
+                        coverages[(project_id, sample["sampleid"])] = float(coverage)
+            except (CharonError, KeyError, ValueError) as e:
+                LOG.warn('Could not get the sample coverages of project "{}" from '
+                         'Charon; not counting them towards its priority: {}'.format(project_id, e))
+        return coverages
+
+
+def _parse_date(date_str):
+    try:
+        return datetime.datetime.strptime(str(date_str)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_run_date(seqrun_id):
+    # e.g. 140528_D00415_0049_BC423WACXX
+    try:
+        return datetime.datetime.strptime(seqrun_id[:6], "%y%m%d").date()
+    except ValueError:
+        return None
@@ -0,0 +1,26 @@
+import unittest
+
+from ngi_pipeline.conductor.classes import NGIProject
+
+
+class TestNGIProject(unittest.TestCase):
+
+    def test_merge(self):
+        # The same sample sequenced on two flowcells, set up separately
+        project_a = NGIProject(name="Y.Mom_14_01", dirname="Y.Mom_14_01",
+                               project_id="P1", base_path="/analysis")
+        seqrun_a = project_a.add_sample("P1_101", "P1_101").add_libprep("A", "A") \
+                            .add_seqrun("FC1", "FC1")
+        seqrun_a.add_fastq_files(["P1_101_L001_R1.fastq.gz"])
+        project_b = NGIProject(name="Y.Mom_14_01", dirname="Y.Mom_14_01",
+                               project_id="P1", base_path="/analysis")
+        sample_b = project_b.add_sample("P1_101", "P1_101")
+        sample_b.add_libprep("A", "A").add_seqrun("FC2", "FC2") \
+                .add_fastq_files(["P1_101_L002_R1.fastq.gz"])
+        project_b.add_sample("P1_102", "P1_102")
+        project_a.merge(project_b)
+        self.assertEqual(sorted(project_a.samples), ["P1_101", "P1_102"])
+        libprep = project_a.samples["P1_101"].libpreps["A"]
+        self.assertEqual(sorted(libprep.seqruns), ["FC1", "FC2"])
+        self.assertEqual(libprep.seqruns["FC1"].fastq_files, ["P1_101_L001_R1.fastq.gz"])
+        self.assertEqual(libprep.seqruns["FC2"].fastq_files, ["P1_101_L002_R1.fastq.gz"])
@@ -0,0 +1,249 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.conductor.flowcell import execute_setup_plan, mark_seqruns_launched, \
+                                            parse_casava_directory, \
+                                            process_demultiplexed_flowcells, \
+                                            setup_analysis_directory_structure
+from ngi_pipeline.conductor import test_launchers
+from ngi_pipeline.conductor.plan import SetupPlan
+from ngi_pipeline.tests.generate_test_data import create_demultiplexed_flowcell
+
+
+class TestParseCasavaDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_casava_directory(self):
+        fc_dir = create_demultiplexed_flowcell(project_name="Y.Mom_14_01",
+                                               sample_names=["P1_102", "P1_101"],
+                                               lanes=[1, 2], tmp_dir=self.tmp_dir)
+        os.makedirs(os.path.join(fc_dir, "Unaligned", "Undetermined_indices", "Sample_lane1"))
+        fc_dir_structure = parse_casava_directory(fc_dir)
+        self.assertEqual(fc_dir_structure['fc_full_id'], os.path.basename(fc_dir))
+        self.assertEqual(fc_dir_structure['samplesheet_path'],
+                         os.path.join(fc_dir, "SampleSheet.csv"))
+        project, = fc_dir_structure['projects']
+        self.assertEqual(project['project_name'], "Y.Mom_14_01")
+        self.assertEqual(project['data_dir'], "Unaligned")
+        self.assertEqual([s['sample_name'] for s in project['samples']], ["P1_101", "P1_102"])
+        sample = project['samples'][0]
+        self.assertEqual(len(sample['files']), 4)
+        self.assertEqual(sorted(sample['file_stats']), sorted(sample['files']))
+        self.assertEqual(sample['file_stats'][sample['files'][0]]['size'], 0)
+
+    def test_missing_directory(self):
+        with self.assertRaises(RuntimeError):
+            parse_casava_directory(os.path.join(self.tmp_dir, "missing"))
+
+
+class TestSetupAnalysisDirectoryStructure(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"analysis": {"top_dir": os.path.join(self.tmp_dir, "analysis")}}
+        os.makedirs(self.config["analysis"]["top_dir"])
+        self.fc_dir = create_demultiplexed_flowcell(project_name="Y.Mom_14_01",
+                                                    sample_names=["P1_101"], lanes=[1],
+                                                    tmp_dir=self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name", return_value="P1")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_incremental(self, mock_libprep, mock_project_id):
+        mock_libprep.return_value = {os.path.basename(self.fc_dir): "A"}
+        def setup():
+            return setup_analysis_directory_structure(self.fc_dir, {}, ign_only=False,
+                                                      config=self.config)
+        projects = setup()
+        seqrun = projects.values()[0].samples["P1_101"].libpreps["A"] \
+                                     .seqruns[os.path.basename(self.fc_dir)]
+        self.assertEqual(len(seqrun.fastq_files), 2)
+        # Once per sample, not once per file
+        self.assertEqual(mock_libprep.call_count, 1)
+        # Not launched yet: handed over again, but not staged or looked up again
+        plan = SetupPlan()
+        plan.add_projects(setup_analysis_directory_structure(self.fc_dir, {}, ign_only=False,
+                                                             plan=plan, config=self.config))
+        self.assertEqual(len(plan.jobs), 1)
+        self.assertEqual(plan.links, [])
+        self.assertEqual(mock_libprep.call_count, 1)
+        mark_seqruns_launched(plan.manifests, set([("P1", "P1_101", "A",
+                                                    os.path.basename(self.fc_dir))]))
+        # Launched and nothing has changed; nothing to do
+        self.assertEqual(setup(), {})
+        self.assertEqual(mock_libprep.call_count, 1)
+        # A new lane arrives: only its files are set up, but the seqrun has all four
+        sample_dir = os.path.join(self.fc_dir, "Unaligned", "Project_Y__Mom_14_01", "Sample_P1_101")
+        for read_num in (1, 2):
+            open(os.path.join(sample_dir, "P1_101_AAAAAA_L002_R{}_001.fastq.gz".format(read_num)),
+                 'w').close()
+        projects = setup()
+        seqrun = projects.values()[0].samples["P1_101"].libpreps["A"] \
+                                     .seqruns[os.path.basename(self.fc_dir)]
+        self.assertEqual(len(seqrun.fastq_files), 4)
+        self.assertEqual(mock_libprep.call_count, 2)
+        seqrun_dir = os.path.join(self.config["analysis"]["top_dir"], "DATA", "Y.Mom_14_01",
+                                  "P1_101", "A", os.path.basename(self.fc_dir))
+        self.assertEqual(len(os.listdir(seqrun_dir)), 4)
+
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name", return_value="P1")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_plan(self, mock_libprep, mock_project_id):
+        mock_libprep.return_value = {os.path.basename(self.fc_dir): "A"}
+        plan = SetupPlan(staging_strategy="copy")
+        plan.add_projects(setup_analysis_directory_structure(self.fc_dir, {}, ign_only=False,
+                                                             plan=plan, config=self.config))
+        # Nothing is changed until the plan is carried out
+        self.assertEqual(os.listdir(self.config["analysis"]["top_dir"]), [])
+        self.assertEqual(len(plan.links), 2)
+        self.assertEqual(len(plan.jobs), 1)
+        plan_path = os.path.join(self.tmp_dir, "plan.json")
+        plan.save(plan_path)
+        staging_report = execute_setup_plan(SetupPlan.load(plan_path), launch=False,
+                                            config=self.config)
+        self.assertEqual(len(staging_report.staged), 2)
+        for src, dst, _, copied in plan.links:
+            self.assertTrue(copied)
+            self.assertTrue(os.path.isfile(dst) and not os.path.islink(dst))
+        # The files are in the manifest, so they are not staged again
+        plan = SetupPlan(staging_strategy="copy")
+        setup_analysis_directory_structure(self.fc_dir, {}, ign_only=False,
+                                           plan=plan, config=self.config)
+        self.assertEqual(plan.links, [])
+
+    @mock.patch("ngi_pipeline.conductor.flowcell.launch_analysis_for_seqruns")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name", return_value="P1")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_launch_retried(self, mock_libprep, mock_project_id, mock_launch):
+        mock_libprep.return_value = {os.path.basename(self.fc_dir): "A"}
+        def run():
+            plan = SetupPlan()
+            plan.add_projects(setup_analysis_directory_structure(self.fc_dir, {}, ign_only=False,
+                                                                 plan=plan, config=self.config))
+            if plan.projects:
+                execute_setup_plan(plan, config=self.config)
+            return plan
+        # The launch fails or skips the seqrun
+        mock_launch.return_value = []
+        self.assertEqual(len(run().links), 2)
+        # It is launched again, without staging the files again
+        def launch(projects, restart_failed_jobs, config):
+            project, = projects
+            sample = project.samples["P1_101"]
+            libprep = sample.libpreps["A"]
+            return [{"project": project, "sample": sample, "libprep": libprep,
+                     "seqrun": libprep.seqruns[os.path.basename(self.fc_dir)]}]
+        mock_launch.side_effect = launch
+        plan = run()
+        self.assertEqual(plan.links, [])
+        self.assertEqual(len(plan.jobs), 1)
+        # Launched; nothing left to do
+        self.assertEqual(run().projects, {})
+        self.assertEqual(mock_launch.call_count, 2)
+
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_project_id_from_name")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_projects_from_names")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_ign_only(self, mock_libprep, mock_projects, mock_project_id):
+        mock_libprep.return_value = {os.path.basename(self.fc_dir): "A"}
+        mock_projects.return_value = {"Y.Mom_14_01": {"projectid": "P1",
+                                                      "best_practice_analysis": "IGN"}}
+        projects = setup_analysis_directory_structure(self.fc_dir, {}, create_files=False,
+                                                      config=self.config)
+        self.assertEqual([p.project_id for p in projects.values()], ["P1"])
+        # One fetch for the flowcell gives both the analysis and the project id
+        mock_projects.assert_called_once_with(["Y.Mom_14_01"])
+        self.assertFalse(mock_project_id.called)
+        mock_projects.return_value = {"Y.Mom_14_01": {"projectid": "P1",
+                                                      "best_practice_analysis": "WGS"}}
+        self.assertEqual(setup_analysis_directory_structure(self.fc_dir, {}, create_files=False,
+                                                            config=self.config), {})
+
+
+class TestProcessDemultiplexedFlowcells(unittest.TestCase):
+
+    def setUp(self):
+        del test_launchers.launched[:]
+        test_launchers.failing.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = {"analysis": {"top_dir": os.path.join(self.tmp_dir, "analysis"),
+                                    "workflows": {"NGI": {
+                                        "analysis_engine": "ngi_pipeline.conductor.test_launchers"}},
+                                    "scheduling": {"max_in_flight": 1}}}
+        os.makedirs(self.config["analysis"]["top_dir"])
+        self.fc_dirs = [create_demultiplexed_flowcell(project_name="Y.Mom_14_01",
+                                                      sample_names=["P1_101"], lanes=[1],
+                                                      run_id=run_id, tmp_dir=self.tmp_dir)
+                        for run_id in ("140528_D00415_0049_BC423WACXX",
+                                       "140702_D00415_0052_AC41A2ANXX")]
+        self.charon_session = mock.Mock(async_max_workers=4)
+        self.charon_session.projects_get.return_value = {"P1": {"pipeline": "NGI"}}
+        self.charon_session.libprep_get_seqruns.return_value = {"seqruns": [
+                {"seqrunid": os.path.basename(fc_dir), "alignment_status": "NEW"}
+                for fc_dir in self.fc_dirs]}
+        self.charon_session.project_get_samples.return_value = {"samples": []}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock.patch("ngi_pipeline.conductor.launchers.count_running_analyses_local",
+                return_value={})
+    @mock.patch("ngi_pipeline.conductor.launchers.update_charon_with_local_jobs_status")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_projects_from_names",
+                return_value={"Y.Mom_14_01": {"projectid": "P1",
+                                              "best_practice_analysis": "IGN"}})
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_deferred_launched_later(self, mock_libprep, mock_projects, mock_update,
+                                     mock_count):
+        mock_libprep.return_value = dict((os.path.basename(fc_dir), "A")
+                                         for fc_dir in self.fc_dirs)
+        def run():
+            with mock.patch("ngi_pipeline.conductor.launchers.get_charon_session",
+                            return_value=self.charon_session):
+                process_demultiplexed_flowcells(self.fc_dirs, config=self.config)
+        # One at a time: the older run goes first, the other is left for later
+        run()
+        self.assertEqual(test_launchers.launched, ["140528_D00415_0049_BC423WACXX"])
+        # The next run launches it, and only it
+        run()
+        self.assertEqual(test_launchers.launched, ["140528_D00415_0049_BC423WACXX",
+                                                   "140702_D00415_0052_AC41A2ANXX"])
+        # Both launched; nothing left to do
+        with self.assertRaises(SystemExit):
+            run()
+
+    @mock.patch("ngi_pipeline.conductor.launchers.count_running_analyses_local",
+                return_value={})
+    @mock.patch("ngi_pipeline.conductor.launchers.update_charon_with_local_jobs_status")
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_projects_from_names",
+                return_value={"Y.Mom_14_01": {"projectid": "P1",
+                                              "best_practice_analysis": "IGN"}})
+    @mock.patch("ngi_pipeline.conductor.flowcell.get_fcid_libprep_index")
+    def test_failed_launch_retried(self, mock_libprep, mock_projects, mock_update,
+                                   mock_count):
+        del self.config["analysis"]["scheduling"]
+        mock_libprep.return_value = dict((os.path.basename(fc_dir), "A")
+                                         for fc_dir in self.fc_dirs)
+        def run():
+            with mock.patch("ngi_pipeline.conductor.launchers.get_charon_session",
+                            return_value=self.charon_session):
+                process_demultiplexed_flowcells(self.fc_dirs, config=self.config)
+        # The engine fails to launch one of them
+        test_launchers.failing.add("140528_D00415_0049_BC423WACXX")
+        run()
+        self.assertEqual(test_launchers.launched, ["140702_D00415_0052_AC41A2ANXX"])
+        # The next run tries it again, and only it
+        test_launchers.failing.clear()
+        run()
+        self.assertEqual(test_launchers.launched, ["140702_D00415_0052_AC41A2ANXX",
+                                                   "140528_D00415_0049_BC423WACXX"])
@@ -0,0 +1,114 @@
+import mock
+import threading
+import time
+import unittest
+
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.conductor.launchers import batch_seqruns_by_flowcell, launch_analysis
+
+# This module doubles as the analysis engine of the tests
+launched = []
+launched_lock = threading.Lock()
+# The seqruns whose launch fails
+failing = set()
+
+def analyze_seqrun(project, sample, libprep, seqrun):
+    time.sleep(0.05)
+    if seqrun.name in failing:
+        return []
+    if seqrun.name == "broken":
+        raise ValueError("Unexpected error")
+    with launched_lock:
+        launched.append(seqrun.name)
+    return [(project, sample, libprep, seqrun)]
+
+def analyze_sample(project, sample):
+    pass
+
+def get_subtasks_for_level(level):
+    return ["test"]
+
+
+class TestLaunchAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        del launched[:]
+        failing.clear()
+        self.config = {"analysis": {"workflows": {"NGI": {
+                            "analysis_engine": "ngi_pipeline.conductor.test_launchers"}}}}
+        self.project = NGIProject(name="Y.Mom_14_01", dirname="Y.Mom_14_01",
+                                  project_id="P1", base_path="/tmp")
+        libprep = self.project.add_sample("P1_101", "P1_101").add_libprep("A", "A")
+        for run_num in range(8):
+            libprep.add_seqrun("run{}".format(run_num), "run{}".format(run_num))
+        self.charon_session = mock.Mock(async_max_workers=4)
+        self.charon_session.projects_get.return_value = {"P1": {"pipeline": "NGI"}}
+        # run7 is missing from Charon
+        statuses = {"run0": "DONE", "run1": "RUNNING", "run2": "FAILED"}
+        self.charon_session.libprep_get_seqruns.return_value = {"seqruns": [
+                {"seqrunid": "run{}".format(run_num),
+                 "alignment_status": statuses.get("run{}".format(run_num), "NEW")}
+                for run_num in range(7)]}
+        self.charon_session.project_get_samples.return_value = {"samples": []}
+
+    @mock.patch("ngi_pipeline.conductor.launchers.count_running_analyses_local",
+                return_value={})
+    @mock.patch("ngi_pipeline.conductor.launchers.update_charon_with_local_jobs_status")
+    def test_launch_concurrently(self, mock_update, mock_count):
+        with mock.patch("ngi_pipeline.conductor.launchers.get_charon_session",
+                        return_value=self.charon_session):
+            start = time.time()
+            launch_analysis("seqrun", [self.project], max_workers=8, config=self.config)
+            elapsed = time.time() - start
+        # Done, running and failed seqruns are left alone
+        self.assertEqual(sorted(launched), ["run3", "run4", "run5", "run6", "run7"])
+        self.assertLess(elapsed, 5 * 0.05)
+        # One listing for the libprep instead of a request per seqrun
+        self.charon_session.libprep_get_seqruns.assert_called_once_with("P1", "P1_101", "A")
+        self.assertFalse(self.charon_session.seqrun_get.called)
+        self.charon_session.seqrun_update.assert_called_once_with("P1", "P1_101", "A", "run7",
+                                                                  alignment_status="NEW")
+
+    @mock.patch("ngi_pipeline.conductor.launchers.count_running_analyses_local",
+                return_value={})
+    @mock.patch("ngi_pipeline.conductor.launchers.update_charon_with_local_jobs_status")
+    def test_launch_error_isolated(self, mock_update, mock_count):
+        self.project.samples["P1_101"].libpreps["A"].add_seqrun("broken", "broken")
+        with mock.patch("ngi_pipeline.conductor.launchers.get_charon_session",
+                        return_value=self.charon_session):
+            settled = launch_analysis("seqrun", [self.project], max_workers=8,
+                                      config=self.config)
+        # The error is logged and the other seqruns are launched all the same
+        self.assertEqual(sorted(launched), ["run3", "run4", "run5", "run6", "run7"])
+        self.assertEqual(sorted(obj_dict["seqrun"].name for obj_dict in settled),
+                         ["run0", "run1", "run3", "run4", "run5", "run6", "run7"])
+
+    @mock.patch("ngi_pipeline.conductor.launchers.count_running_analyses_local",
+                return_value={"P1": 2})
+    @mock.patch("ngi_pipeline.conductor.launchers.update_charon_with_local_jobs_status")
+    def test_launch_within_limits(self, mock_update, mock_count):
+        self.config["analysis"]["scheduling"] = {"max_per_project": 4}
+        with mock.patch("ngi_pipeline.conductor.launchers.get_charon_session",
+                        return_value=self.charon_session):
+            launch_analysis("seqrun", [self.project], config=self.config)
+        # Two running already; the other three are left for later
+        self.assertEqual(len(launched), 2)
+
+
+class TestBatchSeqrunsByFlowcell(unittest.TestCase):
+
+    def test_batch(self):
+        batch_engine = mock.Mock(spec=["analyze_seqrun", "analyze_seqruns"])
+        single_engine = mock.Mock(spec=["analyze_seqrun"])
+        project = NGIProject(name="Y.Mom_14_01", dirname="Y.Mom_14_01",
+                             project_id="P1", base_path="/tmp")
+        libprep = project.add_sample("P1_101", "P1_101").add_libprep("A", "A")
+        objects_to_process = [{"project": project, "sample": project.samples["P1_101"],
+                               "libprep": libprep, "seqrun": libprep.add_seqrun(run, run),
+                               "workflow": "NGI", "analysis_module": engine}
+                              for run, engine in (("fc1", batch_engine), ("fc2", batch_engine),
+                                                  ("fc1", single_engine), ("fc1", batch_engine))]
+        batched = batch_seqruns_by_flowcell(objects_to_process)
+        self.assertEqual([obj_dict.get("batch") for obj_dict in batched],
+                         [[objects_to_process[0], objects_to_process[3]],
+                          [objects_to_process[1]], None])
@@ -0,0 +1,36 @@
+import unittest
+
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.conductor.plan import SetupPlan
+
+
+class TestSetupPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = SetupPlan(staging_strategy="hardlink")
+        project = NGIProject(name="Ab-1234", dirname="Ab-1234", project_id="Ab-1234",
+                             base_path="/analysis")
+        seqrun = project.add_sample("Ab-1234_101", "Ab-1234_101").add_libprep("A", "A") \
+                        .add_seqrun("140528_D00415_0049_BC423WACXX",
+                                    "140528_D00415_0049_BC423WACXX")
+        seqrun.add_fastq_files(["Ab-1234_101_L001_R1.fastq.gz", "Ab-1234_101_L001_R2.fastq.gz"])
+        self.plan.add_projects({"/analysis/DATA/Ab-1234": project})
+        self.plan.charon_projects.add("Ab-1234")
+        self.plan.add_link("/fc/R1.fastq.gz", "/analysis/R1.fastq.gz", 1000, copied=True)
+        self.plan.add_link("/fc/R2.fastq.gz", "/analysis/R2.fastq.gz", 1000, copied=False)
+
+    def test_estimate(self):
+        estimate = self.plan.estimate()
+        self.assertEqual(estimate["bytes"], 2000)
+        self.assertEqual(estimate["bytes_moved"], 1000)
+        self.assertEqual(len(self.plan.charon_records), 4)
+        # 4 records, 1 project and 1 job
+        self.assertEqual(estimate["charon_calls"], 4 + 1 + 2)
+
+    def test_to_dict(self):
+        plan = SetupPlan.from_dict(self.plan.to_dict())
+        self.assertEqual(plan.to_dict(), self.plan.to_dict())
+        project = plan.projects["/analysis/DATA/Ab-1234"]
+        self.assertEqual(project.project_id, "Ab-1234")
+        self.assertEqual(len(project.samples["Ab-1234_101"].libpreps["A"]
+                             .seqruns["140528_D00415_0049_BC423WACXX"].fastq_files), 2)
@@ -0,0 +1,36 @@
+import unittest
+
+from ngi_pipeline.conductor.registry import get_workflow_registry, WorkflowRegistry
+
+# This module doubles as the analysis engine of the tests
+def analyze_seqrun(project, sample, libprep, seqrun):
+    pass
+
+def analyze_sample(project, sample):
+    pass
+
+def get_subtasks_for_level(level):
+    return {"seqrun": ["align"], "sample": ["variantcall"]}[level]
+
+
+class TestWorkflowRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {"analysis": {"workflows": {"NGI": {
+                            "analysis_engine": "ngi_pipeline.conductor.test_registry"}}}}
+
+    def test_get_engine(self):
+        workflow_registry = get_workflow_registry(self.config)
+        self.assertEqual(workflow_registry.get_engine("NGI").__name__,
+                         "ngi_pipeline.conductor.test_registry")
+        self.assertEqual(workflow_registry.subtasks["NGI"]["sample"], ["variantcall"])
+        self.assertRaises(KeyError, workflow_registry.get_engine, "RNA")
+        # Built once
+        self.assertIs(get_workflow_registry(dict(self.config)), workflow_registry)
+
+    def test_misconfigured(self):
+        for workflows_config in ({"NGI": {}},
+                                 {"NGI": {"analysis_engine": "ngi_pipeline.no_such_engine"}},
+                                 # Has no analyze_* functions
+                                 {"NGI": {"analysis_engine": "ngi_pipeline.conductor.registry"}}):
+            self.assertRaises(RuntimeError, WorkflowRegistry, workflows_config)
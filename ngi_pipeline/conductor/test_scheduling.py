@@ -0,0 +1,56 @@
+import datetime
+import mock
+import unittest
+
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.conductor.scheduling import LaunchScheduler
+
+
+class TestLaunchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.today = datetime.date(2015, 3, 1)
+        self.objects_to_process = []
+        for project_id, n_samples, deadline in (("P1", 4, None), ("P2", 2, "2015-03-10")):
+            project = NGIProject(name=project_id, dirname=project_id,
+                                 project_id=project_id, base_path="/tmp")
+            for sample_num in range(n_samples):
+                sample_name = "{}_10{}".format(project_id, sample_num)
+                libprep = project.add_sample(sample_name, sample_name).add_libprep("A", "A")
+                # Sequenced sample_num days ago
+                run_date = self.today - datetime.timedelta(days=sample_num)
+                seqrun = libprep.add_seqrun(run_date.strftime("%y%m%d_D00415_0049_BC423WACXX"),
+                                            "run")
+                self.objects_to_process.append({"project": project,
+                                                "sample": project.samples[sample_name],
+                                                "libprep": libprep, "seqrun": seqrun,
+                                                "project_doc": {"deadline": deadline}})
+
+    def _order(self, objects_to_process):
+        return [obj_dict["sample"].name for obj_dict in objects_to_process]
+
+    def test_priority_and_fair_share(self):
+        scheduler = LaunchScheduler(priority_weights={"age": 1.0}, today=self.today)
+        to_launch, deferred = scheduler.schedule(self.objects_to_process)
+        # P2's deadline puts it first; the projects then take turns, oldest data first
+        self.assertEqual(self._order(to_launch),
+                         ["P2_101", "P1_103", "P2_100", "P1_102", "P1_101", "P1_100"])
+        self.assertEqual(deferred, [])
+
+    def test_limits(self):
+        scheduler = LaunchScheduler(max_in_flight=5, max_per_project=2,
+                                    running={"P1": 1}, today=self.today)
+        to_launch, deferred = scheduler.schedule(self.objects_to_process)
+        self.assertEqual(sorted(self._order(to_launch)), ["P1_103", "P2_100", "P2_101"])
+        self.assertEqual(len(deferred), 3)
+
+    def test_coverage_gap(self):
+        charon_session = mock.Mock(async_max_workers=2)
+        charon_session.project_get_samples.side_effect = lambda project_id: {"samples": [
+                {"sampleid": "P1_100", "total_autosomal_coverage": 0},
+                {"sampleid": "P1_103", "total_autosomal_coverage": 30}]} \
+                if project_id == "P1" else {"samples": []}
+        scheduler = LaunchScheduler(priority_weights={"deadline": 0, "age": 1.0},
+                                    today=self.today)
+        to_launch, _ = scheduler.schedule(self.objects_to_process, charon_session)
+        self.assertEqual(self._order(to_launch)[0], "P1_100")
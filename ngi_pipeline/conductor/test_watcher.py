@@ -0,0 +1,91 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from ngi_pipeline.conductor.watcher import FlowcellWatcher
+from ngi_pipeline.tests.generate_test_data import create_demultiplexed_flowcell
+
+
+class TestFlowcellWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.inbox_dir = tempfile.mkdtemp()
+        self.processed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.inbox_dir)
+
+    def make_watcher(self, **kwargs):
+        return FlowcellWatcher(self.inbox_dir, self.processed.append,
+                               completion_markers=("Unaligned*/Demultiplex_Stats.htm",),
+                               use_inotify=False, **kwargs)
+
+    def new_flowcell(self, complete=True):
+        fc_dir = create_demultiplexed_flowcell(n_samples=2, tmp_dir=self.inbox_dir)
+        if complete:
+            open(os.path.join(fc_dir, "Unaligned", "Demultiplex_Stats.htm"), 'w').close()
+        return fc_dir
+
+    def test_existing_flowcells_ignored(self):
+        self.new_flowcell()
+        watcher = self.make_watcher(settle_time=0)
+        self.assertEqual(watcher.poll(), [])
+        watcher = self.make_watcher(settle_time=0, process_existing=True)
+        self.assertEqual(len(watcher.poll()), 1)
+
+    def test_processed_once_complete_and_settled(self):
+        watcher = self.make_watcher(settle_time=30)
+        fc_dir = self.new_flowcell(complete=False)
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1000):
+            self.assertEqual(watcher.poll(), [])
+        # Not processed until demultiplexing is done
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1100):
+            self.assertEqual(watcher.poll(), [])
+        open(os.path.join(fc_dir, "Unaligned", "Demultiplex_Stats.htm"), 'w').close()
+        # ... and nothing has changed for settle_time seconds
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1200):
+            self.assertEqual(watcher.poll(), [])
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1220):
+            self.assertEqual(watcher.poll(), [])
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1230):
+            self.assertEqual(watcher.poll(), [fc_dir])
+        self.assertEqual(self.processed, [fc_dir])
+        self.assertEqual(watcher.poll(), [])
+
+    def test_retried_after_failure(self):
+        attempts = []
+        def process_flowcell(fc_dir):
+            attempts.append(fc_dir)
+            if len(attempts) == 1:
+                raise IOError("Stale NFS file handle")
+            self.processed.append(fc_dir)
+        watcher = FlowcellWatcher(self.inbox_dir, process_flowcell,
+                                  completion_markers=("Unaligned*/Demultiplex_Stats.htm",),
+                                  settle_time=0, retry_delay=60, use_inotify=False)
+        fc_dir = self.new_flowcell()
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1000):
+            self.assertEqual(watcher.poll(), [])
+        self.assertEqual(attempts, [fc_dir])
+        # Not before retry_delay has passed
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1030):
+            self.assertEqual(watcher.poll(), [])
+        self.assertEqual(len(attempts), 1)
+        with mock.patch("ngi_pipeline.conductor.watcher.time.time", return_value=1060):
+            self.assertEqual(watcher.poll(), [fc_dir])
+        self.assertEqual(self.processed, [fc_dir])
+        self.assertEqual(watcher.poll(), [])
+
+    def test_given_up(self):
+        def process_flowcell(fc_dir):
+            raise SystemExit("Quitting: No projects found")
+        watcher = FlowcellWatcher(self.inbox_dir, process_flowcell,
+                                  completion_markers=("Unaligned*/Demultiplex_Stats.htm",),
+                                  settle_time=0, retry_delay=0, max_retries=2,
+                                  use_inotify=False)
+        self.new_flowcell()
+        for _ in range(3):
+            self.assertEqual(watcher.poll(), [])
+        self.assertEqual(len(watcher.pending), 0)
+        self.assertEqual(len(watcher.processed), 1)
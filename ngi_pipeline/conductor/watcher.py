@@ -0,0 +1,208 @@
+"""Watch the INBOX for demultiplexed flowcells and process them as they arrive.
+
+A flowcell is handed on once demultiplexing has finished (one of the
+completion markers exists in its directory) and nothing in it has changed for
+settle_time seconds, so that files still being written or copied are not
+picked up half-way. Changes are noticed with inotify if pyinotify is
+installed, and by comparing directory listings every poll_interval
+seconds otherwise. A flowcell that fails to process (e.g. while Charon is
+down) is tried again retry_delay seconds later, up to max_retries times.
+"""
+import glob
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from ngi_pipeline.conductor.flowcell import process_demultiplexed_flowcell
+from ngi_pipeline.log.loggers import minimal_logger
+from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.filesystem import scan_directory
+
+LOG = minimal_logger(__name__)
+
+# Written by CASAVA (configureBclToFastq.pl) when demultiplexing is done
+DEFAULT_COMPLETION_MARKERS = ("Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm",)
+# e.g. 140528_D00415_0049_BC423WACXX
+FLOWCELL_DIR_PATTERN = "[0-9]" * 6 + "_*"
+
+
+@with_ngi_config
+def watch_flowcells(inbox_dir=None, use_inotify=None, process_existing=False,
+                    config=None, config_file_path=None):
+    """Process each demultiplexed flowcell as it arrives in the inbox; runs
+    until interrupted.
+
+    :param str inbox_dir: The directory to watch (default project.INBOX in the config)
+    :param bool use_inotify: Use inotify (default if pyinotify is installed)
+    :param bool process_existing: Also process the finished flowcells already in the inbox
+    :param dict config: The parsed NGI configuration file; optional.
+    :param str config_file_path: The path to the NGI configuration file; optional.
+    """
+    if not inbox_dir:
+        try:
+            inbox_dir = config["project"]["INBOX"]
+        except KeyError:
+            raise ValueError("No inbox directory given and none (project.INBOX) "
+                             "in the configuration file")
+    watcher_config = config.get("watcher") or {}
+    def process_flowcell(fc_dir):
+        process_demultiplexed_flowcell(fc_dir, config_file_path=config_file_path)
+    FlowcellWatcher(inbox_dir, process_flowcell,
+                    completion_markers=watcher_config.get("completion_markers",
+                                                          DEFAULT_COMPLETION_MARKERS),
+                    settle_time=watcher_config.get("settle_time", 30),
+                    poll_interval=watcher_config.get("poll_interval", 60),
+                    retry_delay=watcher_config.get("retry_delay", 600),
+                    max_retries=watcher_config.get("max_retries", 3),
+                    use_inotify=use_inotify,
+                    process_existing=process_existing).run()
+
+
+class FlowcellWatcher(object):
+    """Calls process_flowcell(fc_dir) once for each flowcell that arrives
+    in inbox_dir and has finished demultiplexing."""
+    def __init__(self, inbox_dir, process_flowcell,
+                 completion_markers=DEFAULT_COMPLETION_MARKERS,
+                 settle_time=30, poll_interval=60, retry_delay=600, max_retries=3,
+                 use_inotify=None, process_existing=False):
+        """
+        :param str inbox_dir: The directory the flowcells are delivered to
+        :param function process_flowcell: Called with the path to each finished flowcell
+        :param tuple completion_markers: glob patterns, relative to the flowcell directory,
+                                         of the files that mark it as finished
+        :param int settle_time: Seconds the flowcell must go unchanged before it is processed
+        :param int poll_interval: Seconds between scans of the inbox
+        :param int retry_delay: Seconds before a flowcell that failed to process is tried again
+        :param int max_retries: The number of times a flowcell is tried again before giving up
+        :param bool use_inotify: Use inotify (default if pyinotify is installed)
+        :param bool process_existing: Also process the finished flowcells
+                                      already in the inbox at start (default False)
+        """
+        self.inbox_dir = os.path.abspath(inbox_dir)
+        self.process_flowcell = process_flowcell
+        self.completion_markers = completion_markers
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        if use_inotify is None:
+            use_inotify = pyinotify is not None
+        elif use_inotify and pyinotify is None:
+            raise ValueError("inotify watching needs the pyinotify module")
+        # fc_dir -> {"last_change": time, "signature": listing or None,
+        #            and after a failure "retries": count, "retry_at": time}
+        self.pending = {}
+        self.processed = set()
+        self._watch_manager = self._notifier = None
+        if use_inotify:
+            self._watch_manager = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(self._watch_manager,
+                                                default_proc_fun=self._handle_event)
+            self._watch_manager.add_watch(self.inbox_dir,
+                                          pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+        if not process_existing:
+            for fc_dir in self._list_flowcells():
+                if self._is_complete(fc_dir):
+                    self.processed.add(fc_dir)
+            LOG.info("Ignoring the {} finished flowcells already in "
+                     "\"{}\"".format(len(self.processed), self.inbox_dir))
+
+    def run(self):
+        """Watch the inbox until interrupted."""
+        LOG.info("Watching \"{}\" for flowcells ({})".format(self.inbox_dir,
+                 "inotify" if self._notifier else
+                 "polling every {} seconds".format(self.poll_interval)))
+        while True:
+            self.wait()
+            self.poll()
+
+    def wait(self):
+        """Sleep until the next poll is due, or until something changes."""
+        # Wake up in time for the pending flowcells to be handed on promptly
+        timeout = min(self.poll_interval, self.settle_time) if self.pending \
+                  else self.poll_interval
+        if self._notifier:
+            if self._notifier.check_events(timeout=max(timeout, 1) * 1000):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        else:
+            time.sleep(timeout)
+
+    def poll(self):
+        """Look for new flowcells and process those that are ready.
+
+        :returns: The flowcells processed
+        :rtype: list
+        """
+        now = time.time()
+        for fc_dir in self._list_flowcells():
+            if fc_dir not in self.processed and fc_dir not in self.pending:
+                LOG.info("New flowcell \"{}\"".format(fc_dir))
+                self.pending[fc_dir] = {"last_change": now, "signature": None}
+                if self._watch_manager:
+                    self._watch_manager.add_watch(fc_dir, pyinotify.ALL_EVENTS,
+                                                  rec=True, auto_add=True)
+        ready = []
+        for fc_dir, state in self.pending.items():
+            if not self._watch_manager:
+                signature = self._signature(fc_dir)
+                if signature != state["signature"]:
+                    state["signature"], state["last_change"] = signature, now
+            if now - state["last_change"] >= self.settle_time and \
+                    now >= state.get("retry_at", 0) and self._is_complete(fc_dir):
+                ready.append(fc_dir)
+        processed = []
+        for fc_dir in sorted(ready):
+            LOG.info("Flowcell \"{}\" has finished demultiplexing; "
+                     "processing".format(fc_dir))
+            try:
+                self.process_flowcell(fc_dir)
+            # process_demultiplexed_flowcells exits if there is nothing to
+            # process, which may also be because Charon could not be reached
+            except (Exception, SystemExit) as e:
+                state = self.pending[fc_dir]
+                state["retries"] = state.get("retries", 0) + 1
+                if state["retries"] <= self.max_retries:
+                    LOG.error("Error when processing flowcell \"{}\"; trying again in {} "
+                              "seconds: {}".format(fc_dir, self.retry_delay, e))
+                    state["retry_at"] = now + self.retry_delay
+                    continue
+                LOG.error("Error when processing flowcell \"{}\"; giving up after {} "
+                          "attempts: {}".format(fc_dir, state["retries"], e))
+            else:
+                processed.append(fc_dir)
+            self._stop_watching(fc_dir)
+        return processed
+
+    def _handle_event(self, event):
+        for fc_dir, state in self.pending.items():
+            if event.pathname.startswith(fc_dir + os.sep):
+                state["last_change"] = time.time()
+
+    def _stop_watching(self, fc_dir):
+        del self.pending[fc_dir]
+        self.processed.add(fc_dir)
+        if self._watch_manager:
+            watch_descriptor = self._watch_manager.get_wd(fc_dir)
+            if watch_descriptor is not None:
+                self._watch_manager.rm_watch(watch_descriptor, rec=True, quiet=True)
+
+    def _list_flowcells(self):
+        return [entry.path for entry in scan_directory(self.inbox_dir, FLOWCELL_DIR_PATTERN)
+                if entry.is_dir]
+
+    def _is_complete(self, fc_dir):
+        return any(glob.glob(os.path.join(fc_dir, marker))
+                   for marker in self.completion_markers)
+
+    def _signature(self, fc_dir):
+        """The names, sizes and mtimes of everything in the flowcell."""
+        signature = []
+        for dirpath, dirnames, filenames in os.walk(fc_dir):
+            for entry in scan_directory(dirpath, stat_files=True):
+                signature.append((entry.path, entry.size, entry.mtime))
+        return signature
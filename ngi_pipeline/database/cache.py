@@ -0,0 +1,199 @@
+"""Read-through caches for Charon GET responses.
+
+Entries are keyed by the request URL and expire after a fixed time-to-live;
+CharonSession drops the relevant entries itself whenever it writes to Charon.
+"""
+import collections
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+
+class CharonCache(object):
+    """Base class for the cache backends; keeps the hit/miss counters."""
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or stale."""
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value, time.time() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidate(key)
+
+    def invalidate_prefix(self, prefix):
+        """Drop every entry whose key starts with prefix."""
+        with self._lock:
+            self._invalidate_prefix(prefix)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        """Return the hit/miss counters (e.g. for monitoring).
+
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"backend": type(self).__name__,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_ratio": (float(self.hits) / lookups if lookups else 0.0),
+                    "entries": self._len()}
+
+
+class NullCache(CharonCache):
+    """Caches nothing; every lookup is a miss."""
+    def _get(self, key):
+        return None
+
+    def _set(self, key, value, expires):
+        pass
+
+    def _invalidate(self, key):
+        pass
+
+    def _invalidate_prefix(self, prefix):
+        pass
+
+    def _clear(self):
+        pass
+
+    def _len(self):
+        return 0
+
+
+class MemoryCache(CharonCache):
+    """In-memory LRU cache with a time-to-live for each entry."""
+    def __init__(self, ttl=60, max_entries=10000):
+        super(MemoryCache, self).__init__(ttl=ttl)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def _get(self, key):
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            return None
+        if expires < time.time():
+            return None
+        # Move to the most-recently-used end
+        self._entries[key] = (expires, value)
+        # Callers modify the dicts they get back, so never hand out our copy
+        return copy.deepcopy(value)
+
+    def _set(self, key, value, expires):
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, copy.deepcopy(value))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def _invalidate_prefix(self, prefix):
+        for key in [k for k in self._entries if k.startswith(prefix)]:
+            del self._entries[key]
+
+    def _clear(self):
+        self._entries.clear()
+
+    def _len(self):
+        return len(self._entries)
+
+
+class SqliteCache(CharonCache):
+    """On-disk cache in a sqlite database, shared between processes."""
+    def __init__(self, path, ttl=60):
+        super(SqliteCache, self).__init__(ttl=ttl)
+        self.path = os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._connection = sqlite3.connect(self.path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS charon_cache "
+                                     "(key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    def _get(self, key):
+        row = self._connection.execute("SELECT value, expires FROM charon_cache "
+                                       "WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def _set(self, key, value, expires):
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO charon_cache "
+                                     "(key, value, expires) VALUES (?, ?, ?)",
+                                     (key, json.dumps(value), expires))
+
+    def _invalidate(self, key):
+        with self._connection:
+            self._connection.execute("DELETE FROM charon_cache WHERE key = ?", (key,))
+
+    def _invalidate_prefix(self, prefix):
+        with self._connection:
+            self._connection.execute("DELETE FROM charon_cache WHERE substr(key, 1, ?) = ?",
+                                     (len(prefix), prefix))
+
+    def _clear(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM charon_cache")
+
+    def _len(self):
+        with self._connection:
+            self._connection.execute("DELETE FROM charon_cache WHERE expires < ?",
+                                     (time.time(),))
+        return self._connection.execute("SELECT COUNT(*) FROM charon_cache").fetchone()[0]
+
+
+def get_cache(backend="memory", ttl=60, max_entries=10000, path=None):
+    """Build the cache backend named in the config.
+
+    :param str backend: "memory", "sqlite" or "none"
+    :param int ttl: Seconds an entry stays valid
+    :param int max_entries: The size limit of the memory cache
+    :param str path: The database file of the sqlite cache
+
+    :returns: The cache
+    :rtype: CharonCache
+    :raises ValueError: If the backend is unknown or misconfigured
+    """
+    backend = str(backend).lower()
+    if backend in ("none", "false", "off") or not ttl:
+        return NullCache()
+    elif backend == "memory":
+        return MemoryCache(ttl=ttl, max_entries=max_entries)
+    elif backend == "sqlite":
+        if not path:
+            raise ValueError('The sqlite Charon cache needs a "cache_path" '
+                             'in the "charon" configuration section.')
+        return SqliteCache(path=path, ttl=ttl)
+    else:
+        raise ValueError('Unknown Charon cache backend "{}"; choose one '
+                         'of memory, sqlite or none.'.format(backend))
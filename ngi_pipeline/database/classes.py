@@ -1,13 +1,28 @@
 from __future__ import print_function
 
+import atexit
+import collections
 import functools
+import itertools
 import json
 import os
 import re
 import requests
-
+import threading
+import time
+import urllib
+
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from ngi_pipeline.conductor.classes import NGIProject
+from ngi_pipeline.database.cache import get_cache
+from ngi_pipeline.database.instrumentation import CHARON_STATS, record_request, write_stats
+from ngi_pipeline.database.project_index import ProjectIndex
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import memoized
+from ngi_pipeline.utils.config import load_yaml_config, locate_ngi_config
 
 # Need a better way to log
 LOG = minimal_logger(__name__)
@@ -24,30 +39,150 @@ except KeyError as e:
     raise ValueError("Could not get required environmental variable "
                      "\"{}\"; cannot connect to database.".format(e))
 
+# These can be overridden in the "charon" section of the NGI config file
+CHARON_CONFIG_DEFAULTS = {
+        # Number of per-host connection pools to cache and the number of
+        # keep-alive connections to hold open in each of them (raised to
+        # max_workers / async_max_workers if either is larger)
+        "pool_connections": 4,
+        "pool_maxsize": 16,
+        # Seconds to wait for the server before giving up on a single attempt
+        "timeout": 10,
+        # Timeouts, dropped connections and 5xx responses are retried
+        # this many times, sleeping backoff_factor * 2**attempt in between
+        "max_retries": 3,
+        "backoff_factor": 0.5,
+        # GET responses are cached for cache_ttl seconds ("memory", "sqlite"
+        # or "none"); the sqlite backend keeps its entries in cache_path
+        "cache_backend": "memory",
+        "cache_ttl": 60,
+        "cache_max_entries": 10000,
+        "cache_path": None,
+        # The ETag and body of each document fetched are kept for
+        # revision_ttl seconds, so that once the cached copy expires it is
+        # only fetched again if it has changed, and so that updates only go
+        # through if the document is unchanged since (0 turns this off)
+        "revision_ttl": 3600,
+        # Project names and ids are kept in this sqlite database, shared
+        # between runs (in memory if left empty), and the full listing is
+        # fetched again after project_index_refresh seconds
+        "project_index_path": "$HOME/.ngipipeline/project_index.sqlite",
+        "project_index_refresh": 86400,
+        # Number of concurrent requests used for bulk fetches, and by
+        # AsyncCharonSession (e.g. when polling the status of running jobs)
+        "max_workers": 8,
+        "async_max_workers": 32,
+        # Request statistics are written here at exit if set, as JSON
+        # and/or in the Prometheus text format
+        "stats_path": None,
+        "stats_prometheus_path": None,
+}
+
+_CHARON_SESSIONS = {}
+_CHARON_SESSIONS_LOCK = threading.Lock()
+# The stats files already set to be written at exit
+_STATS_PATHS_AT_EXIT = set()
+
+
+def load_charon_config(config=None):
+    """Return the Charon connection settings, i.e. the "charon" section of the
+    NGI config file laid over CHARON_CONFIG_DEFAULTS. A missing config file
+    is not an error; the defaults are used instead.
+
+    :param dict config: The parsed NGI configuration file (optional)
+
+    :returns: The Charon connection settings
+    :rtype: dict
+    """
+    if config is None:
+        try:
+            config = load_yaml_config(locate_ngi_config())
+        except (IOError, RuntimeError):
+            config = {}
+    charon_config = CHARON_CONFIG_DEFAULTS.copy()
+    charon_config.update((config or {}).get("charon") or {})
+    return charon_config
+
+
+def get_charon_session(api_token=None, base_url=None, config=None):
+    """Return the process-wide CharonSession for this API token and base URL,
+    creating it on first use. The session (and so its pool of keep-alive
+    connections) is shared between all callers and threads.
+
+    :param str api_token: The Charon API token (default $CHARON_API_TOKEN)
+    :param str base_url: The Charon base url (default $CHARON_BASE_URL)
+    :param dict config: The parsed NGI configuration file; only used when
+                        the session is first created (optional)
+
+    :returns: The shared session
+    :rtype: CharonSession
+    """
+    session_key = (api_token or CHARON_API_TOKEN, base_url or CHARON_BASE_URL)
+    with _CHARON_SESSIONS_LOCK:
+        try:
+            return _CHARON_SESSIONS[session_key]
+        except KeyError:
+            charon_session = CharonSession(api_token=session_key[0],
+                                           base_url=session_key[1],
+                                           config=config)
+            _CHARON_SESSIONS[session_key] = charon_session
+            return charon_session
+
 
-## TODO Might be better just to instantiate this when loading the module. Do we neeed a new instance every time? I don't think so
 class CharonSession(requests.Session):
-    def __init__(self, api_token=None, base_url=None):
+    def __init__(self, api_token=None, base_url=None, config=None):
         super(CharonSession, self).__init__()
 
         self._api_token = api_token or CHARON_API_TOKEN
         self._api_token_dict = {'X-Charon-API-token': self._api_token}
         self._base_url = base_url or CHARON_BASE_URL
 
-    #def get(url_args, *args, **kwargs):
-    #    url = self.construct_charon_url(url_args)
-    #    return validate_response(super(CharonSession, self).get(url,
-    #                                   headers=self._api_token_dict,
-    #                                   *args, **kwargs))
-
-        self.get = validate_response(functools.partial(self.get,
-                    headers=self._api_token_dict, timeout=3))
-        self.post = validate_response(functools.partial(self.post,
-                    headers=self._api_token_dict, timeout=3))
-        self.put = validate_response(functools.partial(self.put,
-                    headers=self._api_token_dict, timeout=3))
-        self.delete = validate_response(functools.partial(self.delete,
-                    headers=self._api_token_dict, timeout=3))
+        charon_config = load_charon_config(config)
+        self.max_workers = int(charon_config["max_workers"])
+        self.async_max_workers = int(charon_config["async_max_workers"])
+        # Enough keep-alive connections for all the concurrent requests, so
+        # that none is dropped with "Connection pool is full"
+        self.pool_maxsize = max(int(charon_config["pool_maxsize"]),
+                                self.max_workers, self.async_max_workers)
+        adapter = HTTPAdapter(pool_connections=int(charon_config["pool_connections"]),
+                              pool_maxsize=self.pool_maxsize)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        timeout = float(charon_config["timeout"])
+        retry_params = {"max_retries": int(charon_config["max_retries"]),
+                        "backoff_factor": float(charon_config["backoff_factor"])}
+
+        self.stats = CHARON_STATS
+
+        self.get = validate_response(retry_on_failure(record_request(functools.partial(self.get,
+                    headers=self._api_token_dict, timeout=timeout), self.stats, "GET"),
+                    **retry_params))
+        # A POST that reached the server may have been applied, so only
+        # retry those if the connection could not be made at all
+        self.post = validate_response(retry_on_failure(record_request(functools.partial(self.post,
+                    headers=self._api_token_dict, timeout=timeout), self.stats, "POST"),
+                    idempotent=False, **retry_params))
+        self.put = validate_response(retry_on_failure(record_request(functools.partial(self.put,
+                    headers=self._api_token_dict, timeout=timeout), self.stats, "PUT"),
+                    **retry_params))
+        self.delete = validate_response(retry_on_failure(record_request(functools.partial(self.delete,
+                    headers=self._api_token_dict, timeout=timeout), self.stats, "DELETE"),
+                    **retry_params))
+        self.cache = get_cache(backend=charon_config["cache_backend"],
+                               ttl=charon_config["cache_ttl"],
+                               max_entries=int(charon_config["cache_max_entries"]),
+                               path=charon_config["cache_path"])
+        self._revisions = get_cache(backend="memory", ttl=charon_config["revision_ttl"],
+                                    max_entries=int(charon_config["cache_max_entries"]))
+        self.project_index = ProjectIndex(path=charon_config["project_index_path"],
+                                          refresh_interval=float(charon_config["project_index_refresh"]))
+        # Updates queued by the queue_*_update methods, keyed by document
+        self._pending_updates = collections.OrderedDict()
+        self._pending_updates_lock = threading.Lock()
+        stats_paths = (charon_config["stats_path"], charon_config["stats_prometheus_path"])
+        if any(stats_paths) and stats_paths not in _STATS_PATHS_AT_EXIT:
+            _STATS_PATHS_AT_EXIT.add(stats_paths)
+            atexit.register(self.write_stats, *stats_paths)
 
         self._project_params = ("projectid", "name", "status", "pipeline", "bpa")
         self._sample_params = ("sampleid", "status", "received", "qc_status",
@@ -75,6 +210,65 @@ class CharonSession(requests.Session):
         """Build a Charon URL, appending any *args passed."""
         return "{}/api/v1/{}".format(self._base_url,'/'.join([str(a) for a in args]))
 
+    def write_stats(self, json_path=None, prometheus_path=None):
+        """Write the request statistics of this session (and the cache's hit
+        counts) to a JSON and/or a Prometheus text file."""
+        write_stats(self.stats, json_path=json_path, prometheus_path=prometheus_path,
+                    extra={"cache": self.cache.stats()})
+
+    def _cached_get(self, url):
+        """GET the json for url, going through the cache. If a copy whose
+        cache entry has expired is still known by its ETag, the request is
+        conditional and the copy is reused if the server answers 304."""
+        response_json = self.cache.get(url)
+        if response_json is None:
+            revision = self._revisions.get(url)
+            headers = dict(self._api_token_dict)
+            if revision:
+                headers["If-None-Match"] = revision["etag"]
+            response = self.get(url, headers=headers)
+            if response.status_code == 304:
+                response_json = revision["json"]
+            else:
+                response_json = response.json()
+                etag = response.headers.get("ETag")
+                if etag:
+                    self._revisions.set(url, {"etag": etag, "json": response_json})
+            self.cache.set(url, response_json)
+        return response_json
+
+    def _if_match_headers(self, url):
+        """Return the request headers for an update of the document at url,
+        conditional on it being unchanged since we last fetched it."""
+        headers = dict(self._api_token_dict)
+        revision = self._revisions.get(url)
+        if revision:
+            headers["If-Match"] = revision["etag"]
+        return headers
+
+    def _invalidate_cache(self, doc_type, *ids):
+        """Drop the cached copies of a document and of the listing holding it,
+        e.g. "seqrun/P1/P1_101/A/<runid>" and "seqruns/P1/P1_101/A" (and any
+        filtered variants of the listing, "seqruns/P1/P1_101/A?...")."""
+        listing_url = self.construct_charon_url(doc_type + "s", *ids[:-1])
+        for cache in (self.cache, self._revisions):
+            cache.invalidate(self.construct_charon_url(doc_type, *ids))
+            cache.invalidate(listing_url)
+            cache.invalidate_prefix(listing_url + "?")
+
+    def _invalidate_cache_project(self, projectid, recursive=False):
+        """Drop the cached project documents, which may be keyed by project
+        name as well as id, and optionally everything below the project."""
+        for cache in (self.cache, self._revisions):
+            cache.invalidate_prefix(self.construct_charon_url('project') + "/")
+            cache.invalidate(self.construct_charon_url('projects'))
+            cache.invalidate_prefix(self.construct_charon_url('projects') + "?")
+            if recursive:
+                cache.invalidate(self.construct_charon_url('samples', projectid))
+                cache.invalidate_prefix(self.construct_charon_url('samples', projectid) + "?")
+                for doc_type in ('sample', 'libprep', 'libpreps', 'seqrun', 'seqruns'):
+                    cache.invalidate_prefix(self.construct_charon_url(doc_type, projectid) + "/")
+
 
     ## FIXME There's a lot of repeat code here that might could be condensed
 
@@ -82,27 +276,188 @@ class CharonSession(requests.Session):
     def project_create(self, projectid, name=None, status=None, pipeline=None, bpa=None):
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._project_params }
-        return self.post(self.construct_charon_url('project'),
-                         data=json.dumps(data)).json()
+        try:
+            project = self.post(self.construct_charon_url('project'),
+                                data=json.dumps(data)).json()
+        finally:
+            self._invalidate_cache_project(projectid)
+        if name:
+            self.project_index.add(projectid, name)
+        return project
 
     def project_get(self, projectid):
-        return self.get(self.construct_charon_url('project', projectid)).json()
+        return self._cached_get(self.construct_charon_url('project', projectid))
 
 
     def project_get_samples(self, projectid):
-        return self.get(self.construct_charon_url('samples', projectid)).json()
+        return self._cached_get(self.construct_charon_url('samples', projectid))
     
     def project_update(self, projectid, name=None, status=None, pipeline=None, bpa=None):
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._project_params if l_dict.get(k)}
-        return self.put(self.construct_charon_url('project', projectid),
-                        data=json.dumps(data)).text
+        url = self.construct_charon_url('project', projectid)
+        try:
+            response_text = self.put(url, data=json.dumps(data),
+                                     headers=self._if_match_headers(url)).text
+        finally:
+            self._invalidate_cache_project(projectid)
+        if name:
+            self.project_index.add(projectid, name)
+        return response_text
 
     def projects_get_all(self):
-        return self.get(self.construct_charon_url('projects')).json()
+        return self._cached_get(self.construct_charon_url('projects'))
 
     def project_delete(self, projectid):
-        return self.delete(self.construct_charon_url('project', projectid)).text
+        try:
+            return self.delete(self.construct_charon_url('project', projectid)).text
+        finally:
+            self._invalidate_cache_project(projectid, recursive=True)
+            self.project_index.remove(projectid)
+
+    def projects_get(self, projectids, max_workers=None, errors=None):
+        """Fetch several projects concurrently.
+
+        :param list projectids: The project ids or names
+        :param int max_workers: The number of concurrent requests (default from config)
+        :param dict errors: Add the projects that could not be fetched, other
+                            than those not in Charon, to this dict as
+                            {id or name: exception} (optional)
+
+        :returns: The documents of the projects found, by the id or name asked for
+        :rtype: dict
+        """
+        def get_project(projectid):
+            try:
+                return self.project_get(projectid), None
+            except (CharonError, requests.exceptions.RequestException) as e:
+                if getattr(e, "status_code", None) == 404:
+                    LOG.debug('Project "{}" not found in Charon: {}'.format(projectid, e))
+                    return None, None
+                LOG.error('Could not fetch project "{}" from Charon: {}'.format(projectid, e))
+                return None, e
+        projectids = list(projectids)
+        results = _threaded_map(get_project, projectids, max_workers or self.max_workers)
+        if errors is not None:
+            errors.update((projectid, error) for projectid, (_, error) in zip(projectids, results)
+                          if error is not None)
+        return dict((projectid, project) for projectid, (project, _) in zip(projectids, results)
+                    if project is not None)
+
+    def refresh_project_index(self):
+        """Fill the project name/id index from the full project listing."""
+        self.project_index.update(self.projects_get_all()["projects"])
+
+    def project_get_tree(self, projectid, project_name=None, base_path=None,
+                         max_workers=None):
+        """Build the NGIProject for a project with all of its samples, libpreps
+        and seqruns. The libpreps of all samples are fetched concurrently, and
+        then the seqruns of all libpreps, so this takes three rounds of requests
+        rather than one request per sample and per libprep in series.
+
+        :param str projectid: The project id (e.g. "P123")
+        :param str project_name: The project name (e.g. "J.Doe_14_01"); fetched from Charon if not given
+        :param str base_path: The analysis top directory of the project
+        :param int max_workers: The number of concurrent requests (default from config)
+
+        :returns: The project with its status set on every sample, libprep and seqrun
+        :rtype: NGIProject
+        :raises CharonError: If any of the requests fails
+        """
+        if not project_name:
+            project_name = self.project_get(projectid)["name"]
+        max_workers = max_workers or self.max_workers
+        project_obj = NGIProject(name=project_name, dirname=project_name,
+                                 project_id=projectid, base_path=base_path)
+        samples = self.project_get_samples(projectid)["samples"]
+        sample_objs = []
+        for sample in samples:
+            sample_id = sample["sampleid"]
+            sample_obj = project_obj.add_sample(name=sample_id, dirname=sample_id)
+            sample_obj.status = sample.get("status", "unknown")
+            sample_objs.append(sample_obj)
+        libpreps_per_sample = _threaded_map(lambda sample_obj:
+                self.sample_get_libpreps(projectid, sample_obj.name)["libpreps"],
+                sample_objs, max_workers)
+        libprep_objs = []
+        for sample_obj, libpreps in zip(sample_objs, libpreps_per_sample):
+            for libprep in libpreps:
+                libprep_id = libprep["libprepid"]
+                libprep_obj = sample_obj.add_libprep(name=libprep_id, dirname=libprep_id)
+                libprep_obj.status = libprep.get("status", "unknown")
+                libprep_objs.append((sample_obj, libprep_obj))
+        seqruns_per_libprep = _threaded_map(lambda (sample_obj, libprep_obj):
+                self.libprep_get_seqruns(projectid, sample_obj.name,
+                                         libprep_obj.name)["seqruns"],
+                libprep_objs, max_workers)
+        for (sample_obj, libprep_obj), seqruns in zip(libprep_objs, seqruns_per_libprep):
+            for seqrun in seqruns:
+                # e.g. 140528_D00415_0049_BC423WACXX
+                seqrun_id = seqrun["seqrunid"]
+                seqrun_obj = libprep_obj.add_seqrun(name=seqrun_id, dirname=seqrun_id)
+                seqrun_obj.status = seqrun.get("status", "unknown")
+        return project_obj
+
+    def _filtered_listing_url(self, listing, ids, filters):
+        """The url of a listing with the plain field=value filters as query
+        parameters, e.g. "samples/P1?status=NEW", so that a server that can
+        filter needn't send the whole listing. The results are filtered here
+        as well, since the server may ignore the parameters."""
+        url = self.construct_charon_url(listing, *ids)
+        params = sorted((k, v) for k, v in filters.items()
+                        if isinstance(v, (basestring, int, float)))
+        if params:
+            url += "?" + urllib.urlencode(params)
+        return url
+
+    def projects_iter(self, **filters):
+        """Yield the projects in Charon whose fields match filters.
+
+        :param dict filters: The field values to match, e.g. status="OPEN";
+                             a list or tuple value matches any of its items
+
+        :returns: The project documents, one by one
+        :rtype: generator of dicts
+        """
+        url = self._filtered_listing_url("projects", (), filters)
+        for project in self._cached_get(url)["projects"]:
+            if _doc_matches(project, filters):
+                yield project
+
+    def samples_iter(self, project_filters=None, min_coverage=None,
+                     max_workers=None, **filters):
+        """Yield the samples in Charon whose fields match filters, for all
+        projects matching project_filters. The sample listings are fetched
+        max_workers projects at a time and the matches handed out before the
+        next batch is fetched, so only one batch is held in memory at once;
+        the sample listings are not cached.
+
+        :param dict project_filters: Restrict to the projects matching these (see projects_iter)
+        :param float min_coverage: Only samples with at least this total_autosomal_coverage
+        :param int max_workers: The number of concurrent requests (default from config)
+        :param dict filters: The sample field values to match, e.g. status="NEW"
+
+        :returns: (project, sample) document pairs, one by one
+        :rtype: generator of tuples
+        """
+        max_workers = max_workers or self.max_workers
+        def get_samples(project):
+            url = self._filtered_listing_url("samples", (project["projectid"],), filters)
+            # Not cached, or every listing streamed through would be kept
+            return self.get(url).json()["samples"]
+        projects = self.projects_iter(**(project_filters or {}))
+        while True:
+            batch = list(itertools.islice(projects, max_workers))
+            if not batch:
+                break
+            for project, samples in zip(batch, _threaded_map(get_samples, batch, max_workers)):
+                for sample in samples:
+                    if not _doc_matches(sample, filters):
+                        continue
+                    if min_coverage is not None and \
+                            (sample.get("total_autosomal_coverage") or 0) < min_coverage:
+                        continue
+                    yield project, sample
 
     # Sample
     def sample_create(self, projectid, sampleid, status=None, received=None,
@@ -112,14 +467,17 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("sample", projectid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._sample_params }
-        return self.post(url, json.dumps(data)).json()
+        try:
+            return self.post(url, json.dumps(data)).json()
+        finally:
+            self._invalidate_cache("sample", projectid, sampleid)
 
     def sample_get(self, projectid, sampleid):
         url = self.construct_charon_url("sample", projectid, sampleid)
-        return self.get(url).json()
+        return self._cached_get(url)
 
     def sample_get_libpreps(self, projectid, sampleid):
-        return self.get(self.construct_charon_url('libpreps', projectid, sampleid)).json()
+        return self._cached_get(self.construct_charon_url('libpreps', projectid, sampleid))
 
     def sample_update(self, projectid, sampleid, status=None, received=None,
                       qc_status=None, genotyping_status=None,
@@ -128,7 +486,10 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("sample", projectid, sampleid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._sample_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        try:
+            return self.put(url, json.dumps(data), headers=self._if_match_headers(url)).text
+        finally:
+            self._invalidate_cache("sample", projectid, sampleid)
 
     ## Eliminate?
     def samples_get_all(self, projectid):
@@ -140,21 +501,27 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("libprep", projectid, sampleid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._libprep_params }
-        return self.post(url, json.dumps(data)).json()
+        try:
+            return self.post(url, json.dumps(data)).json()
+        finally:
+            self._invalidate_cache("libprep", projectid, sampleid, libprepid)
 
     def libprep_get(self, projectid, sampleid, libprepid):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
-        return self.get(url).json()
+        return self._cached_get(url)
 
     def libprep_get_seqruns(self, projectid, sampleid, libprepid):
-        return self.get(self.construct_charon_url('seqruns', projectid, sampleid, libprepid)).json()
+        return self._cached_get(self.construct_charon_url('seqruns', projectid, sampleid, libprepid))
 
 
     def libprep_update(self, projectid, sampleid, libprepid, status=None, limsid=None):
         url = self.construct_charon_url("libprep", projectid, sampleid, libprepid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._libprep_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        try:
+            return self.put(url, json.dumps(data), headers=self._if_match_headers(url)).text
+        finally:
+            self._invalidate_cache("libprep", projectid, sampleid, libprepid)
 
     ## Eliminate?
     def libpreps_get_all(self, projectid, sampleid):
@@ -176,11 +543,14 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid)
         l_dict = locals()
         data = { k: l_dict.get(k) for k in self._seqrun_params }
-        return self.post(url, json.dumps(data)).json()
+        try:
+            return self.post(url, json.dumps(data)).json()
+        finally:
+            self._invalidate_cache("seqrun", projectid, sampleid, libprepid, seqrunid)
 
     def seqrun_get(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
-        return self.get(url).json()
+        return self._cached_get(url)
 
     def seqrun_update(self, projectid, sampleid, libprepid, seqrunid,
                       total_reads=None, mean_autosomal_coverage=None, reads_per_lane=None,
@@ -199,18 +569,130 @@ class CharonSession(requests.Session):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
         l_dict = locals()
         data = { k: str(l_dict.get(k)) for k in self._seqrun_params if l_dict.get(k)}
-        return self.put(url, json.dumps(data)).text
+        try:
+            return self.put(url, json.dumps(data), headers=self._if_match_headers(url)).text
+        finally:
+            self._invalidate_cache("seqrun", projectid, sampleid, libprepid, seqrunid)
 
     def seqrun_reset(self, projectid, sampleid, libprepid, seqrunid):
         url = self.construct_charon_url("seqrun", projectid, sampleid, libprepid, seqrunid)
         data = { k: None for k in self._seqrun_reset_params}
-        return self.put(url, json.dumps(data)).text
+        try:
+            return self.put(url, json.dumps(data), headers=self._if_match_headers(url)).text
+        finally:
+            self._invalidate_cache("seqrun", projectid, sampleid, libprepid, seqrunid)
 
 
     def seqruns_get_all(self, projectid, sampleid, libprepid):
         return self.libprep_get_seqruns(projectid, sampleid, libprepid)
         #return self.get(self.construct_charon_url('seqruns', projectid, sampleid, libprepid)).json()
 
+    # Deferred updates
+    def queue_project_update(self, projectid, **fields):
+        self._queue_update("project", (projectid,), fields)
+
+    def queue_sample_update(self, projectid, sampleid, **fields):
+        self._queue_update("sample", (projectid, sampleid), fields)
+
+    def queue_libprep_update(self, projectid, sampleid, libprepid, **fields):
+        self._queue_update("libprep", (projectid, sampleid, libprepid), fields)
+
+    def queue_seqrun_update(self, projectid, sampleid, libprepid, seqrunid, **fields):
+        self._queue_update("seqrun", (projectid, sampleid, libprepid, seqrunid), fields)
+
+    def _queue_update(self, doc_type, ids, fields):
+        """Merge fields into the pending update for this document, so that any
+        number of queued updates to one document are sent as a single PUT by
+        flush_updates(). Later values win; fields that the matching *_update
+        method does not take are dropped."""
+        params = getattr(self, "_{}_params".format(doc_type))
+        ignored = set(fields) - set(params)
+        if ignored:
+            LOG.debug("Ignoring extra fields for {} update: {}".format(doc_type,
+                                                                      ", ".join(ignored)))
+        with self._pending_updates_lock:
+            pending = self._pending_updates.setdefault((doc_type,) + tuple(ids), {})
+            pending.update((k, v) for k, v in fields.iteritems() if k in params)
+
+    def flush_updates(self, max_workers=None):
+        """Send all queued updates, one PUT per document and up to max_workers
+        at a time. Failed updates are not requeued but returned, so the caller
+        can decide what to do about them.
+
+        :param int max_workers: The number of concurrent requests (default from config)
+
+        :returns: The failures as {(doc_type, id, ...): exception}, e.g.
+                  {("seqrun", "P1", "P1_101", "A", "<seqrunid>"): CharonError(...)};
+                  empty if every update succeeded
+        :rtype: dict
+        """
+        with self._pending_updates_lock:
+            pending = self._pending_updates.items()
+            self._pending_updates = collections.OrderedDict()
+        def send_update((key, fields)):
+            try:
+                getattr(self, "{}_update".format(key[0]))(*key[1:], **fields)
+            except (CharonError, requests.exceptions.RequestException) as e:
+                LOG.error('Unable to update {} "{}" in Charon: {}'.format(key[0],
+                                                                       "/".join(key[1:]), e))
+                return e
+        errors = _threaded_map(send_update, pending, max_workers or self.max_workers)
+        return { key: error for (key, fields), error in zip(pending, errors) if error }
+
+
+def _async_method(name):
+    def method(self, *args, **kwargs):
+        return self._pool.apply_async(getattr(self.charon_session, name), args, kwargs)
+    method.__name__ = name
+    method.__doc__ = ("Start CharonSession.{}() in the background.\n\n"
+                      ":rtype: multiprocessing.pool.AsyncResult".format(name))
+    return method
+
+
+class AsyncCharonSession(object):
+    """
+    Runs CharonSession requests in the background on a pool of threads.
+    Each method takes the same arguments as its CharonSession namesake and
+    returns an AsyncResult, whose get() returns (or raises) what the blocking
+    call would have; at most max_workers requests are in flight at a time.
+
+        with AsyncCharonSession() as async_session:
+            results = [async_session.sample_get(p, s) for p, s in samples]
+            statuses = [result.get()["status"] for result in results]
+    """
+    def __init__(self, charon_session=None, max_workers=None):
+        """
+        :param CharonSession charon_session: The session to use (default the shared one)
+        :param int max_workers: The number of concurrent requests
+                                (default charon.async_max_workers from config)
+        """
+        self.charon_session = charon_session or get_charon_session()
+        self.max_workers = max_workers or self.charon_session.async_max_workers
+        self._pool = ThreadPool(self.max_workers)
+
+    def close(self):
+        """Wait for the outstanding requests and stop the threads."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    project_get = _async_method("project_get")
+    project_get_samples = _async_method("project_get_samples")
+    project_update = _async_method("project_update")
+    sample_get = _async_method("sample_get")
+    sample_get_libpreps = _async_method("sample_get_libpreps")
+    sample_update = _async_method("sample_update")
+    libprep_get = _async_method("libprep_get")
+    libprep_get_seqruns = _async_method("libprep_get_seqruns")
+    libprep_update = _async_method("libprep_update")
+    seqrun_get = _async_method("seqrun_get")
+    seqrun_update = _async_method("seqrun_update")
+
 
 ## TODO create different CharonError subclasses for different codes (e.g. 400, 404)
 class CharonError(Exception):
@@ -219,6 +701,67 @@ class CharonError(Exception):
         super(CharonError, self).__init__(message, *args, **kwargs)
 
 
+class retry_on_failure(object):
+    """
+    Retry a Charon API query with exponential backoff when the request times
+    out, the connection fails or the server responds with a 5xx error. The
+    last response (or exception) is passed on once the retries run out.
+    """
+    RETRY_CODES = (500, 502, 503, 504)
+
+    def __init__(self, f, max_retries=3, backoff_factor=0.5, idempotent=True):
+        self.f = f
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # Non-idempotent requests are only retried if they never got through
+        self.retry_exceptions = (ConnectionError, Timeout) if idempotent else (ConnectionError,)
+        self.retry_codes = self.RETRY_CODES if idempotent else ()
+
+    def __call__(self, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.f(*args, **kwargs)
+            except self.retry_exceptions as e:
+                if attempt == self.max_retries:
+                    raise
+                reason = e
+            else:
+                if response.status_code not in self.retry_codes or attempt == self.max_retries:
+                    return response
+                reason = "code {}".format(response.status_code)
+            delay = self.backoff_factor * (2 ** attempt)
+            LOG.warn('Charon request failed ({}); retrying in {} seconds '
+                     '(attempt {} of {})'.format(reason, delay, attempt + 1,
+                                                 self.max_retries))
+            time.sleep(delay)
+
+
+def _threaded_map(function, iterable, max_workers):
+    """Like map(), but with up to max_workers calls running at a time.
+    The first exception raised by a call is re-raised here."""
+    items = list(iterable)
+    if max_workers <= 1 or len(items) <= 1:
+        return map(function, items)
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _doc_matches(doc, filters):
+    """True if the fields of doc have the values in filters; a list or tuple
+    in filters matches any of its items."""
+    for field, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            if doc.get(field) not in value:
+                return False
+        elif doc.get(field) != value:
+            return False
+    return True
+
+
 class validate_response(object):
     """
     Validate or raise an appropriate exception for a Charon API query.
@@ -226,7 +769,8 @@ class validate_response(object):
     def __init__(self, f):
         self.f = f
         ## Should these be class attributes? I don't really know
-        self.SUCCESS_CODES = (200, 201, 204)
+        # 304 is the answer to a conditional GET for an unchanged document
+        self.SUCCESS_CODES = (200, 201, 204, 304)
         # There are certainly more failure codes I need to add here
         self.FAILURE_CODES = {
                 400: (CharonError, ("Charon access failure: invalid input "
@@ -244,6 +788,10 @@ class validate_response(object):
                 409: (CharonError, ("Charon access failure: document "
                                     "revision conflict (reason '{response.reason}' / "
                                     "code {response.status_code} / "
+                                    "url '{response.url}')")),
+                412: (CharonError, ("Charon access failure: document "
+                                    "changed since it was last read (reason "
+                                    "'{response.reason}' / code {response.status_code} / "
                                     "url '{response.url}')")),}
 
     def __call__(self, *args, **kwargs):
@@ -1,4 +1,4 @@
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonError, get_charon_session
 
 from ngi_pipeline.log.loggers import minimal_logger
 
@@ -15,8 +15,18 @@ def get_project_id_from_name(project_name):
     :raises RuntimeError: If there is some problem relating to the GET (HTTP Return code != 200)
     :raises ValueError: If the project has no project id in the database or if the project does not exist in Charon
     """
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
+    project_index = charon_session.project_index
+    if project_index.is_stale():
+        try:
+            charon_session.refresh_project_index()
+        except CharonError as e:
+            LOG.warn('Could not refresh the project index: {}'.format(e))
+    project_id = project_index.get_id(project_name)
+    if project_id:
+        return project_id
 
+    # Not in the index (e.g. created since it was last refreshed)
     try:
         project_id = charon_session.project_get(project_name)
     except CharonError as e:
@@ -25,59 +35,50 @@ def get_project_id_from_name(project_name):
         else:
             raise
     try:
+        project_index.add(project_id['projectid'], project_name)
         return project_id['projectid']
     except KeyError:
         raise ValueError('Couldn\'t retrive project id for project "{}"; '
-                         'this project\'s database entry has no "projectid" value.'.format(project))
+                         'this project\'s database entry has no "projectid" value.'.format(project_name))
+
+
+def get_projects_from_names(project_names):
+    """Fetch the Charon documents of several projects by name, concurrently,
+    and add their ids to the project index.
+
+    :param list project_names: The human-friendly names of the projects (e.g. "J.Doe_14_01")
+
+    :returns: The documents of the projects found in Charon, by project name
+    :rtype: dict
+    """
+    charon_session = get_charon_session()
+    projects = charon_session.projects_get(project_names)
+    for project_name, project in projects.items():
+        if project.get('projectid'):
+            charon_session.project_index.add(project['projectid'], project_name)
+    return projects
 
 
 def rebuild_project_obj_from_Charon(analysis_top_dir, project_name, project_id):
-    project_dir = os.path.join(analysis_top_dir, "DATA", project_name)
-    project_obj = NGIProject(name=project_name, dirname=project_name,
-                                     project_id=project_id,
-                                     base_path=analysis_top_dir)
-    #I use the DB to build the object
-    #get the samples
-    charon_session = CharonSession()
-    url = charon_session.construct_charon_url("samples", project_id)
-    samples_response = charon_session.get(url)
-    if samples_response.status_code != 200:
-        error_msg = ('Error accessing database: could not get samples for projects: {}'.format(project_id,
-                            project_response.reason))
+    """Build the NGIProject object for a project, with all of its samples,
+    libpreps and seqruns, from the Charon database.
+
+    :param str analysis_top_dir: The analysis top directory of the project
+    :param str project_name: The human-friendly name of the project (e.g. "J.Doe_14_01")
+    :param str project_id: The alphanumeric id of the project (e.g. "P123")
+
+    :returns: The project object
+    :rtype: NGIProject
+
+    :raises RuntimeError: If the project could not be fetched from the database
+    """
+    charon_session = get_charon_session()
+    try:
+        return charon_session.project_get_tree(project_id,
+                                               project_name=project_name,
+                                               base_path=analysis_top_dir)
+    except CharonError as e:
+        error_msg = ('Error accessing database: could not rebuild project '
+                     '{}: {}'.format(project_id, e))
         LOG.error(error_msg)
         raise RuntimeError(error_msg)
-    #now I have all the samples
-    samples_dict = samples_response.json()["samples"]
-    for sample in samples_dict:
-        sample_id = sample["sampleid"]
-        sample_dir = os.path.join(project_dir, sample_id)
-        sample_obj = project_obj.add_sample(name=sample_id, dirname=sample_id)
-        #now get lib preps
-        url = charon_session.construct_charon_url("libpreps", project_id, sample_id)
-        libpreps_response = charon_session.get(url)
-        if libpreps_response.status_code != 200:
-            error_msg = ('Error accessing database: could not get lib preps for sample {}: {}'.format(sample_id,
-                            project_response.reason))
-            LOG.error(error_msg)
-            raise RuntimeError(error_msg)
-        libpreps_dict = libpreps_response.json()["libpreps"]
-        for libprep in libpreps_dict:
-            libprep_id = libprep["libprepid"]
-            libprep_object = sample_obj.add_libprep(name=libprep_id,
-                                                        dirname=libprep_id)
-            url = charon_session.construct_charon_url("seqruns", project_id, sample_id, libprep_id)
-            seqruns_response = charon_session.get(url)
-            if seqruns_response.status_code != 200:
-                error_msg = ('Error accessing database: could not get lib preps for sample {}: {}'.format(sample_id,
-                            seqruns_response.reason))
-                LOG.error(error_msg)
-                raise RuntimeError(error_msg)
-            seqruns_dict = seqruns_response.json()["seqruns"]
-            for seqrun in seqruns_dict:
-                runid = seqrun["runid"]
-                #140528_D00415_0049_BC423WACXX   --> 140528_BC423WACXX
-                parse_FC = re.compile("(\d{6})_(.*)_(.*)_(.*)")
-                fc_short_run_id = "{}_{}".format(parse_FC.match(runid).group(1), parse_FC.match(runid).group(4))
-                seqrun_object = libprep_object.add_seqrun(name=fc_short_run_id,
-                                                          dirname=fc_short_run_id)
-    return project_obj
@@ -0,0 +1,196 @@
+"""Request counters and timings for the Charon API.
+
+Every HTTP request a CharonSession makes is recorded in CHARON_STATS by
+endpoint (method and document type, e.g. "GET seqrun") and by the conductor
+stage it was made in, so that a run can be summarized as JSON or in the
+Prometheus text format.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import json
+import re
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Upper bounds (in seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# e.g. http://charon/api/v1/seqrun/P1/P1_101/A/<seqrunid> --> "seqrun"
+ENDPOINT_RE = re.compile(r'/api/v1/(?P<endpoint>\w+)')
+
+
+class EndpointStats(object):
+    """The counters for one (stage, method, endpoint)."""
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.codes = collections.Counter()
+        # One count per bucket in DURATION_BUCKETS plus one for anything slower
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def add(self, code, duration, bytes_sent, bytes_received):
+        self.count += 1
+        self.total_time += duration
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.codes[code] += 1
+        self.buckets[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+
+    def to_dict(self):
+        return {"count": self.count,
+                "total_time": self.total_time,
+                "mean_time": (self.total_time / self.count if self.count else 0.0),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "codes": dict((str(code), n) for code, n in self.codes.items()),
+                "duration_buckets": dict(zip([str(b) for b in DURATION_BUCKETS] + ["+Inf"],
+                                             self.buckets))}
+
+
+class CharonStats(object):
+    """Thread-safe tally of the requests made to Charon."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = collections.defaultdict(EndpointStats)
+        self._stages = []
+
+    def record(self, method, url, code, duration, bytes_sent=0, bytes_received=0):
+        """Record one request.
+
+        :param str method: The HTTP verb
+        :param str url: The url requested
+        :param code: The status code of the response, or the name of the
+                     exception raised instead (e.g. "ConnectionError")
+        :param float duration: Seconds taken
+        """
+        match = ENDPOINT_RE.search(url)
+        endpoint = match.group("endpoint") if match else "unknown"
+        with self._lock:
+            stage = self._stages[-1] if self._stages else "none"
+            self._endpoints[(stage, method, endpoint)].add(code, duration, bytes_sent,
+                                                           bytes_received)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Attribute the requests made inside this block (from any thread) to
+        the conductor stage name; stages can be nested."""
+        with self._lock:
+            self._stages.append(name)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._stages.remove(name)
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def to_dict(self):
+        """Return the counters as {stage: {"<method> <endpoint>": {...}}}."""
+        with self._lock:
+            stats = collections.defaultdict(dict)
+            for (stage, method, endpoint), endpoint_stats in self._endpoints.items():
+                stats[stage]["{} {}".format(method, endpoint)] = endpoint_stats.to_dict()
+            return dict(stats)
+
+    def to_prometheus(self, prefix="ngi_charon"):
+        """Return the counters in the Prometheus text exposition format."""
+        lines = ["# TYPE {}_requests_total counter".format(prefix),
+                 "# TYPE {}_request_duration_seconds histogram".format(prefix),
+                 "# TYPE {}_bytes_total counter".format(prefix)]
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for (stage, method, endpoint), s in endpoints:
+                labels = 'stage="{}",method="{}",endpoint="{}"'.format(stage, method, endpoint)
+                for code, n in sorted(s.codes.items()):
+                    lines.append('{}_requests_total{{{},code="{}"}} {}'.format(prefix, labels,
+                                                                            code, n))
+                cumulative = 0
+                for bound, n in zip([str(b) for b in DURATION_BUCKETS] + ["+Inf"], s.buckets):
+                    cumulative += n
+                    lines.append('{}_request_duration_seconds_bucket{{{},le="{}"}} '
+                                 '{}'.format(prefix, labels, bound, cumulative))
+                lines.append('{}_request_duration_seconds_sum{{{}}} {}'.format(prefix, labels,
+                                                                              s.total_time))
+                lines.append('{}_request_duration_seconds_count{{{}}} {}'.format(prefix, labels,
+                                                                                s.count))
+                lines.append('{}_bytes_total{{{},direction="sent"}} {}'.format(prefix, labels,
+                                                                             s.bytes_sent))
+                lines.append('{}_bytes_total{{{},direction="received"}} '
+                             '{}'.format(prefix, labels, s.bytes_received))
+        return "\n".join(lines) + "\n"
+
+
+# The process-wide counters shared by all sessions
+CHARON_STATS = CharonStats()
+
+
+class charon_stage(object):
+    """
+    Decorator; attribute the Charon requests made while the function runs
+    to the named conductor stage.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with CHARON_STATS.stage(self.name):
+                return f(*args, **kwargs)
+        return wrapped
+
+
+class record_request(object):
+    """
+    Record the timing, size and outcome of each call to a Charon API query
+    (i.e. each attempt, when wrapped by retry_on_failure) in a CharonStats.
+    """
+    def __init__(self, f, stats, method):
+        self.f = f
+        self.stats = stats
+        self.method = method
+
+    def __call__(self, url, data=None, **kwargs):
+        if data is not None:
+            kwargs["data"] = data
+        start = time.time()
+        try:
+            response = self.f(url, **kwargs)
+        except Exception as e:
+            self.stats.record(self.method, url, type(e).__name__, time.time() - start,
+                              bytes_sent=len(data or ""))
+            raise
+        self.stats.record(self.method, url, response.status_code, time.time() - start,
+                          bytes_sent=len(data or ""),
+                          bytes_received=len(response.content or ""))
+        return response
+
+
+def write_stats(stats, json_path=None, prometheus_path=None, extra=None):
+    """Write the counters to a JSON and/or a Prometheus text file.
+
+    :param CharonStats stats: The counters
+    :param str json_path: The JSON file to write (optional)
+    :param str prometheus_path: The Prometheus text file to write (optional)
+    :param dict extra: More sections for the JSON file, e.g. {"cache": {...}} (optional)
+    """
+    if json_path:
+        output = {"requests": stats.to_dict()}
+        output.update(extra or {})
+        with open(json_path, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+        LOG.info('Wrote Charon request statistics to "{}"'.format(json_path))
+    if prometheus_path:
+        with open(prometheus_path, 'w') as f:
+            f.write(stats.to_prometheus())
+        LOG.info('Wrote Charon request metrics to "{}"'.format(prometheus_path))
@@ -6,7 +6,7 @@ import os
 import re
 import shelve
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonError, get_charon_session
 from ngi_pipeline.database.communicate import get_project_id_from_name
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
@@ -129,8 +129,7 @@ def write_status_to_charon(project_id, return_code):
 
     :raises RuntimeError: If the Charon database could not be updated
     """
-    ## Consider keeping on CharonSession open. What's the time savings?
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
     ## Is "CLOSED" correct here?
     status = "CLOSED" if return_code is 0 else "FAILED"
     try:
@@ -153,7 +152,7 @@ def write_to_charon_NGI_results(job_id, return_code, run_dir):
 
     :raises RuntimeError: If the Charon database could not be updated
     """
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
     # Consider moving this mapping to the CharonSession object or something
     if return_code is None:
         status = "RUNNING"
@@ -0,0 +1,102 @@
+"""A local index of Charon project names and ids.
+
+Project ids never change once a project is created, so the mapping from
+"Y.Mom_14_01" to "P123" can be kept on disk and shared between runs instead
+of being fetched from Charon every time it is needed. The index is warmed
+from the full project listing every refresh_interval seconds and filled in
+one project at a time in between.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+
+class ProjectIndex(object):
+    """Project name <-> project id map in a sqlite database."""
+    def __init__(self, path=None, refresh_interval=86400):
+        """
+        :param str path: The database file (default in memory, i.e. not kept between runs)
+        :param int refresh_interval: Seconds before the index is due a full refresh
+        """
+        if path:
+            self.path = os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+            index_dir = os.path.dirname(self.path)
+            try:
+                os.makedirs(index_dir)
+            except OSError:
+                # Already there, e.g. made by another process
+                if not os.path.isdir(index_dir):
+                    raise
+        else:
+            self.path = ":memory:"
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30,
+                                           check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS project_index "
+                                     "(projectid TEXT PRIMARY KEY, name TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS project_index_name "
+                                     "ON project_index (name)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS project_index_refresh "
+                                     "(refreshed REAL)")
+
+    def get_id(self, project_name):
+        """Return the id of the project named project_name, or None if unknown."""
+        with self._lock:
+            row = self._connection.execute("SELECT projectid FROM project_index "
+                                           "WHERE name = ?", (project_name,)).fetchone()
+        return row[0] if row else None
+
+    def get_name(self, projectid):
+        """Return the name of the project projectid, or None if unknown."""
+        with self._lock:
+            row = self._connection.execute("SELECT name FROM project_index "
+                                           "WHERE projectid = ?", (projectid,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, projectid, project_name):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO project_index "
+                                     "(projectid, name) VALUES (?, ?)",
+                                     (projectid, project_name))
+
+    def remove(self, projectid):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM project_index WHERE projectid = ?",
+                                     (projectid,))
+
+    def update(self, projects):
+        """Replace the index with the projects in a full Charon project
+        listing, dropping those deleted or renamed since, and mark it as
+        refreshed.
+
+        :param list projects: The project documents (with "projectid" and "name")
+        """
+        rows = [(p["projectid"], p["name"]) for p in projects
+                if p.get("projectid") and p.get("name")]
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM project_index")
+            self._connection.executemany("INSERT OR REPLACE INTO project_index "
+                                         "(projectid, name) VALUES (?, ?)", rows)
+            self._connection.execute("DELETE FROM project_index_refresh")
+            self._connection.execute("INSERT INTO project_index_refresh (refreshed) "
+                                     "VALUES (?)", (time.time(),))
+        LOG.debug("Project index refreshed with {} projects".format(len(rows)))
+
+    def is_stale(self):
+        """True if the index has never been refreshed, or not for refresh_interval seconds."""
+        with self._lock:
+            row = self._connection.execute("SELECT refreshed FROM "
+                                           "project_index_refresh").fetchone()
+        return row is None or row[0] + self.refresh_interval < time.time()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM "
+                                            "project_index").fetchone()[0]
@@ -0,0 +1,108 @@
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ngi_pipeline.database.cache import get_cache, MemoryCache, NullCache, SqliteCache
+from ngi_pipeline.database.classes import CharonSession
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = MemoryCache(ttl=60)
+        self.assertIsNone(cache.get("project/P1"))
+        cache.set("project/P1", {"projectid": "P1"})
+        self.assertEqual(cache.get("project/P1"), {"projectid": "P1"})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_returns_copies(self):
+        cache = MemoryCache(ttl=60)
+        cache.set("project/P1", {"status": "OPEN"})
+        cache.get("project/P1")["status"] = "CLOSED"
+        self.assertEqual(cache.get("project/P1")["status"], "OPEN")
+
+    def test_expiry(self):
+        cache = MemoryCache(ttl=0.01)
+        cache.set("project/P1", {"projectid": "P1"})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("project/P1"))
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(ttl=60, max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+
+    def test_invalidate_prefix(self):
+        cache = MemoryCache(ttl=60)
+        cache.set("sample/P1/P1_101", {})
+        cache.set("sample/P10/P10_101", {})
+        cache.invalidate_prefix("sample/P1/")
+        self.assertIsNone(cache.get("sample/P1/P1_101"))
+        self.assertEqual(cache.get("sample/P10/P10_101"), {})
+
+
+class TestSqliteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "cache", "charon.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persists_between_instances(self):
+        SqliteCache(self.path, ttl=60).set("project/P1", {"projectid": "P1"})
+        cache = SqliteCache(self.path, ttl=60)
+        self.assertEqual(cache.get("project/P1"), {"projectid": "P1"})
+        cache.invalidate_prefix("project/")
+        self.assertIsNone(cache.get("project/P1"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+
+class TestGetCache(unittest.TestCase):
+
+    def test_backends(self):
+        self.assertIsInstance(get_cache("memory"), MemoryCache)
+        self.assertIsInstance(get_cache("none"), NullCache)
+        self.assertIsInstance(get_cache(False), NullCache)
+        self.assertIsInstance(get_cache("memory", ttl=0), NullCache)
+        with self.assertRaises(ValueError):
+            get_cache("sqlite")
+        with self.assertRaises(ValueError):
+            get_cache("redis")
+
+
+class TestCharonSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.session = CharonSession(api_token="x", base_url="http://localhost:1")
+        self.session.get = mock.Mock(return_value=mock.Mock(status_code=200, headers={},
+                                                              json=lambda: {"status": "NEW"}))
+        self.session.put = mock.Mock(return_value=mock.Mock(text=""))
+
+    def test_get_is_cached(self):
+        self.session.sample_get("P1", "P1_101")
+        self.session.sample_get("P1", "P1_101")
+        self.assertEqual(self.session.get.call_count, 1)
+
+    def test_update_invalidates(self):
+        self.session.sample_get("P1", "P1_101")
+        self.session.project_get_samples("P1")
+        self.session.sample_update("P1", "P1_101", status="DONE")
+        self.session.sample_get("P1", "P1_101")
+        self.session.project_get_samples("P1")
+        self.assertEqual(self.session.get.call_count, 4)
+
+    def test_project_delete_invalidates_tree(self):
+        self.session.delete = mock.Mock(return_value=mock.Mock(text=""))
+        self.session.seqrun_get("P1", "P1_101", "A", "run1")
+        self.session.project_delete("P1")
+        self.session.seqrun_get("P1", "P1_101", "A", "run1")
+        self.assertEqual(self.session.get.call_count, 2)
@@ -1,9 +1,14 @@
+import collections
 import json
+import mock
 import requests
+import time
 import unittest
 
-from ngi_pipeline.database.classes import CharonSession, CHARON_BASE_URL, CharonError
+from ngi_pipeline.database.classes import AsyncCharonSession, CharonSession, CHARON_BASE_URL, CharonError, \
+                                          get_charon_session, retry_on_failure
 from ngi_pipeline.tests.generate_test_data import generate_run_id
+from ngi_pipeline.tests.mock_charon import MockCharonServer
 
 class TestCharonFunctions(unittest.TestCase):
 
@@ -130,3 +135,230 @@ class TestCharonFunctions(unittest.TestCase):
     def test_14_project_delete(self):
         self.session.project_delete(projectid=self.p_id)
 
+
+
+FakeResponse = collections.namedtuple("FakeResponse", ["status_code"])
+
+class TestRetryOnFailure(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def _respond_with(self, *status_codes):
+        status_codes = list(status_codes)
+        def f(*args, **kwargs):
+            self.calls.append(args)
+            return FakeResponse(status_codes.pop(0))
+        return f
+
+    def test_retry_server_error(self):
+        f = retry_on_failure(self._respond_with(503, 502, 200), backoff_factor=0)
+        self.assertEqual(200, f("url").status_code)
+        self.assertEqual(3, len(self.calls))
+
+    def test_retry_gives_up(self):
+        f = retry_on_failure(self._respond_with(500, 500, 500), max_retries=2, backoff_factor=0)
+        self.assertEqual(500, f("url").status_code)
+        self.assertEqual(3, len(self.calls))
+
+    def test_no_retry_client_error(self):
+        f = retry_on_failure(self._respond_with(404, 200), backoff_factor=0)
+        self.assertEqual(404, f("url").status_code)
+        self.assertEqual(1, len(self.calls))
+
+    def test_no_retry_non_idempotent(self):
+        f = retry_on_failure(self._respond_with(503, 201), backoff_factor=0, idempotent=False)
+        self.assertEqual(503, f("url").status_code)
+        self.assertEqual(1, len(self.calls))
+
+    def test_retry_connection_error(self):
+        def f(*args, **kwargs):
+            self.calls.append(args)
+            if len(self.calls) < 2:
+                raise requests.exceptions.ConnectionError("Connection refused")
+            return FakeResponse(200)
+        self.assertEqual(200, retry_on_failure(f, backoff_factor=0)("url").status_code)
+        self.assertEqual(2, len(self.calls))
+
+    def test_get_charon_session_shared(self):
+        self.assertIs(get_charon_session(), get_charon_session())
+        self.assertIsNot(get_charon_session(), get_charon_session(base_url="http://other"))
+
+
+class TestProjectGetTree(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockCharonServer().start()
+        cls.p_name = cls.server.populate("P100", n_samples=5, n_libpreps=2, n_seqruns=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_project_get_tree(self):
+        session = CharonSession(base_url=self.server.base_url,
+                                config={"charon": {"cache_backend": "none"}})
+        project_obj = session.project_get_tree("P100", base_path="/tmp", max_workers=4)
+        self.assertEqual(project_obj.name, self.p_name)
+        self.assertEqual(len(list(project_obj)), 5)
+        seqruns = [seqrun for sample in project_obj
+                          for libprep in sample for seqrun in libprep]
+        self.assertEqual(len(seqruns), 20)
+        self.assertEqual(set(sample.status for sample in project_obj), set(["NEW"]))
+
+
+class TestQueuedUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.session = CharonSession(api_token="x", base_url="http://localhost:1",
+                                     config={"charon": {"cache_backend": "none"}})
+        self.session.put = mock.Mock(return_value=mock.Mock(text=""))
+
+    def test_updates_coalesced(self):
+        self.session.queue_seqrun_update("P1", "P1_101", "A", "run1", alignment_status="RUNNING")
+        self.session.queue_seqrun_update("P1", "P1_101", "A", "run1",
+                                         alignment_status="DONE", total_reads=100)
+        self.session.queue_sample_update("P1", "P1_101", status="DONE")
+        self.assertEqual(self.session.flush_updates(), {})
+        self.assertEqual(self.session.put.call_count, 2)
+        seqrun_data = [json.loads(args[1]) for args, kwargs in self.session.put.call_args_list
+                       if args[0].endswith("/run1")][0]
+        self.assertEqual(seqrun_data["alignment_status"], "DONE")
+        self.assertEqual(seqrun_data["total_reads"], "100")
+        # The queue is empty after a flush
+        self.assertEqual(self.session.flush_updates(), {})
+        self.assertEqual(self.session.put.call_count, 2)
+
+    def test_failures_reported(self):
+        def put(url, data, **kwargs):
+            if url.endswith("P1_102"):
+                raise CharonError("Not found", 404)
+            return mock.Mock(text="")
+        self.session.put = put
+        self.session.queue_sample_update("P1", "P1_101", status="DONE")
+        self.session.queue_sample_update("P1", "P1_102", status="DONE")
+        failures = self.session.flush_updates(max_workers=2)
+        self.assertEqual(failures.keys(), [("sample", "P1", "P1_102")])
+
+
+class TestAsyncCharonSession(unittest.TestCase):
+
+    def test_concurrent_gets(self):
+        server = MockCharonServer(latency=0.05).start()
+        try:
+            server.populate("P100", n_samples=20)
+            session = CharonSession(base_url=server.base_url,
+                                    config={"charon": {"cache_backend": "none"}})
+            start = time.time()
+            with AsyncCharonSession(session, max_workers=20) as async_session:
+                results = [async_session.sample_get("P100", "P100_{}".format(101 + i))
+                           for i in range(20)]
+                statuses = [result.get()["status"] for result in results]
+            self.assertEqual(statuses, ["NEW"] * 20)
+            # 20 requests of 50 ms each, not run one after the other
+            self.assertLess(time.time() - start, 0.8)
+            with self.assertRaises(CharonError):
+                AsyncCharonSession(session).sample_get("P100", "P100_999").get()
+        finally:
+            server.stop()
+
+    def test_connection_pool_fits_workers(self):
+        session = CharonSession(config={"charon": {"pool_maxsize": 4,
+                                                   "async_max_workers": 12}})
+        self.assertEqual(session.get_adapter(CHARON_BASE_URL)._pool_maxsize, 12)
+
+
+class TestMockCharonRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockCharonServer().start()
+        self.session = CharonSession(base_url=self.server.base_url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_create_update_delete(self):
+        self.session.project_create("P1", name="Y.Mom_14_01", status="OPEN")
+        self.session.sample_create("P1", "P1_101", status="NEW")
+        self.session.sample_update("P1", "P1_101", status="RUNNING")
+        self.assertEqual(self.session.sample_get("P1", "P1_101")["status"], "RUNNING")
+        self.assertEqual(self.session.project_get("Y.Mom_14_01")["projectid"], "P1")
+        with self.assertRaises(CharonError):
+            self.session.sample_create("P1", "P1_101")
+        self.session.project_delete("P1")
+        with self.assertRaises(CharonError):
+            self.session.sample_get("P1", "P1_101")
+
+    def test_error_injection(self):
+        self.server.error_rate, self.server.error_code = 1.0, 500
+        with self.assertRaises(CharonError) as cm:
+            CharonSession(base_url=self.server.base_url,
+                          config={"charon": {"max_retries": 1, "backoff_factor": 0}}
+                          ).project_get("P1")
+        self.assertEqual(cm.exception.status_code, 500)
+        self.assertEqual(self.server.request_stats()["requests"], 2)
+
+    def test_conditional_requests(self):
+        self.session.project_create("P1", name="Y.Mom_14_01", status="OPEN")
+        self.session.project_get("P1")
+        self.session.cache.clear()
+        # The revision is still known, so the server answers 304 with no body
+        self.assertEqual(self.session.project_get("P1")["status"], "OPEN")
+        self.assertEqual(self.server.requests[-1].status_code, 304)
+        # Someone else changes the project; the update based on the old revision is refused
+        self.server.update_document("project", ("P1",), status="CLOSED")
+        with self.assertRaises(CharonError) as cm:
+            self.session.project_update("P1", status="ABORTED")
+        self.assertEqual(cm.exception.status_code, 412)
+
+    def test_samples_iter(self):
+        self.server.populate("P1", n_samples=3, status="OPEN")
+        self.server.populate("P2", n_samples=2, status="CLOSED")
+        self.server.update_document("sample", ("P1", "P1_102"), status="DONE")
+        self.server.update_document("sample", ("P1", "P1_103"), total_autosomal_coverage=30)
+        self.assertEqual([p["projectid"] for p in self.session.projects_iter(status="OPEN")],
+                         ["P1"])
+        samples = self.session.samples_iter(status="NEW", max_workers=1)
+        self.assertEqual([s["sampleid"] for p, s in samples],
+                         ["P1_101", "P1_103", "P2_101", "P2_102"])
+        samples = self.session.samples_iter(project_filters={"status": ["OPEN"]},
+                                            status="NEW", min_coverage=28.5)
+        self.assertEqual([s["sampleid"] for p, s in samples], ["P1_103"])
+        # The status filter was sent along to the server
+        self.assertIn("/api/v1/samples/P1?status=NEW",
+                      [r.path for r in self.server.requests])
+        # Nor were the listings kept in the cache
+        self.assertIsNone(self.session.cache.get(
+                self.session._filtered_listing_url("samples", ("P1",), {"status": "NEW"})))
+
+    def test_project_index(self):
+        self.server.populate("P1", n_samples=0, project_name="Y.Mom_14_01")
+        self.session.refresh_project_index()
+        self.session.project_create("P2", name="Y.Mom_14_02")
+        self.assertEqual(self.session.project_index.get_id("Y.Mom_14_01"), "P1")
+        self.assertEqual(self.session.project_index.get_id("Y.Mom_14_02"), "P2")
+        self.session.project_delete("P2")
+        self.assertIsNone(self.session.project_index.get_id("Y.Mom_14_02"))
+
+    def test_projects_get(self):
+        self.server.populate("P1", n_samples=0, project_name="Y.Mom_14_01")
+        self.server.populate("P2", n_samples=0, project_name="Y.Mom_14_02")
+        projects = self.session.projects_get(["Y.Mom_14_01", "P2", "Y.Mom_14_99"],
+                                             max_workers=3)
+        self.assertEqual(sorted(projects), ["P2", "Y.Mom_14_01"])
+        self.assertEqual(projects["Y.Mom_14_01"]["projectid"], "P1")
+
+    def test_projects_get_errors(self):
+        self.server.populate("P1", n_samples=0, project_name="Y.Mom_14_01")
+        def project_get(projectid):
+            if projectid == "P3":
+                raise CharonError("Service unavailable", 503)
+            return CharonSession.project_get(self.session, projectid)
+        self.session.project_get = project_get
+        errors = {}
+        projects = self.session.projects_get(["P1", "P2", "P3"], errors=errors)
+        self.assertEqual(sorted(projects), ["P1"])
+        # Missing from Charon is not an error; failing to fetch it is
+        self.assertEqual(errors.keys(), ["P3"])
+        self.assertEqual(errors["P3"].status_code, 503)
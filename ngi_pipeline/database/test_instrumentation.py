@@ -0,0 +1,41 @@
+import collections
+import unittest
+
+from ngi_pipeline.database.instrumentation import CharonStats, record_request
+
+FakeResponse = collections.namedtuple("FakeResponse", ["status_code", "content"])
+
+
+class TestCharonStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = CharonStats()
+
+    def test_record_by_stage_and_endpoint(self):
+        get = record_request(lambda url, **kwargs: FakeResponse(200, "{}"), self.stats, "GET")
+        put = record_request(lambda url, **kwargs: FakeResponse(404, ""), self.stats, "PUT")
+        get("http://charon/api/v1/seqrun/P1/P1_101/A/run1")
+        with self.stats.stage("launch_analysis"):
+            get("http://charon/api/v1/seqrun/P1/P1_101/A/run2")
+            put("http://charon/api/v1/sample/P1/P1_101", '{"status": "DONE"}')
+        stats = self.stats.to_dict()
+        self.assertEqual(stats["none"]["GET seqrun"]["count"], 1)
+        self.assertEqual(stats["launch_analysis"]["GET seqrun"]["bytes_received"], 2)
+        self.assertEqual(stats["launch_analysis"]["PUT sample"]["codes"], {"404": 1})
+        self.assertEqual(stats["launch_analysis"]["PUT sample"]["bytes_sent"], 18)
+
+    def test_exceptions_recorded(self):
+        def fail(url, **kwargs):
+            raise IOError("Connection refused")
+        with self.assertRaises(IOError):
+            record_request(fail, self.stats, "GET")("http://charon/api/v1/projects")
+        self.assertEqual(self.stats.to_dict()["none"]["GET projects"]["codes"], {"IOError": 1})
+
+    def test_prometheus(self):
+        self.stats.record("GET", "http://charon/api/v1/project/P1", 200, 0.02)
+        self.stats.record("GET", "http://charon/api/v1/project/P2", 200, 3.0)
+        text = self.stats.to_prometheus()
+        labels = 'stage="none",method="GET",endpoint="project"'
+        self.assertIn('ngi_charon_requests_total{{{},code="200"}} 2'.format(labels), text)
+        self.assertIn('ngi_charon_request_duration_seconds_bucket{{{},le="0.025"}} 1'.format(labels), text)
+        self.assertIn('ngi_charon_request_duration_seconds_bucket{{{},le="+Inf"}} 2'.format(labels), text)
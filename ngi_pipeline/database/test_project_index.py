@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ngi_pipeline.database.project_index import ProjectIndex
+
+
+class TestProjectIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "index", "projects.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persists_between_instances(self):
+        ProjectIndex(self.path).update([{"projectid": "P1", "name": "Y.Mom_14_01"},
+                                        {"projectid": "P2", "name": "Y.Mom_14_02"},
+                                        {"projectid": "P3"}])
+        index = ProjectIndex(self.path)
+        self.assertEqual(index.get_id("Y.Mom_14_02"), "P2")
+        self.assertEqual(index.get_name("P1"), "Y.Mom_14_01")
+        self.assertEqual(len(index), 2)
+        self.assertFalse(index.is_stale())
+        index.remove("P2")
+        self.assertIsNone(index.get_id("Y.Mom_14_02"))
+
+    def test_refresh_replaces(self):
+        index = ProjectIndex(self.path)
+        index.update([{"projectid": "P1", "name": "Y.Mom_14_01"},
+                      {"projectid": "P2", "name": "Y.Mom_14_02"}])
+        # P1 renamed and P2 deleted in Charon since
+        index.update([{"projectid": "P1", "name": "Y.Mom_14_03"}])
+        self.assertIsNone(index.get_id("Y.Mom_14_01"))
+        self.assertIsNone(index.get_id("Y.Mom_14_02"))
+        self.assertEqual(index.get_id("Y.Mom_14_03"), "P1")
+        self.assertEqual(len(index), 1)
+
+    def test_staleness(self):
+        index = ProjectIndex(refresh_interval=0.01)
+        index.add("P1", "Y.Mom_14_01")
+        self.assertTrue(index.is_stale())
+        index.update([])
+        self.assertFalse(index.is_stale())
+        time.sleep(0.02)
+        self.assertTrue(index.is_stale())
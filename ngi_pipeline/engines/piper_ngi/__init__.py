@@ -9,16 +9,19 @@ import shutil
 import subprocess
 import time
 
+from multiprocessing.pool import ThreadPool
+
 from ngi_pipeline.engines.piper_ngi import workflows
 from ngi_pipeline.engines.piper_ngi.utils import create_log_file_path, create_exit_code_file_path
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonError, get_charon_session
 from ngi_pipeline.log.loggers import log_process_non_blocking, minimal_logger
 from ngi_pipeline.engines.piper_ngi.local_process_tracking import is_seqrun_analysis_running_local, \
                                                           is_sample_analysis_running_local, \
                                                           record_process_seqrun, \
                                                           record_process_sample
 from ngi_pipeline.utils.filesystem import load_modules, execute_command_line, rotate_log, safe_makedir
-from ngi_pipeline.utils.classes import with_ngi_config
+from ngi_pipeline.utils.classes import resource_limited, with_ngi_config
+from ngi_pipeline.utils.slurm import create_sbatch_file, submit_sbatch
 from ngi_pipeline.utils.parsers import parse_lane_from_filename, find_fastq_read_pairs_from_dir, \
                                        get_flowcell_id_from_dirtree
 
@@ -51,54 +54,161 @@ def analyze_seqrun(project, sample, libprep, seqrun, config=None, config_file_pa
     :seqrun NGISeqrun seqrun: The sequencing run to analyzed
     :param dict config: The parsed configuration file (optional)
     :param str config_file_path: The path to the configuration file (optional)
+
+    :returns: The seqrun as a (project, sample, libprep, seqrun) tuple if its
+              analysis was launched or is already running; empty if it failed
+    :rtype: list
     """
+    return analyze_seqruns([(project, sample, libprep, seqrun)], config=config)
+
+
+@with_ngi_config
+def analyze_seqruns(seqruns, config=None, config_file_path=None):
+    """Analyze several sequencing runs (e.g. all those of a flowcell). With
+    piper.launch_method "slurm" in the config they are submitted as one
+    SLURM array job per workflow subtask; otherwise each is run locally.
 
+    :param list seqruns: (project, sample, libprep, seqrun) tuples
+    :param dict config: The parsed configuration file (optional)
+    :param str config_file_path: The path to the configuration file (optional)
+
+    :returns: The seqruns whose analysis was launched, submitted or is already
+              running; those that failed are left out
+    :rtype: list
+    """
     modules_to_load = ["java/sun_jdk1.7.0_25", "R/2.15.0"]
     load_modules(modules_to_load)
+    use_slurm = config.get("piper", {}).get("launch_method", "local") == "slurm"
+    def prepare_seqrun(seqrun_tuple, workflow_subtask):
+        """Launch the seqrun analysis locally, or prepare its SLURM job.
+        Returns the seqrun and its SLURM job (None if it was launched locally
+        or is already running), or None if it failed."""
+        project, sample, libprep, seqrun = seqrun_tuple
+        if is_seqrun_analysis_running_local(workflow_subtask=workflow_subtask,
+                                            project_id=project.project_id,
+                                            sample_id=sample.name,
+                                            libprep_id=libprep.name,
+                                            seqrun_id=seqrun.name):
+            return seqrun_tuple, None
+        try:
+            ## Temporarily logging to a file until we get ELK set up
+            log_file_path = create_log_file_path(workflow_subtask=workflow_subtask,
+                                                 project_base_path=project.base_path,
+                                                 project_name=project.name,
+                                                 sample_id=sample.name,
+                                                 libprep_id=libprep.name,
+                                                 seqrun_id=seqrun.name)
+            rotate_log(log_file_path)
+            # Store the exit code of detached processes
+            exit_code_path = create_exit_code_file_path(workflow_subtask=workflow_subtask,
+                                                        project_base_path=project.base_path,
+                                                        project_name=project.name,
+                                                        sample_id=sample.name,
+                                                        libprep_id=libprep.name,
+                                                        seqrun_id=seqrun.name)
+            setup_xml_path = build_setup_xml(project, config, sample,
+                                             libprep.name, seqrun.name)
+            command_line = build_piper_cl(project, workflow_subtask, setup_xml_path,
+                                          exit_code_path, config)
+            if use_slurm:
+                return seqrun_tuple, (seqrun_tuple, command_line, log_file_path)
+            p_handle = launch_piper_job(command_line, project, log_file_path)
+            try:
+                record_process_seqrun(project=project, sample=sample, libprep=libprep,
+                                      seqrun=seqrun, workflow_subtask=workflow_subtask,
+                                      analysis_module_name="piper_ngi",
+                                      analysis_dir=project.analysis_dir,
+                                      pid=p_handle.pid)
+            except CharonError as e:
+                ## This is a problem. If the job isn't recorded, we won't
+                ## ever know that it has been run and its results will be ignored.
+                ## I think? Or no I guess if it's relaunched then the results will be there.
+                ## But we will have multiple processes running.
+                ## FIXME fix this
+                LOG.error("<Could not record ...>")
+            return seqrun_tuple, None
+        except (NotImplementedError, RuntimeError) as e:
+            error_msg = ('Processing project "{}" / sample "{}" / libprep "{}" / '
+                         'seqrun "{}" failed: {}'.format(project, sample, libprep, seqrun,
+                                                       e.__repr__()))
+            LOG.error(error_msg)
+            return None
+    max_workers = int(config.get("analysis", {}).get("launch_workers", 1))
+    # Only the seqruns launched for every subtask count as launched
+    launched = list(seqruns)
     for workflow_subtask in get_subtasks_for_level(level="seqrun"):
-        if not is_seqrun_analysis_running_local(workflow_subtask=workflow_subtask,
-                                                project_id=project.project_id,
-                                                sample_id=sample.name,
-                                                libprep_id=libprep.name,
-                                                seqrun_id=seqrun.name):
+        prepare = lambda seqrun_tuple: prepare_seqrun(seqrun_tuple, workflow_subtask)
+        # The setup.xml files are built concurrently, as when the seqruns are
+        # launched one by one
+        if max_workers > 1 and len(seqruns) > 1:
+            pool = ThreadPool(min(max_workers, len(seqruns)))
             try:
-                ## Temporarily logging to a file until we get ELK set up
-                log_file_path = create_log_file_path(workflow_subtask=workflow_subtask,
-                                                     project_base_path=project.base_path,
-                                                     project_name=project.name,
-                                                     sample_id=sample.name,
-                                                     libprep_id=libprep.name,
-                                                     seqrun_id=seqrun.name)
-                rotate_log(log_file_path)
-                # Store the exit code of detached processes
-                exit_code_path = create_exit_code_file_path(workflow_subtask=workflow_subtask,
-                                                            project_base_path=project.base_path,
-                                                            project_name=project.name,
-                                                            sample_id=sample.name,
-                                                            libprep_id=libprep.name,
-                                                            seqrun_id=seqrun.name)
-                build_setup_xml(project, config, sample, libprep.name, seqrun.name)
-                command_line = build_piper_cl(project, workflow_subtask, exit_code_path, config)
-                p_handle = launch_piper_job(command_line, project, log_file_path)
-                try:
-                    record_process_seqrun(project=project, sample=sample, libprep=libprep,
-                                          seqrun=seqrun, workflow_subtask=workflow_subtask,
-                                          analysis_module_name="piper_ngi",
-                                          analysis_dir=project.analysis_dir,
-                                          pid=p_handle.pid)
-                except CharonError as e:
-                    ## This is a problem. If the job isn't recorded, we won't
-                    ## ever know that it has been run and its results will be ignored.
-                    ## I think? Or no I guess if it's relaunched then the results will be there.
-                    ## But we will have multiple processes running.
-                    ## FIXME fix this
-                    LOG.error("<Could not record ...>")
-                    continue
-            except (NotImplementedError, RuntimeError) as e:
-                error_msg = ('Processing project "{}" / sample "{}" / libprep "{}" / '
-                             'seqrun "{}" failed: {}'.format(project, sample, libprep, seqrun,
-                                                           e.__repr__()))
-                LOG.error(error_msg)
+                prepared = pool.map(prepare, seqruns)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            prepared = map(prepare, seqruns)
+        prepared = filter(None, prepared)
+        subtask_launched = [seqrun_tuple for seqrun_tuple, job in prepared if not job]
+        jobs = [job for _, job in prepared if job]
+        if jobs:
+            subtask_launched.extend(submit_piper_jobs_slurm(jobs, workflow_subtask, config))
+        launched = [seqrun_tuple for seqrun_tuple in launched
+                    if seqrun_tuple in subtask_launched]
+    return launched
+
+
+def _get_slurm_config(config):
+    """The sbatch parameters of the Piper jobs: the slurm section of the config,
+    charged to environment.project_id unless it names an account."""
+    slurm_config = {"account": config.get("environment", {}).get("project_id"),
+                    "extra_parameters": config.get("environment", {}).get("extra_slurm_params")}
+    slurm_config.update(config.get("slurm") or {})
+    return slurm_config
+
+
+def submit_piper_jobs_slurm(jobs, workflow_subtask, config):
+    """Submit the Piper command lines of several seqruns to SLURM as one
+    array job and record the job id of each task.
+
+    :param list jobs: ((project, sample, libprep, seqrun), command line, log file path) tuples
+    :param str workflow_subtask: The workflow the command lines run (e.g. "dna_alignonly")
+    :param dict config: The parsed configuration file
+
+    :returns: The (project, sample, libprep, seqrun) tuples submitted; empty
+              if the submission failed
+    :rtype: list
+    """
+    (project, _, _, seqrun), _, _ = jobs[0]
+    sbatch_dir = os.path.join(project.base_path, "ANALYSIS", "sbatch")
+    safe_makedir(sbatch_dir, 0770)
+    job_name = "piper_{}_{}".format(workflow_subtask, seqrun.name)
+    try:
+        sbatch_path = create_sbatch_file(os.path.join(sbatch_dir, job_name + ".sbatch"),
+                                         job_name,
+                                         [command_line for _, command_line, _ in jobs],
+                                         log_paths=[log_file_path for _, _, log_file_path in jobs],
+                                         cwds=[os.path.join(job_project.base_path, "ANALYSIS",
+                                                            job_project.dirname)
+                                               for (job_project, _, _, _), _, _ in jobs],
+                                         slurm_config=_get_slurm_config(config))
+        job_id = submit_sbatch(sbatch_path)
+    except (ValueError, RuntimeError) as e:
+        LOG.error('Could not submit {} "{}" jobs to SLURM: {}'.format(len(jobs),
+                                                                     workflow_subtask, e))
+        return []
+    for task_index, ((project, sample, libprep, seqrun), _, _) in enumerate(jobs):
+        try:
+            record_process_seqrun(project=project, sample=sample, libprep=libprep,
+                                  seqrun=seqrun, workflow_subtask=workflow_subtask,
+                                  analysis_module_name="piper_ngi",
+                                  analysis_dir=project.analysis_dir, pid=None,
+                                  slurm_job_id=("{}_{}".format(job_id, task_index)
+                                                if len(jobs) > 1 else job_id))
+        except RuntimeError as e:
+            LOG.error(e)
+    return [seqrun_tuple for seqrun_tuple, _, _ in jobs]
 
 @with_ngi_config
 def analyze_sample(project, sample, config=None, config_file_path=None):
@@ -111,7 +221,7 @@ def analyze_sample(project, sample, config=None, config_file_path=None):
     """
     modules_to_load = ["java/sun_jdk1.7.0_25", "R/2.15.0"]
     load_modules(modules_to_load)
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
     # Determine if we can begin sample-level processing yet.
     # Conditions are that the coverage is above 28.9X
     # If these conditions become more complex we can create a function for this
@@ -136,19 +246,33 @@ def analyze_sample(project, sample, config=None, config_file_path=None):
                                                                 project_name=project.name,
                                                                 sample_id=sample.name)
 
-                    build_setup_xml(project, config, sample)
-                    command_line = build_piper_cl(project, workflow_subtask, exit_code_path, config)
-                    p_handle = launch_piper_job(command_line, project, log_file_path)
+                    setup_xml_path = build_setup_xml(project, config, sample)
+                    command_line = build_piper_cl(project, workflow_subtask, setup_xml_path,
+                                                  exit_code_path, config)
+                    if config.get("piper", {}).get("launch_method", "local") == "slurm":
+                        sbatch_dir = os.path.join(project.base_path, "ANALYSIS", "sbatch")
+                        safe_makedir(sbatch_dir, 0770)
+                        job_name = "piper_{}_{}".format(workflow_subtask, sample.name)
+                        sbatch_path = create_sbatch_file(os.path.join(sbatch_dir,
+                                                                      job_name + ".sbatch"),
+                                                         job_name, [command_line],
+                                                         log_paths=[log_file_path],
+                                                         cwds=[project.analysis_dir],
+                                                         slurm_config=_get_slurm_config(config))
+                        pid, slurm_job_id = None, submit_sbatch(sbatch_path)
+                    else:
+                        pid = launch_piper_job(command_line, project, log_file_path).pid
+                        slurm_job_id = None
                     try:
                         record_process_sample(project=project, sample=sample,
                                               workflow_subtask=workflow_subtask,
                                               analysis_module_name="piper_ngi",
                                               analysis_dir=project.analysis_dir,
-                                              pid=p_handle.pid)
+                                              pid=pid, slurm_job_id=slurm_job_id)
                     except RuntimeError as e:
                         LOG.error(e)
                         continue
-                except (NotImplementedError, RuntimeError) as e:
+                except (NotImplementedError, RuntimeError, ValueError) as e:
                     error_msg = ('Processing project "{}" / sample "{}" failed: '
                                  '{}'.format(project, sample, e.__repr__()))
                     LOG.error(error_msg)
@@ -157,6 +281,7 @@ def analyze_sample(project, sample, config=None, config_file_path=None):
                  'processing.'.format(sample, project))
 
 
+@resource_limited("piper")
 def launch_piper_job(command_line, project, log_file_path=None):
     """Launch the Piper command line.
 
@@ -184,10 +309,11 @@ def launch_piper_job(command_line, project, log_file_path=None):
     return popen_object
 
 
-def build_piper_cl(project, workflow_name, exit_code_path, config):
+def build_piper_cl(project, workflow_name, setup_xml_path, exit_code_path, config):
     """Determine which workflow to run for a project and build the appropriate command line.
     :param NGIProject project: The project object to analyze.
     :param str workflow_name: The name of the workflow to execute (e.g. "dna_alignonly")
+    :param str setup_xml_path: The setup.xml file made by build_setup_xml
     :param str exit_code_path: The path to the file to which the exit code for this cl will be written
     :param dict config: The (parsed) configuration file for this machine/environment.
 
@@ -225,9 +351,7 @@ def build_piper_cl(project, workflow_name, exit_code_path, config):
              'project "{}" / workflow "{}"'.format(project, workflow_name))
     ## NOTE This key will probably exist on the project level, and may have multiple values.
     ##      Workflows may imply a number of substeps (e.g. basic = qc, alignment, etc.) ?
-    try:
-        setup_xml_path = project.setup_xml_path
-    except AttributeError:
+    if not setup_xml_path:
         error_msg = ('Project "{}" has no setup.xml file. Skipping project '
                      'command-line generation.'.format(project))
         raise ValueError(error_msg)
@@ -261,8 +385,8 @@ def build_setup_xml(project, config, sample=None, libprep_id=None, seqrun_id=Non
     :param str library_id: id of the library
     :param str seqrun_id: flowcell identifier
 
-    :returns: A list of Project objects with setup.xml paths as attributes.
-    :rtype: list
+    :returns: The path to the setup.xml file
+    :rtype: str
     """
 
     if not seqrun_id:
@@ -346,12 +470,20 @@ def build_setup_xml(project, config, sample=None, libprep_id=None, seqrun_id=Non
             setupfilecreator_cl += " --input_fastq {}".format(fastq_file)
 
     try:
-        LOG.info("Executing command line: {}".format(setupfilecreator_cl))
-        subprocess.check_call(shlex.split(setupfilecreator_cl))
-        project.setup_xml_path = output_xml_filepath
+        run_setupfilecreator(setupfilecreator_cl)
+        # The same for every sample of the project; the setup.xml file is
+        # returned rather than set on the project, which may be shared by
+        # analyses being launched at the same time
         project.analysis_dir   = analysis_dir
     except (subprocess.CalledProcessError, OSError, ValueError) as e:
         error_msg = ("Unable to produce setup XML file for project {}; "
                      "skipping project analysis. "
                      "Error is: \"{}\". .".format(project, e))
         raise RuntimeError(error_msg)
+    return output_xml_filepath
+
+
+@resource_limited("setupfilecreator")
+def run_setupfilecreator(setupfilecreator_cl):
+    LOG.info("Executing command line: {}".format(setupfilecreator_cl))
+    subprocess.check_call(shlex.split(setupfilecreator_cl))
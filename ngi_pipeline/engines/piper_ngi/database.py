@@ -6,7 +6,7 @@ import contextlib
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.utils.classes import with_ngi_config
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -17,6 +17,8 @@ LOG = minimal_logger(__name__)
 # Declare the base class
 Base = declarative_base()
 Session = sessionmaker()
+# The databases whose schema has been checked since startup
+_upgraded_databases = set()
 
 
 @contextlib.contextmanager
@@ -35,6 +37,9 @@ def get_db_session(database_path=None, config=None, config_file_path=None):
         LOG.debug('Local job tracking database at "{}" already exists; '
                   'connecting.'.format(database_abspath))
         engine = _init_engine(database_abspath)
+        if database_abspath not in _upgraded_databases:
+            _upgrade_schema(engine)
+            _upgraded_databases.add(database_abspath)
     # Bind the Session to the engine
     Session.configure(bind=engine)
     # Instantiate
@@ -52,6 +57,49 @@ def _init_engine(database_path):
     #return create_engine('sqlite:///:memory:', echo=True)
 
 
+def _upgrade_schema(engine):
+    """Add the tables and columns introduced since the database was created,
+    and rebuild the tables whose primary key has changed."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            Base.metadata.create_all(engine, tables=[table])
+            continue
+        existing_columns = set(column["name"] for column in inspector.get_columns(table.name))
+        existing_key = inspector.get_pk_constraint(table.name).get("constrained_columns") or []
+        if set(existing_key) != set(column.name for column in table.primary_key):
+            _rebuild_table(engine, table, existing_columns)
+            continue
+        for column in table.columns:
+            if column.name not in existing_columns:
+                LOG.info('Adding column "{}" to table "{}" of the local job tracking '
+                         'database'.format(column.name, table.name))
+                engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                                    table.name, column.name,
+                                    column.type.compile(dialect=engine.dialect)))
+
+
+def _rebuild_table(engine, table, existing_columns):
+    """Recreate a table with the current schema, keeping the rows and the
+    columns they have in common; sqlite cannot change the primary key of
+    an existing table."""
+    LOG.info('Rebuilding table "{}" of the local job tracking database'.format(table.name))
+    old_name = "{}_old".format(table.name)
+    columns = ", ".join(column.name for column in table.columns
+                        if column.name in existing_columns)
+    with engine.begin() as connection:
+        connection.execute("ALTER TABLE {} RENAME TO {}".format(table.name, old_name))
+        table.create(connection)
+        connection.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(table.name, columns,
+                                                                       columns, old_name))
+        connection.execute("DROP TABLE {}".format(old_name))
+        if "process_id" in existing_columns and "slurm_job_id" in existing_columns:
+            # The process ids of SLURM jobs were made up by sqlite
+            connection.execute("UPDATE {} SET process_id = NULL WHERE slurm_job_id "
+                               "IS NOT NULL".format(table.name))
+
+
 def create_database_populate_schema(location):
     """Create the database and populate it with the schema."""
     engine = _init_engine(location)
@@ -76,6 +124,7 @@ def create_database_populate_schema(location):
 class SeqrunAnalysis(Base):
     __tablename__ = 'seqrunanalysis'
 
+    id = Column(Integer, primary_key=True)
     project_id = Column(String(50))
     project_name = Column(String(50))
     project_base_path = Column(String(100))
@@ -88,7 +137,9 @@ class SeqrunAnalysis(Base):
     workflow = Column(String(50))
     engine = Column(String(50))
     analysis_dir = Column(String(100))
-    process_id = Column(Integer, primary_key=True, unique=True)
+    process_id = Column(Integer, unique=True)
+    # Set instead of the process id for jobs submitted to SLURM
+    slurm_job_id = Column(String(50))
 
 
     def __repr__(self):
@@ -115,6 +166,8 @@ class SampleAnalysis(Base):
     engine = Column(String(50))
     analysis_dir = Column(String(100))
     process_id = Column(Integer, unique=True)
+    # Set instead of the process id for jobs submitted to SLURM
+    slurm_job_id = Column(String(50))
     ## Could introduce a ForeignKey to seqrun analyses here
     #seqruns = relationship("SeqrunAnalysis", order_by="SeqrunAnalysis.process_id", backref="sampleanalysis")
 
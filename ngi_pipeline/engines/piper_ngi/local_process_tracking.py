@@ -1,13 +1,19 @@
+import collections
 import glob
 import os
 import psutil
 import re
+import sqlalchemy
+import sqlalchemy.exc
 import time
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import AsyncCharonSession, CharonError, \
+                                          get_charon_session
+from ngi_pipeline.database.instrumentation import charon_stage
 from ngi_pipeline.log.loggers import minimal_logger
 from ngi_pipeline.engines.piper_ngi.database import SeqrunAnalysis, SampleAnalysis, get_db_session
 from ngi_pipeline.engines.piper_ngi.utils import create_exit_code_file_path
+from ngi_pipeline.utils.slurm import get_queued_slurm_jobs
 from ngi_pipeline.utils.parsers import parse_qualimap_results, \
                                        STHLM_UUSNP_SEQRUN_RE, \
                                        STHLM_UUSNP_SAMPLE_RE
@@ -16,174 +22,217 @@ from ngi_pipeline.utils.parsers import parse_qualimap_results, \
 LOG = minimal_logger(__name__)
 
 
+@charon_stage("update_jobs_status")
 def update_charon_with_local_jobs_status():
     """Check the status of all locally-tracked jobs and update Charon accordingly.
+
+    The Charon status of the running jobs is fetched concurrently, the Charon
+    updates are queued and sent together at the end, and the local entry for
+    a finished job is only deleted if its update went through. Jobs submitted
+    to SLURM are looked up in a single listing of the queue.
     """
     LOG.info("Updating Charon with the status of all locally-tracked jobs...")
     with get_db_session() as session:
-        charon_session = CharonSession()
-
-        # Sequencing Run Analyses
-        for seqrun_entry in session.query(SeqrunAnalysis).all():
-
-            # Local names
-            workflow = seqrun_entry.workflow
-            project_name = seqrun_entry.project_name
-            project_id = seqrun_entry.project_id
-            project_base_path = seqrun_entry.project_base_path
-            sample_id = seqrun_entry.sample_id
-            libprep_id = seqrun_entry.libprep_id
-            seqrun_id = seqrun_entry.seqrun_id
-            pid = seqrun_entry.process_id
-
-            exit_code = get_exit_code(workflow_name=workflow,
-                                      project_base_path=project_base_path,
-                                      project_name=project_name,
-                                      sample_id=sample_id,
-                                      libprep_id=libprep_id,
-                                      seqrun_id=seqrun_id)
-            label = "project/sample/libprep/seqrun {}/{}/{}/{}".format(project_name,
-                                                                       sample_id,
-                                                                       libprep_id,
-                                                                       seqrun_id)
-            try:
-                if exit_code == 0:
-                    # 0 -> Job finished successfully
-                    LOG.info('Workflow "{}" for {} finished succesfully. '
-                             'Recording status "DONE" in Charon'.format(workflow, label))
-                    set_alignment_status = "DONE"
-                    try:
-                        write_to_charon_alignment_results(base_path=project_base_path,
-                                                          project_name=project_name,
-                                                          project_id=project_id,
-                                                          sample_id=sample_id,
-                                                          libprep_id=libprep_id,
-                                                          seqrun_id=seqrun_id)
-                    except (RuntimeError, ValueError) as e:
-                        LOG.error(e)
-                        set_alignment_status = "FAILED"
-                    charon_session.seqrun_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 libprepid=libprep_id,
-                                                 seqrunid=seqrun_id,
-                                                 alignment_status=set_alignment_status)
-                    # Job is only deleted if the Charon update succeeds
-                    session.delete(seqrun_entry)
-                elif exit_code == 1 or (not psutil.pid_exists(pid) and not exit_code):
-                    if exit_code == 1:
-                        # 1 -> Job failed (DATA_FAILURE / COMPUTATION_FAILURE ?)
-                        LOG.info('Workflow "{}" for {} failed. Recording status '
-                                 '"FAILED" in Charon.'.format(workflow, label))
+        charon_session = get_charon_session()
+        async_session = AsyncCharonSession(charon_session)
+        try:
+            queued_slurm_jobs = _get_queued_slurm_jobs(session)
+            # The local entries to delete once Charon has been updated, as
+            # [(charon_update_key, db_entry, label), ...]
+            finished_entries = []
+            # The pending Charon status requests of the running jobs, as
+            # [(async_result, charon_update_key, label), ...]
+            running_seqruns, running_samples = [], []
+
+            # Sequencing Run Analyses
+            for seqrun_entry in session.query(SeqrunAnalysis).all():
+
+                # Local names
+                workflow = seqrun_entry.workflow
+                project_name = seqrun_entry.project_name
+                project_id = seqrun_entry.project_id
+                project_base_path = seqrun_entry.project_base_path
+                sample_id = seqrun_entry.sample_id
+                libprep_id = seqrun_entry.libprep_id
+                seqrun_id = seqrun_entry.seqrun_id
+                job = _describe_job(seqrun_entry)
+
+                exit_code = get_exit_code(workflow_name=workflow,
+                                          project_base_path=project_base_path,
+                                          project_name=project_name,
+                                          sample_id=sample_id,
+                                          libprep_id=libprep_id,
+                                          seqrun_id=seqrun_id)
+                label = "project/sample/libprep/seqrun {}/{}/{}/{}".format(project_name,
+                                                                           sample_id,
+                                                                           libprep_id,
+                                                                           seqrun_id)
+                seqrun_key = ("seqrun", project_id, sample_id, libprep_id, seqrun_id)
+                try:
+                    if exit_code == 0:
+                        # 0 -> Job finished successfully
+                        LOG.info('Workflow "{}" for {} finished succesfully. '
+                                 'Recording status "DONE" in Charon'.format(workflow, label))
+                        set_alignment_status = "DONE"
+                        try:
+                            # Queued with the status below and sent as one update
+                            write_to_charon_alignment_results(base_path=project_base_path,
+                                                              project_name=project_name,
+                                                              project_id=project_id,
+                                                              sample_id=sample_id,
+                                                              libprep_id=libprep_id,
+                                                              seqrun_id=seqrun_id,
+                                                              deferred=True)
+                        except (RuntimeError, ValueError) as e:
+                            LOG.error(e)
+                            set_alignment_status = "FAILED"
+                        charon_session.queue_seqrun_update(projectid=project_id,
+                                                           sampleid=sample_id,
+                                                           libprepid=libprep_id,
+                                                           seqrunid=seqrun_id,
+                                                           alignment_status=set_alignment_status)
+                        # Job is only deleted if the Charon update succeeds
+                        finished_entries.append((seqrun_key, seqrun_entry, label))
+                    elif exit_code == 1 or (not exit_code and
+                                            _is_job_alive(seqrun_entry, queued_slurm_jobs) is False):
+                        if exit_code == 1:
+                            # 1 -> Job failed (DATA_FAILURE / COMPUTATION_FAILURE ?)
+                            LOG.info('Workflow "{}" for {} failed. Recording status '
+                                     '"FAILED" in Charon.'.format(workflow, label))
+                        else:
+                            # Job failed without writing an exit code (process no longer running)
+                            LOG.error('ERROR: No exit code found for process {} '
+                                      'but it does not appear to be running '
+                                      '({} does not exist). Setting status to '
+                                      '"FAILED", inspect manually'.format(label, job))
+                        charon_session.queue_seqrun_update(projectid=project_id,
+                                                           sampleid=sample_id,
+                                                           libprepid=libprep_id,
+                                                           seqrunid=seqrun_id,
+                                                           alignment_status="FAILED")
+                        # Job is only deleted if the Charon update succeeds
+                        finished_entries.append((seqrun_key, seqrun_entry, label))
                     else:
-                        # Job failed without writing an exit code (process no longer running)
-                        LOG.error('ERROR: No exit code found for process {} '
-                                  'but it does not appear to be running '
-                                  '(pid {} does not exist). Setting status to '
-                                  '"FAILED", inspect manually'.format(label, pid))
-                    charon_session.seqrun_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 libprepid=libprep_id,
-                                                 seqrunid=seqrun_id,
-                                                 alignment_status="FAILED")
-                    # Job is only deleted if the Charon update succeeds
-                    LOG.debug("Deleting local entry {}".format(seqrun_entry))
-                    session.delete(seqrun_entry)
-                else:
-                    # None -> Job still running
-                    charon_status = charon_session.seqrun_get(projectid=project_id,
-                                                              sampleid=sample_id,
-                                                              libprepid=libprep_id,
-                                                              seqrunid=seqrun_id)['alignment_status']
-                    if not charon_status == "RUNNING":
-                        LOG.warn('Tracking inconsistency for {}: Charon status is "{}" but '
-                                 'local process tracking database indicates it is running. '
-                                 'Setting value in Charon to RUNNING.'.format(label, charon_status))
-                        charon_session.seqrun_update(projectid=project_id,
-                                                     sampleid=sample_id,
-                                                     libprepid=libprep_id,
-                                                     seqrunid=seqrun_id,
-                                                     alignment_status="RUNNING")
-            except CharonError as e:
-                LOG.error('Unable to update Charon status for "{}": {}'.format(label, e))
-
-
-        for sample_entry in session.query(SampleAnalysis).all():
-
-            # Local names
-            workflow = sample_entry.workflow
-            project_name = sample_entry.project_name
-            project_id = sample_entry.project_id
-            project_base_path = sample_entry.project_base_path
-            sample_id = sample_entry.sample_id
-            pid = sample_entry.process_id
-
-            exit_code = get_exit_code(workflow_name=workflow,
-                                      project_base_path=project_base_path,
-                                      project_name=project_name,
-                                      sample_id=sample_id)
-            label = "project/sample/libprep/seqrun {}/{}".format(project_name,
-                                                                       sample_id)
-            try:
-                if exit_code == 0:
-                    # 0 -> Job finished successfully
-                    LOG.info('Workflow "{}" for {} finished succesfully. '
-                             'Recording status "DONE" in Charon'.format(workflow, label))
-                    set_status = "DONE"
-                    ## TODO implement sample-level analysis results parsing / reporting to Charon?
-                    #try:
-                    #    write_to_charon_alignment_results(base_path=project_base_path,
-                    #                                      project_name=project_name,
-                    #                                      project_id=project_id,
-                    #                                      sample_id=sample_id,
-                    #                                      libprep_id=libprep_id,
-                    #                                      seqrun_id=seqrun_id)
-                    #except (RuntimeError, ValueError) as e:
-                    #    LOG.error(e)
-                    #    set_alignment_status = "FAILED"
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 status=set_status)
-                    # Job is only deleted if the Charon update succeeds
-                    session.delete(sample_entry)
-                elif exit_code == 1 or (not psutil.pid_exists(pid) and not exit_code):
-                    if exit_code == 1:
-                        # 1 -> Job failed (DATA_FAILURE / COMPUTATION_FAILURE ?)
-                        LOG.info('Workflow "{}" for {} failed. Recording status '
-                                 '"COMPUTATION_FAILED" in Charon.'.format(workflow, label))
+                        # None -> Job still running; its Charon status is checked below
+                        running_seqruns.append((async_session.seqrun_get(projectid=project_id,
+                                                                         sampleid=sample_id,
+                                                                         libprepid=libprep_id,
+                                                                         seqrunid=seqrun_id),
+                                                seqrun_key, label))
+                except CharonError as e:
+                    LOG.error('Unable to update Charon status for "{}": {}'.format(label, e))
+
+
+            for sample_entry in session.query(SampleAnalysis).all():
+
+                # Local names
+                workflow = sample_entry.workflow
+                project_name = sample_entry.project_name
+                project_id = sample_entry.project_id
+                project_base_path = sample_entry.project_base_path
+                sample_id = sample_entry.sample_id
+                job = _describe_job(sample_entry)
+
+                exit_code = get_exit_code(workflow_name=workflow,
+                                          project_base_path=project_base_path,
+                                          project_name=project_name,
+                                          sample_id=sample_id)
+                label = "project/sample/libprep/seqrun {}/{}".format(project_name,
+                                                                           sample_id)
+                sample_key = ("sample", project_id, sample_id)
+                try:
+                    if exit_code == 0:
+                        # 0 -> Job finished successfully
+                        LOG.info('Workflow "{}" for {} finished succesfully. '
+                                 'Recording status "DONE" in Charon'.format(workflow, label))
+                        set_status = "DONE"
+                        ## TODO implement sample-level analysis results parsing / reporting to Charon?
+                        #try:
+                        #    write_to_charon_alignment_results(base_path=project_base_path,
+                        #                                      project_name=project_name,
+                        #                                      project_id=project_id,
+                        #                                      sample_id=sample_id,
+                        #                                      libprep_id=libprep_id,
+                        #                                      seqrun_id=seqrun_id)
+                        #except (RuntimeError, ValueError) as e:
+                        #    LOG.error(e)
+                        #    set_alignment_status = "FAILED"
+                        charon_session.queue_sample_update(projectid=project_id,
+                                                           sampleid=sample_id,
+                                                           status=set_status)
+                        # Job is only deleted if the Charon update succeeds
+                        finished_entries.append((sample_key, sample_entry, label))
+                    elif exit_code == 1 or (not exit_code and
+                                            _is_job_alive(sample_entry, queued_slurm_jobs) is False):
+                        if exit_code == 1:
+                            # 1 -> Job failed (DATA_FAILURE / COMPUTATION_FAILURE ?)
+                            LOG.info('Workflow "{}" for {} failed. Recording status '
+                                     '"COMPUTATION_FAILED" in Charon.'.format(workflow, label))
+                        else:
+                            # Job failed without writing an exit code
+                            LOG.error('ERROR: No exit code found for process {} '
+                                      'but it does not appear to be running '
+                                      '({} does not exist). Setting status to '
+                                      '"COMPUTATION_FAILED", inspect manually'.format(label, job))
+                        charon_session.queue_sample_update(projectid=project_id,
+                                                           sampleid=sample_id,
+                                                           status="COMPUTATION_FAILED")
+                        # Job is only deleted if the Charon update succeeds
+                        finished_entries.append((sample_key, sample_entry, label))
                     else:
-                        # Job failed without writing an exit code
-                        LOG.error('ERROR: No exit code found for process {} '
-                                  'but it does not appear to be running '
-                                  '(pid {} does not exist). Setting status to '
-                                  '"COMPUTATION_FAILED", inspect manually'.format(label, pid))
-                    charon_session.sample_update(projectid=project_id,
-                                                 sampleid=sample_id,
-                                                 status="COMPUTATION_FAILED")
-                    # Job is only deleted if the Charon update succeeds
-                    session.delete(sample_entry)
-                else:
-                    # None -> Job still running
-                    try:
-                        charon_status = charon_session.sample_get(projectid=project_id,
-                                                              sampleid=sample_id)['status']
-                    except (CharonError, KeyError) as e:
-                        LOG.warn('Unable to get required information from Charon for '
-                          'sample "{}" / project "{}" -- forcing it to RUNNING: {}'.format(sample_id, project_id, e))
-                        charon_status = "NEW"
-
-                    if not charon_status == "RUNNING":
-                        LOG.warn('Tracking inconsistency for {}: Charon status is "{}" but '
-                                 'local process tracking database indicates it is running. '
-                                 'Setting value in Charon to RUNNING.'.format(label, charon_status))
-                        charon_session.sample_update(projectid=project_id,
-                                                     sampleid=sample_id,
-                                                     status="RUNNING")
-            except CharonError as e:
-                LOG.error('Unable to update Charon status for "{}": {}'.format(label, e))
+                        # None -> Job still running; its Charon status is checked below
+                        running_samples.append((async_session.sample_get(projectid=project_id,
+                                                                         sampleid=sample_id),
+                                                sample_key, label))
+                except CharonError as e:
+                    LOG.error('Unable to update Charon status for "{}": {}'.format(label, e))
+
+            for charon_result, (_, project_id, sample_id, libprep_id, seqrun_id), label in running_seqruns:
+                try:
+                    charon_status = charon_result.get()['alignment_status']
+                except CharonError as e:
+                    LOG.error('Unable to update Charon status for "{}": {}'.format(label, e))
+                    continue
+                if not charon_status == "RUNNING":
+                    LOG.warn('Tracking inconsistency for {}: Charon status is "{}" but '
+                             'local process tracking database indicates it is running. '
+                             'Setting value in Charon to RUNNING.'.format(label, charon_status))
+                    charon_session.queue_seqrun_update(projectid=project_id,
+                                                       sampleid=sample_id,
+                                                       libprepid=libprep_id,
+                                                       seqrunid=seqrun_id,
+                                                       alignment_status="RUNNING")
+            for charon_result, (_, project_id, sample_id), label in running_samples:
+                try:
+                    charon_status = charon_result.get()['status']
+                except (CharonError, KeyError) as e:
+                    LOG.warn('Unable to get required information from Charon for '
+                      'sample "{}" / project "{}" -- forcing it to RUNNING: {}'.format(sample_id, project_id, e))
+                    charon_status = "NEW"
+                if not charon_status == "RUNNING":
+                    LOG.warn('Tracking inconsistency for {}: Charon status is "{}" but '
+                             'local process tracking database indicates it is running. '
+                             'Setting value in Charon to RUNNING.'.format(label, charon_status))
+                    charon_session.queue_sample_update(projectid=project_id,
+                                                       sampleid=sample_id,
+                                                       status="RUNNING")
+        finally:
+            # Waits for the outstanding requests, if any
+            async_session.close()
+
+        failed_updates = charon_session.flush_updates()
+        for update_key, db_entry, label in finished_entries:
+            if update_key in failed_updates:
+                LOG.error('Unable to update Charon status for "{}"; keeping the '
+                          'local entry: {}'.format(label, failed_updates[update_key]))
+            else:
+                LOG.debug("Deleting local entry {}".format(db_entry))
+                session.delete(db_entry)
         session.commit()
 
 
-def write_to_charon_alignment_results(base_path, project_name, project_id, sample_id, libprep_id, seqrun_id):
+def write_to_charon_alignment_results(base_path, project_name, project_id, sample_id,
+                                      libprep_id, seqrun_id, deferred=False):
     """Update the status of a sequencing run after alignment.
 
     :param str project_name: The name of the project (e.g. T.Durden_14_01)
@@ -191,22 +240,19 @@ def write_to_charon_alignment_results(base_path, project_name, project_id, sampl
     :param str sample_id: ...
     :param str libprep_id: ...
     :param str seqrun_id: ...
+    :param bool deferred: Queue the update on the shared CharonSession instead
+                          of sending it; it is sent by flush_updates()
 
     :raises RuntimeError: If the Charon database could not be updated
     :raises ValueError: If the output data could not be parsed.
     """
-    charon_session = CharonSession()
-    try:
-        seqrun_dict = charon_session.seqrun_get(project_id, sample_id, libprep_id, seqrun_id)
-    except CharonError as e:
-        raise CharonError('Error accessing database for project "{}", sample {}; '
-                           'could not update Charon while performing best practice: '
-                           '{}'.format(project_name, sample_id,  e))
+    charon_session = get_charon_session()
+    # Only the fields set here are updated, so there is no need to fetch the
+    # seqrun first; the update is refused if the seqrun has changed since the
+    # session last read it
+    seqrun_dict = {"projectid": project_id, "sampleid": sample_id,
+                   "libprepid": libprep_id, "seqrunid": seqrun_id, "lanes": 0}
     piper_run_id = seqrun_id.split("_")[3]
-    seqrun_dict["lanes"] = 0
-    if seqrun_dict.get("alignment_status") == "DONE":
-        LOG.warn("Sequencing run \"{}\" marked as DONE but writing new alignment results; "
-                 "this will overwrite the previous results.".format(seqrun_id))
     # Find all the appropriate files
     piper_result_dir = os.path.join(base_path, "ANALYSIS", project_name, "02_preliminary_alignment_qc")
     try:
@@ -230,6 +276,9 @@ def write_to_charon_alignment_results(base_path, project_name, project_id, sampl
         lane_alignment_metrics = parse_qualimap_results(genome_result)
         # Update the dict for this lane
         update_seq_run_for_lane(seqrun_dict, lane_alignment_metrics)
+    if deferred:
+        charon_session.queue_seqrun_update(**seqrun_dict)
+        return
     try:
         # Update the seqrun in the Charon database
         charon_session.seqrun_update(**seqrun_dict)
@@ -273,7 +322,9 @@ def update_seq_run_for_lane(seqrun_dict, lane_alignment_metrics):
 
 ## TODO This can be moved to a more generic local_process_tracking submodule
 def record_process_seqrun(project, sample, libprep, seqrun, workflow_subtask,
-                          analysis_module_name, analysis_dir, pid):
+                          analysis_module_name, analysis_dir, pid, slurm_job_id=None):
+    if slurm_job_id:
+        pid = "SLURM job {}".format(slurm_job_id)
     LOG.info('Recording process id "{}" for project "{}", sample "{}", libprep "{}", '
              'seqrun "{}", workflow "{}"'.format(pid, project, sample, libprep,
                                                  seqrun, workflow_subtask))
@@ -287,7 +338,8 @@ def record_process_seqrun(project, sample, libprep, seqrun, workflow_subtask,
                                        engine=analysis_module_name,
                                        workflow=workflow_subtask,
                                        analysis_dir=analysis_dir,
-                                       process_id=pid)
+                                       process_id=None if slurm_job_id else pid,
+                                       slurm_job_id=slurm_job_id)
         ## FIXME We must make sure that an entry for this doesn't already exist!
         session.add(seqrun_db_obj)
         for attempts in range(3):
@@ -317,7 +369,9 @@ def record_process_seqrun(project, sample, libprep, seqrun, workflow_subtask,
 ## TODO This can be moved to a more generic local_process_tracking submodule
 # FIXME change to use strings maybe
 def record_process_sample(project, sample, workflow_subtask, analysis_module_name,
-                          analysis_dir, pid, config=None):
+                          analysis_dir, pid, slurm_job_id=None, config=None):
+    if slurm_job_id:
+        pid = "SLURM job {}".format(slurm_job_id)
     LOG.info('Recording process id "{}" for project "{}", sample "{}", '
              'workflow "{}"'.format(pid, project, sample, workflow_subtask))
     with get_db_session() as session:
@@ -328,7 +382,8 @@ def record_process_sample(project, sample, workflow_subtask, analysis_module_nam
                                        engine=analysis_module_name,
                                        workflow=workflow_subtask,
                                        analysis_dir=analysis_dir,
-                                       process_id=pid)
+                                       process_id=None if slurm_job_id else pid,
+                                       slurm_job_id=slurm_job_id)
         ## FIXME We must make sure that an entry for this doesn't already exist!
         session.add(seqrun_db_obj)
         for attempts in range(3):
@@ -345,6 +400,53 @@ def record_process_sample(project, sample, workflow_subtask, analysis_module_nam
                                'workflow "{}"'.format(pid, project, sample, workflow_subtask))
 
 
+def _get_queued_slurm_jobs(session):
+    """The SLURM jobs still queued or running, if any of the tracked jobs were
+    submitted to SLURM; None if the queue cannot be listed."""
+    if not any(session.query(db_class.slurm_job_id)
+                      .filter(db_class.slurm_job_id != None).first()
+               for db_class in (SeqrunAnalysis, SampleAnalysis)):
+        return set()
+    try:
+        return get_queued_slurm_jobs()
+    except RuntimeError as e:
+        LOG.error("{}; leaving the SLURM jobs without an exit code as running".format(e))
+        return None
+
+
+def _is_job_alive(db_entry, queued_slurm_jobs):
+    """True if the job of a tracked analysis is still running, False if not,
+    None if that cannot be told."""
+    if db_entry.slurm_job_id:
+        if queued_slurm_jobs is None:
+            return None
+        return db_entry.slurm_job_id in queued_slurm_jobs
+    return psutil.pid_exists(db_entry.process_id)
+
+
+def _describe_job(db_entry):
+    if db_entry.slurm_job_id:
+        return "SLURM job {}".format(db_entry.slurm_job_id)
+    return "pid {}".format(db_entry.process_id)
+
+
+def count_running_analyses_local():
+    """Count the analyses being run, per project, in the local process
+    tracking database.
+
+    :returns: project id -> number of seqrun and sample analyses
+    :rtype: collections.Counter
+    """
+    running = collections.Counter()
+    with get_db_session() as session:
+        for db_class in (SeqrunAnalysis, SampleAnalysis):
+            for project_id, count in session.query(db_class.project_id,
+                                                   sqlalchemy.func.count()) \
+                                            .group_by(db_class.project_id):
+                running[project_id] += count
+    return running
+
+
 # Do we need this function?
 def is_seqrun_analysis_running_local(workflow_subtask, project_id, sample_id,
                                      libprep_id, seqrun_id):
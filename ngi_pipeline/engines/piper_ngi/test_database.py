@@ -49,7 +49,7 @@ class TestSqlAlchemyDB(unittest.TestCase):
                                                 engine=self.engine,
                                                 process_id=self.process_id)
         self.session.add(seqrun_analysis)
-        with self.assertRaises(sqlalchemy.orm.exc.FlushError):
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
             self.session.commit()
 
     def test_add_sample_analysis(self):
@@ -63,3 +63,47 @@ class TestSqlAlchemyDB(unittest.TestCase):
         query = self.session.query(sql_db.SampleAnalysis).filter_by(
                                         process_id=self.process_id).one()
         self.assertEqual(query, sample_analysis)
+
+
+class TestUpgradeSchema(unittest.TestCase):
+
+    def test_add_slurm_job_id(self):
+        database_path = os.path.join(tempfile.mkdtemp(), "old_database")
+        # A database from before jobs were submitted to SLURM
+        engine = sqlalchemy.create_engine("sqlite:////{}".format(database_path))
+        engine.execute("CREATE TABLE sampleanalysis (project_id VARCHAR(50), "
+                       "sample_id VARCHAR(50) PRIMARY KEY, process_id INTEGER)")
+        engine.execute("INSERT INTO sampleanalysis VALUES ('P123', 'P123_456', 101)")
+        with sql_db.get_db_session(database_path=database_path) as session:
+            session.add(sql_db.SampleAnalysis(project_id="P123", sample_id="P123_457",
+                                              slurm_job_id="4242"))
+            session.commit()
+            self.assertEqual(sorted((entry.sample_id, entry.slurm_job_id) for entry
+                                    in session.query(sql_db.SampleAnalysis)),
+                             [("P123_456", None), ("P123_457", "4242")])
+            self.assertEqual(session.query(sql_db.SeqrunAnalysis).count(), 0)
+
+    def test_seqrun_key(self):
+        database_path = os.path.join(tempfile.mkdtemp(), "old_database")
+        # Keyed by the process id, which SLURM jobs do not have
+        engine = sqlalchemy.create_engine("sqlite:////{}".format(database_path))
+        engine.execute("CREATE TABLE seqrunanalysis (project_id VARCHAR(50), "
+                       "seqrun_id VARCHAR(100), process_id INTEGER NOT NULL PRIMARY KEY, "
+                       "slurm_job_id VARCHAR(50))")
+        engine.execute("INSERT INTO seqrunanalysis VALUES ('P123', 'run1', 101, NULL)")
+        # A process id made up by sqlite for a SLURM job
+        engine.execute("INSERT INTO seqrunanalysis VALUES ('P123', 'run2', 102, '4242_0')")
+        with sql_db.get_db_session(database_path=database_path) as session:
+            session.add(sql_db.SeqrunAnalysis(project_id="P123", seqrun_id="run3",
+                                              slurm_job_id="4243_0"))
+            session.add(sql_db.SeqrunAnalysis(project_id="P123", seqrun_id="run4",
+                                              slurm_job_id="4243_1"))
+            # A real process with the id sqlite made up before
+            session.add(sql_db.SeqrunAnalysis(project_id="P123", seqrun_id="run5",
+                                              process_id=102))
+            session.commit()
+            self.assertEqual(sorted((entry.seqrun_id, entry.process_id, entry.slurm_job_id)
+                                    for entry in session.query(sql_db.SeqrunAnalysis)),
+                             [("run1", 101, None), ("run2", None, "4242_0"),
+                              ("run3", None, "4243_0"), ("run4", None, "4243_1"),
+                              ("run5", 102, None)])
@@ -91,7 +91,9 @@ def generate_identifier(date=None, flowcell_id=None):
     return "{}_{}".format(date, flowcell_id)
 
 
-def create_demultiplexed_flowcell():
+def create_demultiplexed_flowcell(project_name=None, sample_names=None,
+                                  n_samples=1, lanes=None, run_id=None,
+                                  tmp_dir=None):
     """
     140704_D00123_0321_BC423WACXX/
     |--- RunInfo.xml
@@ -100,32 +102,50 @@ def create_demultiplexed_flowcell():
     |--- Unaligned
          |--- Project_J__Doe_14_01
               |--- Sample_P123_456
-                   |--- P123_456_AGCTGC_1_R1_001.fastq.gz
-                   |--- P123_456_AGCTGC_1_R2_001.fastq.gz
+                   |--- P123_456_AGCTGC_L001_R1_001.fastq.gz
+                   |--- P123_456_AGCTGC_L001_R2_001.fastq.gz
+
+    :param str project_name: The project name (default random)
+    :param list sample_names: The sample names (default n_samples random names)
+    :param int n_samples: The number of samples if no names are given
+    :param list lanes: The lanes each sample was sequenced on (default one random lane)
+    :param str run_id: The run id, i.e. the flowcell directory name (default random)
+    :param str tmp_dir: Where to create the flowcell (default a new temporary directory)
+
+    :returns: The path to the flowcell directory
+    :rtype: str
     """
-    run_id = generate_run_id()
-    project_name = generate_project_name()
-    sample_name = generate_sample_name()
-    run_info_xml_text = generate_RunInfo()
+    if not run_id: run_id = generate_run_id()
+    if not project_name: project_name = generate_project_name()
+    if not sample_names:
+        sample_names = set()
+        while len(sample_names) < n_samples:
+            sample_names.add(generate_sample_name())
+    if not lanes: lanes = [random.randint(1,8)]
+    run_info_xml_text = generate_RunInfo(run_id=run_id)
     run_parameters_xml_text = generate_runParameters()
-    tmp_dir = tempfile.mkdtemp()
+    if not tmp_dir: tmp_dir = tempfile.mkdtemp()
     run_dir = os.path.join(tmp_dir, run_id)
     run_samplesheet = os.path.join(run_dir, "SampleSheet.csv")
     run_info_xml_file = os.path.join(run_dir, "RunInfo.xml")
     run_parameters_xml_file = os.path.join(run_dir, "runParameters.xml")
     unaligned_dir = os.path.join(run_dir, "Unaligned")
-    project_dir = os.path.join(unaligned_dir, project_name)
-    sample_dir = os.path.join(project_dir, "Sample_{}".format(sample_name))
-    sample_samplesheet = os.path.join(sample_dir, "SampleSheet.csv")
-    # Created the whole tree, run_dir/unaligned_dir/project_dir/sample_dir
-    os.makedirs(sample_dir)
-    generate_sample_file_name(sample_name)
-    # Touch files
+    # Stockholm project directories are like Project_Y__Mom_14_01
+    project_dir = os.path.join(unaligned_dir,
+                               "Project_{}".format(project_name.replace(".", "__")))
+    for sample_name in sample_names:
+        sample_dir = os.path.join(project_dir, "Sample_{}".format(sample_name))
+        sample_samplesheet = os.path.join(sample_dir, "SampleSheet.csv")
+        # Created the whole tree, run_dir/unaligned_dir/project_dir/sample_dir
+        os.makedirs(sample_dir)
+        open(sample_samplesheet, 'w').close()
+        barcode = generate_barcode()
+        # Touch files
+        for lane in lanes:
+            for fq in generate_paired_sample_file_names(sample_name=sample_name,
+                                                        barcode=barcode, lane=lane):
+                open(os.path.join(sample_dir, fq), 'w').close()
     open(run_samplesheet, 'w').close()
-    open(sample_samplesheet, 'w').close()
-    for fq in generate_paired_sample_file_names(sample_name = sample_name):
-        fq_file_path = os.path.join(sample_dir, fq)
-        open(fq_file_path, 'w').close()
     # Write files
     with open(run_info_xml_file, 'w') as f:
         f.writelines(run_info_xml_text)
@@ -154,7 +174,7 @@ def generate_RunInfo(run_id=None, fcid=generate_flowcell_id(),
     """Generate a dummy RunInfo.xml file. This contains only the "Flowcell",
     "Date", and "Instrument" parameters.
     """
-    run_id = generate_run_id(date=date, instrument_id=instrument_id, fcid=fcid)
+    if not run_id: run_id = generate_run_id(date=date, instrument_id=instrument_id, fcid=fcid)
     if run_id:  # User submitted a run id which we must parse
         try:
             date, instrument_id, _, fcid = run_id.split("_")
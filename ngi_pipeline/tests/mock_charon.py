@@ -0,0 +1,278 @@
+"""A minimal stand-in for the Charon API, for tests and benchmarks.
+
+Serves the /api/v1/project|sample|libprep|seqrun routes used by
+CharonSession (GET of documents and listings, POST, PUT and DELETE) from
+memory; listings can be filtered by field=value query parameters. It can
+sleep before each response to mimic the latency of a real server and answer
+a share of the requests with an error instead. Responses carry an ETag, and
+If-None-Match (GET) and If-Match (PUT) are honoured:
+
+    server = MockCharonServer(latency=0.01, error_rate=0.05).start()
+    server.populate("P100", n_samples=96)
+    session = CharonSession(api_token="x", base_url=server.base_url)
+    ...
+    print(server.request_stats())
+    server.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+import urlparse
+
+from ngi_pipeline.tests.generate_test_data import generate_project_name, generate_run_id
+
+# The document type served under each listing url, e.g. "samples/P1"
+LISTING_TYPES = {"projects": "project", "samples": "sample",
+                 "libpreps": "libprep", "seqruns": "seqrun"}
+# The id fields of a document, from the project down
+ID_FIELDS = ("projectid", "sampleid", "libprepid", "seqrunid")
+DOC_TYPES = ("project", "sample", "libprep", "seqrun")
+
+RequestRecord = collections.namedtuple("RequestRecord", ["method", "path",
+                                                         "status_code", "duration"])
+
+
+class MockCharonHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_json(*self.server.dispatch(self.command, self.path, headers=self.headers))
+
+    def do_DELETE(self):
+        self.send_json(*self.server.dispatch(self.command, self.path, headers=self.headers))
+
+    def do_POST(self):
+        self.send_json(*self.server.dispatch(self.command, self.path, self.read_json(),
+                                             headers=self.headers))
+
+    def do_PUT(self):
+        self.send_json(*self.server.dispatch(self.command, self.path, self.read_json(),
+                                             headers=self.headers))
+
+    def read_json(self):
+        body = self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            return None
+
+    def send_json(self, status_code, body=None, headers=None):
+        body = json.dumps(body) if body is not None else ""
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the test output clean
+        pass
+
+
+class MockCharonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server holding the Charon documents in a dict keyed
+    by (doc_type, id, ...), e.g. ("libprep", "P1", "P1_101", "A")."""
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 makes concurrent clients queue up
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_code=503, port=0,
+                 handler_class=MockCharonHandler):
+        """
+        :param float latency: Seconds to wait before answering each request
+        :param float error_rate: The share of requests answered with error_code
+        :param int error_code: The status code of the injected errors
+        :param int port: The port to listen on (default any free port)
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.documents = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, method, path, body=None, headers=None):
+        """Answer one request.
+
+        :returns: The status code, the json body and the headers of the response
+        :rtype: tuple
+        """
+        start = time.time()
+        headers = headers or {}
+        response_headers = {}
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            status_code, response = self.error_code, {"message": "Injected error"}
+        elif method == "PUT" and headers.get("If-Match") and \
+                headers.get("If-Match") != self._etag(*self._route("GET", path, None)):
+            status_code, response = 412, {"message": "Document has changed"}
+        else:
+            status_code, response = self._route(method, path, body)
+            if method == "GET" and status_code == 200:
+                response_headers["ETag"] = self._etag(status_code, response)
+                if headers.get("If-None-Match") == response_headers["ETag"]:
+                    status_code, response = 304, None
+        with self._lock:
+            self.requests.append(RequestRecord(method, path, status_code,
+                                               time.time() - start))
+        return status_code, response, response_headers
+
+    @staticmethod
+    def _etag(status_code, response):
+        if status_code != 200:
+            return None
+        return '"{}"'.format(hashlib.md5(json.dumps(response, sort_keys=True)).hexdigest())
+
+    def _route(self, method, path, body):
+        path, _, query = path.partition("?")
+        args = path.strip("/").split("/")
+        if args[:2] != ["api", "v1"] or len(args) < 3:
+            return 404, {"message": "Not found"}
+        doc_type, ids = args[2], tuple(args[3:])
+        if doc_type in LISTING_TYPES:
+            if method != "GET":
+                return 405, {"message": "Method not allowed"}
+            docs = self.get_listing(LISTING_TYPES[doc_type], ids,
+                                    dict(urlparse.parse_qsl(query)))
+            return 200, {doc_type: docs}
+        if doc_type not in DOC_TYPES or len(ids) > DOC_TYPES.index(doc_type) + 1:
+            return 404, {"message": "Not found"}
+        if method in ("POST", "PUT") and body is None:
+            return 400, {"message": "Invalid json"}
+        if method == "POST":
+            # The id of the new document is in the body, e.g. POST sample/P1
+            try:
+                ids = ids + (body[ID_FIELDS[len(ids)]],)
+            except KeyError:
+                return 400, {"message": "Missing {}".format(ID_FIELDS[len(ids)])}
+            if self.get_document(doc_type, ids) is not None:
+                return 400, {"message": "Document already exists"}
+            return 201, self.add_document(doc_type, ids, **body)
+        if method == "GET":
+            doc = self.get_document(doc_type, ids)
+        elif method == "PUT":
+            doc = self.update_document(doc_type, ids, **body)
+        elif method == "DELETE":
+            doc = self.delete_document(doc_type, ids)
+        else:
+            return 405, {"message": "Method not allowed"}
+        if doc is None:
+            return 404, {"message": "Not found"}
+        return (200, doc) if method == "GET" else (204, None)
+
+    def get_document(self, doc_type, ids):
+        with self._lock:
+            doc = self.documents.get((doc_type,) + tuple(ids))
+            if doc is None and doc_type == "project" and len(ids) == 1:
+                # Projects can be fetched by name as well
+                for key, project in self.documents.items():
+                    if key[0] == "project" and project.get("name") == ids[0]:
+                        return dict(project)
+            return dict(doc) if doc is not None else None
+
+    def get_listing(self, doc_type, ids, filters=None):
+        """The documents of doc_type below ids whose fields (as strings)
+        equal the values in filters."""
+        filters = filters or {}
+        with self._lock:
+            return [dict(doc) for key, doc in sorted(self.documents.items())
+                    if key[0] == doc_type and key[1:-1] == ids and
+                       all(unicode(doc.get(k)) == v for k, v in filters.items())]
+
+    def add_document(self, doc_type, ids, **fields):
+        doc = dict(fields)
+        doc.update(zip(ID_FIELDS, ids))
+        with self._lock:
+            self.documents[(doc_type,) + tuple(ids)] = doc
+        return dict(doc)
+
+    def update_document(self, doc_type, ids, **fields):
+        with self._lock:
+            doc = self.documents.get((doc_type,) + tuple(ids))
+            if doc is not None:
+                doc.update((k, v) for k, v in fields.items() if k not in ID_FIELDS)
+                return dict(doc)
+
+    def delete_document(self, doc_type, ids):
+        """Delete a document and everything below it."""
+        ids = tuple(ids)
+        with self._lock:
+            doc = self.documents.pop((doc_type,) + ids, None)
+            if doc is not None:
+                for key in self.documents.keys():
+                    if key[1:len(ids) + 1] == ids and \
+                            DOC_TYPES.index(key[0]) > DOC_TYPES.index(doc_type):
+                        del self.documents[key]
+            return doc
+
+    def populate(self, projectid, n_samples=10, n_libpreps=1, n_seqruns=1,
+                 project_name=None, seqrun_ids=None, **project_fields):
+        """Add a project with n_samples samples, each with n_libpreps libpreps
+        with n_seqruns seqruns each.
+
+        :param list seqrun_ids: The seqrun ids to use for every libprep (default random)
+        :param dict project_fields: Extra fields for the project document
+
+        :returns: The project name
+        :rtype: str
+        """
+        project_name = project_name or generate_project_name()
+        fields = {"name": project_name, "status": "OPEN", "pipeline": "NGI"}
+        fields.update(project_fields)
+        self.add_document("project", (projectid,), **fields)
+        for sample_num in xrange(n_samples):
+            sampleid = "{}_{}".format(projectid, 101 + sample_num)
+            self.add_document("sample", (projectid, sampleid), status="NEW")
+            for libprep_num in xrange(n_libpreps):
+                libprepid = chr(ord("A") + libprep_num)
+                self.add_document("libprep", (projectid, sampleid, libprepid),
+                                  status="NEW")
+                for seqrunid in (seqrun_ids or [generate_run_id() for i in xrange(n_seqruns)]):
+                    self.add_document("seqrun", (projectid, sampleid, libprepid, seqrunid),
+                                      alignment_status="NEW")
+        return project_name
+
+    def request_stats(self):
+        """Summarize the requests answered so far.
+
+        :returns: The number of requests per method and status code, and the
+                  median, 95th percentile and maximum time taken to answer
+        :rtype: dict
+        """
+        with self._lock:
+            records = list(self.requests)
+        durations = sorted(record.duration for record in records)
+        def percentile(p):
+            if not durations:
+                return 0.0
+            return durations[min(len(durations) - 1, int(p * len(durations)))]
+        return {"requests": len(records),
+                "methods": dict(collections.Counter(r.method for r in records)),
+                "status_codes": dict(collections.Counter(r.status_code for r in records)),
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "max": durations[-1] if durations else 0.0}
@@ -1,5 +1,7 @@
 import collections
 import functools
+import os
+import threading
 
 from ngi_pipeline.utils.config import load_yaml_config, locate_ngi_config
 
@@ -50,3 +52,73 @@ class memoized(object):
     # goes through the __call__ function defined above
     def __get__(self, obj, objtype):
         return functools.partial(self.__call__, obj)
+
+
+class memoized_by_mtime(object):
+    """
+    Decorator, caches the results of a function whose first argument is the
+    path to a file, for as long as the file's mtime and size stay the same.
+    Only the max_entries most recently used results are kept.
+    """
+    max_entries = 64
+
+    def __init__(self, func):
+        self.func = func
+        self.cached = collections.OrderedDict()
+        self._lock = threading.Lock()
+        functools.update_wrapper(self, func)
+
+    def __call__(self, path, *args):
+        file_stat = os.stat(path)
+        signature = (file_stat.st_mtime, file_stat.st_size)
+        key = (path,) + args
+        with self._lock:
+            try:
+                cached_signature, return_val = self.cached.pop(key)
+            except KeyError:
+                pass
+            else:
+                if cached_signature == signature:
+                    self.cached[key] = (signature, return_val)
+                    return return_val
+        return_val = self.func(path, *args)
+        with self._lock:
+            self.cached[key] = (signature, return_val)
+            while len(self.cached) > self.max_entries:
+                self.cached.popitem(last=False)
+        return return_val
+
+    def __repr__(self):
+        return self.func.__doc__
+
+
+class resource_limited(object):
+    """
+    Decorator, limits how many calls of the functions sharing a resource
+    (e.g. "setupfilecreator") run at the same time, e.g. across the threads
+    launching analyses. Resources without a limit (see set_limits) are unlimited.
+    """
+    _semaphores = {}
+    _lock = threading.Lock()
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    @classmethod
+    def set_limits(cls, limits):
+        """
+        :param dict limits: The number of concurrent calls allowed per resource
+        """
+        with cls._lock:
+            for resource, limit in limits.items():
+                cls._semaphores[resource] = threading.BoundedSemaphore(int(limit))
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            semaphore = self._semaphores.get(self.resource)
+            if semaphore is None:
+                return func(*args, **kwargs)
+            with semaphore:
+                return func(*args, **kwargs)
+        return wrapped
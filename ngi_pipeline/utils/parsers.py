@@ -6,9 +6,9 @@ import re
 import xml.etree.cElementTree as ET
 import xml.parsers.expat
 
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonError, get_charon_session
 from ngi_pipeline.log.loggers import minimal_logger
-from ngi_pipeline.utils.classes import memoized
+from ngi_pipeline.utils.classes import memoized, memoized_by_mtime
 
 LOG = minimal_logger(__name__)
 
@@ -39,80 +39,100 @@ def slurm_time_to_seconds(slurm_time_str):
     return seconds
 
 
-def determine_library_prep_from_fcid(project_id, sample_name, fcid):
+def get_fcid_libprep_index(project_id, sample_name):
+    """Map each sequencing run of a sample to its library prep, using the
+    information in the database; one request for the libpreps and one per
+    libprep for its seqruns.
+
+    :param str project_id: The ID of the project
+    :param str sample_name: The name of the sample
+
+    :returns: The library prep of each seqrun (e.g. {"140528_D00415_0049_BC423WACXX": "A"})
+    :rtype: dict
+    :raises ValueError: If the database could not be queried
+    """
+    charon_session = get_charon_session()
+    fcid_index = {}
+    try:
+        libpreps = charon_session.sample_get_libpreps(project_id, sample_name)['libpreps']
+        for libprep in libpreps:
+            # Get the sequencing runs and see which FCIDs they are
+            seqruns = charon_session.libprep_get_seqruns(project_id,
+                                                         sample_name,
+                                                         libprep['libprepid'])['seqruns']
+            for seqrun in seqruns:
+                fcid_index[seqrun["seqrunid"]] = libprep['libprepid']
+    except CharonError as e:
+        # A missing sample or libprep just has no seqruns
+        if e.status_code != 404:
+            raise ValueError('Could not get library preps for project "{}" '
+                             '/ sample "{}": {}'.format(project_id, sample_name, e))
+    return fcid_index
+
+
+def determine_library_prep_from_fcid(project_id, sample_name, fcid, fcid_index=None):
     """Use the information in the database to get the library prep id
     from the project name, sample name, and flowcell id.
 
     :param str project_id: The ID of the project
     :param str sample_name: The name of the sample
     :param str fcid: The flowcell ID
+    :param dict fcid_index: The sample's index from get_fcid_libprep_index,
+                            if already fetched (optional)
 
     :returns: The library prep (e.g. "A")
     :rtype str
     :raises ValueError: If no match was found.
     """
-    charon_session = CharonSession()
+    if fcid_index is None:
+        fcid_index = get_fcid_libprep_index(project_id, sample_name)
     try:
-        libpreps = charon_session.sample_get_libpreps(project_id, sample_name)['libpreps']
-        if libpreps:
-            for libprep in libpreps:
-                # Get the sequencing runs and see if they match the FCID we have
-                seqruns = charon_session.libprep_get_seqruns(project_id,
-                                                             sample_name,
-                                                             libprep['libprepid'])['seqruns']
-                if seqruns:
-                    for seqrun in seqruns:
-                        seqrun_runid = seqrun["seqrunid"]
-                        if seqrun_runid == fcid:
-                            return libprep['libprepid']
-                    else:
-                        raise CharonError("No match", 404)
-                else:
-                    raise CharonError("No seqruns found!", 404)
-        else:
-            raise CharonError("No libpreps found!", 404)
-    except CharonError as e:
-        if e.status_code == 404:
-            raise ValueError('No library prep found for project "{}" / sample "{}" '
-                             '/ fcid "{}"'.format(project_id, sample_name, fcid))
-        else:
-            raise ValueError('Could not determine library prep for project "{}" '
-                             '/ sample "{}" / fcid "{}": {}'.format(project_id,
-                                                                    sample_name,
-                                                                    fcid,
-                                                                    e))
+        return fcid_index[fcid]
+    except KeyError:
+        raise ValueError('No library prep found for project "{}" / sample "{}" '
+                         '/ fcid "{}"'.format(project_id, sample_name, fcid))
 
 
 def determine_libprep_from_uppsala_samplesheet(samplesheet_path, project_id, sample_id, seqrun_id, lane_num):
-    samplesheet = parse_samplesheet(samplesheet_path)
     fcid = seqrun_id.split("_")[3][1:]
-    for row in samplesheet:
-        ss_project_id = row["SampleProject"]
-        ss_sample_id = row["SampleID"]
-        ss_fcid = row["FCID"]
-        ss_lane_num = int(row["Lane"])
-
-        if project_id == ss_project_id and \
-           sample_id == ss_sample_id and \
-           fcid == ss_fcid and \
-           lane_num == ss_lane_num:
-               # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
-               try:
-                   return row["Description"].split(":")[1]
-               except IndexError:
-                   error_msg = ('Malformed description in "{}"; cannot get '
-                                'libprep information'.format(samplesheet_path))
-                   LOG.warn(error_msg)
-                   raise ValueError(error_msg)
-    error_msg = ('No match found in "{}" for project "{}" / sample "{}" / '
-                 'seqrun "{}" / lane number "{}"'.format(samplesheet_path,
-                                                         project_id, sample_id,
-                                                         seqrun_id, lane_num))
-    LOG.warn(error_msg)
-    raise ValueError(error_msg)
+    try:
+        row = index_samplesheet(samplesheet_path)[(project_id, sample_id, fcid, lane_num)]
+    except KeyError:
+        error_msg = ('No match found in "{}" for project "{}" / sample "{}" / '
+                     'seqrun "{}" / lane number "{}"'.format(samplesheet_path,
+                                                             project_id, sample_id,
+                                                             seqrun_id, lane_num))
+        LOG.warn(error_msg)
+        raise ValueError(error_msg)
+    # Resembles 'LIBRARY_NAME:SX398_NA11993_Nano'
+    try:
+        return row["Description"].split(":")[1]
+    except IndexError:
+        error_msg = ('Malformed description in "{}"; cannot get '
+                     'libprep information'.format(samplesheet_path))
+        LOG.warn(error_msg)
+        raise ValueError(error_msg)
 
 
-@memoized
+@memoized_by_mtime
+def index_samplesheet(samplesheet_path):
+    """Index the rows of an Illumina SampleSheet.csv by
+    (SampleProject, SampleID, FCID, Lane); the first row wins if there
+    are several for the same key.
+
+    :param str samplesheet_path: The path to the SampleSheet.csv
+
+    :returns: The rows, keyed by (project id, sample id, fcid, lane number)
+    :rtype: dict
+    """
+    index = {}
+    for row in parse_samplesheet(samplesheet_path):
+        key = (row["SampleProject"], row["SampleID"], row["FCID"], int(row["Lane"]))
+        index.setdefault(key, row)
+    return index
+
+
+@memoized_by_mtime
 def parse_samplesheet(samplesheet_path):
     """Parses an Illumina SampleSheet.csv and returns a list of dicts
     """
@@ -0,0 +1,152 @@
+"""Submit jobs to SLURM and find out which are still queued or running.
+
+A job runs one or more command lines; with more than one, it is submitted
+as an array job with a task per command line, so that e.g. all the seqruns
+of a flowcell go to the scheduler in a single sbatch call:
+
+    sbatch_path = create_sbatch_file(sbatch_path, "piper_140528_D00415", command_lines,
+                                     log_paths=log_paths, slurm_config=config["slurm"])
+    job_id = submit_sbatch(sbatch_path)
+    task_job_ids = ["{}_{}".format(job_id, index) for index in range(len(command_lines))]
+
+The sbatch parameters come from the slurm section of the config:
+
+    slurm:
+        account: a2010002
+        partition: node
+        cores: 16
+        time: 4-00:00:00
+        extra_parameters: ["--qos=seqver"]
+"""
+import datetime
+import getpass
+import os
+import pipes
+import shutil
+import subprocess
+
+from textwrap import dedent
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+SBATCH_TEMPLATE = dedent("""\
+    #!/bin/bash -l
+    #SBATCH -A {account}
+    #SBATCH -p {partition}
+    #SBATCH -n {cores}
+    #SBATCH -t {time}
+    #SBATCH -J {job_name}
+    #SBATCH -o {slurm_log_path}
+    #SBATCH -e {slurm_log_path}
+    {extra_parameters}
+    {commands}
+    """)
+
+
+def create_sbatch_file(sbatch_path, job_name, command_lines, log_paths=None,
+                       cwds=None, slurm_config=None):
+    """Write an sbatch file running the command lines; an array job with
+    one task per command line if there are several.
+
+    :param str sbatch_path: The file to write; an existing one is kept as a backup
+    :param str job_name: The name of the job in the queue
+    :param list command_lines: The (shell) command lines to run
+    :param list log_paths: The files to log the output of each command line to (optional)
+    :param list cwds: The directory to run each command line in (optional)
+    :param dict slurm_config: The account, partition, cores, time and
+                              extra_parameters of the job
+
+    :returns: The path to the sbatch file
+    :rtype: str
+
+    :raises ValueError: If there are no command lines, or no account to charge them to
+    """
+    if not command_lines:
+        raise ValueError("No command lines to submit")
+    slurm_config = slurm_config or {}
+    if not slurm_config.get("account"):
+        raise ValueError("No SLURM account (slurm.account) in the configuration file")
+    log_paths = log_paths or [None] * len(command_lines)
+    cwds = cwds or [None] * len(command_lines)
+    commands = [_wrap_command_line(command_line, log_path, cwd)
+                for command_line, log_path, cwd in zip(command_lines, log_paths, cwds)]
+    extra_parameters = ["#SBATCH {}".format(parameter) for parameter
+                        in slurm_config.get("extra_parameters") or []]
+    sbatch_dir = os.path.dirname(os.path.abspath(sbatch_path))
+    if len(commands) > 1:
+        extra_parameters.append("#SBATCH --array=0-{}".format(len(commands) - 1))
+        slurm_log_path = os.path.join(sbatch_dir, "{}-%A_%a.out".format(job_name))
+        commands = (['case "$SLURM_ARRAY_TASK_ID" in'] +
+                    ["    {})\n        {}\n        ;;".format(index, command)
+                     for index, command in enumerate(commands)] +
+                    ["esac"])
+    else:
+        slurm_log_path = os.path.join(sbatch_dir, "{}-%j.out".format(job_name))
+    sbatch_text = SBATCH_TEMPLATE.format(account=slurm_config["account"],
+                                         partition=slurm_config.get("partition", "core"),
+                                         cores=slurm_config.get("cores", 1),
+                                         time=slurm_config.get("time", "1-00:00:00"),
+                                         job_name=job_name,
+                                         slurm_log_path=slurm_log_path,
+                                         extra_parameters="\n".join(extra_parameters),
+                                         commands="\n".join(commands))
+    if os.path.exists(sbatch_path):
+        shutil.move(sbatch_path, sbatch_path + ".bak{}".format(
+                        datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")))
+    with open(sbatch_path, 'w') as f:
+        f.write(sbatch_text)
+    return sbatch_path
+
+
+def submit_sbatch(sbatch_path):
+    """Submit an sbatch file to the queue.
+
+    :param str sbatch_path: The sbatch file
+
+    :returns: The SLURM job id
+    :rtype: str
+
+    :raises RuntimeError: If sbatch is not available or fails
+    """
+    try:
+        output = subprocess.check_output(["sbatch", "--parsable", sbatch_path],
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError('Could not submit sbatch file "{}": {} '
+                           '{}'.format(sbatch_path, e, getattr(e, "output", "")))
+    # "<job id>" or "<job id>;<cluster>"
+    job_id = output.strip().split(";")[0]
+    LOG.info('Submitted "{}" to SLURM as job {}'.format(sbatch_path, job_id))
+    return job_id
+
+
+def get_queued_slurm_jobs(user=None):
+    """The jobs of the user that are pending or running; array jobs as one
+    "<job id>_<task index>" per task.
+
+    :param str user: The owner of the jobs (default the current user)
+
+    :returns: The job ids
+    :rtype: set
+
+    :raises RuntimeError: If squeue is not available or fails
+    """
+    try:
+        output = subprocess.check_output(["squeue", "--noheader", "--array",
+                                          "--format=%i", "--user", user or getpass.getuser()],
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError("Could not list the SLURM queue: {} "
+                           "{}".format(e, getattr(e, "output", "")))
+    return set(line.strip() for line in output.splitlines() if line.strip())
+
+
+def _wrap_command_line(command_line, log_path=None, cwd=None):
+    command = "{{ {}; }}".format(command_line)
+    if log_path:
+        command += " > {} 2>&1".format(pipes.quote(log_path))
+    if cwd:
+        command = "cd {} && {}".format(pipes.quote(cwd), command)
+    return command
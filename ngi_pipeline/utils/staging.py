@@ -0,0 +1,192 @@
+"""Stage fastq files into the analysis directory structure.
+
+All the files of a flowcell are planned first, as (src, dst) pairs; files
+already in place are found with one listing per destination directory rather
+than a stat per file. The rest are then linked or copied in a pool of
+threads and each result is verified:
+
+    tasks, skipped = plan_staging(pairs)
+    report = stage_files(tasks, strategy="hardlink", max_workers=8)
+
+The strategies are "symlink", "hardlink" (falling back to a copy when src and
+dst are on different filesystems) and "copy" (a reflink where the filesystem
+supports it, optionally verified by checksum).
+"""
+import collections
+import errno
+import hashlib
+import os
+import shutil
+import subprocess
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from ngi_pipeline.log.loggers import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+StagingTask = collections.namedtuple("StagingTask", ["src", "dst"])
+
+
+class StagingReport(collections.namedtuple("StagingReport", ["staged", "skipped", "failed",
+                                                             "bytes", "seconds"])):
+    """The outcome of stage_files: the tasks done, the tasks skipped, the
+    (task, error message) pairs that failed, the bytes staged and the time taken."""
+    @property
+    def throughput(self):
+        """Bytes staged per second."""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+def plan_staging(src_dst_pairs):
+    """Split the (src, dst) pairs into those still to be staged and those
+    whose dst already exists.
+
+    :param list src_dst_pairs: The (source file, destination file) pairs
+
+    :returns: The tasks to do and the tasks to skip
+    :rtype: tuple of lists of StagingTask
+    """
+    existing_names = {}
+    tasks, skipped = [], []
+    for src, dst in src_dst_pairs:
+        dst_dir, dst_name = os.path.split(dst)
+        if dst_dir not in existing_names:
+            try:
+                existing_names[dst_dir] = set(os.listdir(dst_dir))
+            except OSError:
+                existing_names[dst_dir] = set()
+        if dst_name in existing_names[dst_dir]:
+            skipped.append(StagingTask(src, dst))
+        else:
+            # The same dst given twice is staged once
+            existing_names[dst_dir].add(dst_name)
+            tasks.append(StagingTask(src, dst))
+    return tasks, skipped
+
+
+def stage_files(tasks, strategy="symlink", max_workers=None, checksum=False, skipped=None):
+    """Stage the files and verify the results.
+
+    :param list tasks: The StagingTasks to do, e.g. from plan_staging
+    :param str strategy: "symlink", "hardlink" or "copy" (default "symlink")
+    :param int max_workers: The number of files staged at the same time (default 1)
+    :param bool checksum: Verify copies by md5 as well as by size (default False)
+    :param list skipped: The tasks left out by plan_staging, for the report
+
+    :returns: What was staged, and how fast
+    :rtype: StagingReport
+
+    :raises ValueError: If the strategy is unknown
+    """
+    try:
+        stage_file = STAGING_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError('Unknown staging strategy "{}"; should be one of '
+                         '{}'.format(strategy, ", ".join(sorted(STAGING_STRATEGIES))))
+    def stage(task):
+        try:
+            stage_file(task.src, task.dst)
+        except (OSError, IOError, subprocess.CalledProcessError) as e:
+            return 0, str(e)
+        try:
+            _verify(task.src, task.dst, strategy, checksum)
+            return os.stat(task.src).st_size, None
+        except (OSError, IOError) as e:
+            # Don't leave a bad file to be mistaken for a staged one next time
+            try:
+                os.remove(task.dst)
+            except OSError:
+                pass
+            return 0, "verification failed: {}".format(e)
+    start = time.time()
+    max_workers = max_workers or 1
+    if max_workers > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(max_workers, len(tasks)))
+        try:
+            results = pool.map(stage, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(stage, tasks)
+    staged, failed, n_bytes = [], [], 0
+    for task, (size, error) in zip(tasks, results):
+        if error:
+            LOG.error('Could not {} "{}" to "{}": {}'.format(strategy, task.src,
+                                                            task.dst, error))
+            failed.append((task, error))
+        else:
+            staged.append(task)
+            n_bytes += size
+    report = StagingReport(staged, skipped or [], failed, n_bytes, time.time() - start)
+    LOG.info("Staged {} files ({}) by {} in {:.1f}s: {:.1f} MB/s; {} already in place, "
+             "{} failed".format(len(staged), _format_bytes(n_bytes), strategy,
+                                report.seconds, report.throughput / 1e6,
+                                len(report.skipped), len(failed)))
+    return report
+
+
+def _symlink(src, dst):
+    os.symlink(src, dst)
+
+
+def _hardlink(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Different filesystems
+        _copy(src, dst)
+
+
+def _copy(src, dst):
+    # Copy to a temporary name so that no partial file is left at dst
+    tmp_dst = dst + ".part"
+    try:
+        # Clones the file on filesystems that support it (btrfs, XFS), copies it otherwise
+        subprocess.check_call(["cp", "--reflink=auto", "--preserve=timestamps", src, tmp_dst])
+    except OSError:
+        # No GNU cp
+        shutil.copy2(src, tmp_dst)
+    except subprocess.CalledProcessError:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+    os.rename(tmp_dst, dst)
+
+
+STAGING_STRATEGIES = {"symlink": _symlink,
+                      "hardlink": _hardlink,
+                      "copy": _copy}
+
+
+def _verify(src, dst, strategy, checksum):
+    """Raise OSError if dst is not src, or a faithful copy of it."""
+    if os.path.samefile(src, dst):
+        return
+    if strategy == "symlink":
+        raise OSError("{} does not point to {}".format(dst, src))
+    src_size, dst_size = os.path.getsize(src), os.path.getsize(dst)
+    if src_size != dst_size:
+        raise OSError("{} has {} bytes but {} has {}".format(src, src_size, dst, dst_size))
+    if checksum and _md5sum(src) != _md5sum(dst):
+        raise OSError("{} differs from {}".format(dst, src))
+
+
+def _md5sum(path, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _format_bytes(n_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n_bytes < 1024:
+            return "{:.1f} {}".format(n_bytes, unit)
+        n_bytes /= 1024.0
+    return "{:.1f} TB".format(n_bytes)
@@ -1,6 +1,11 @@
 import contextlib
+import threading
+import time
+import unittest
 
-from ngi_pipeline.utils.classes import with_ngi_config
+from multiprocessing.pool import ThreadPool
+
+from ngi_pipeline.utils.classes import resource_limited, with_ngi_config
 
 # This isn't being called by nosetests, I think due to the fact
 # that it gets renamed as "with_config" despite the fact that I've
@@ -11,6 +16,26 @@ from ngi_pipeline.utils.classes import with_ngi_config
 def test_with_ngi_config(config=None, config_file_path=None):
     assert(config)
 
+class TestResourceLimited(unittest.TestCase):
+
+    def test_resource_limited(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+        @resource_limited("test_resource")
+        def use_resource(i):
+            with lock:
+                running.append(i)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(i)
+        resource_limited.set_limits({"test_resource": 2})
+        pool = ThreadPool(6)
+        pool.map(use_resource, range(12))
+        pool.close()
+        self.assertEqual(max(peak), 2)
+
 if __name__=="__main__":
     test_with_ngi_config()
     test_context_manager()
@@ -7,7 +7,8 @@ import tempfile
 import unittest
 
 from .filesystem import chdir, curdir_tmpdir, do_rsync, execute_command_line, \
-                        load_modules, safe_makedir
+                        load_modules, make_directories, safe_makedir, \
+                        scan_directory
 
 
 class TestFilesystemUtils(unittest.TestCase):
@@ -53,6 +54,33 @@ class TestFilesystemUtils(unittest.TestCase):
         safe_makedir(dir_tree)
         assert(os.path.exists(dir_tree))
 
+    def test_make_directories(self):
+        existing_dir = os.path.join(self.tmp_dir, "P1")
+        os.makedirs(existing_dir)
+        new_dirs = [os.path.join(existing_dir, "P1_101", "A", "run1"),
+                    os.path.join(existing_dir, "P1_101"),
+                    os.path.join(self.tmp_dir, "P2", "P2_101")]
+        created = make_directories(new_dirs + [existing_dir])
+        for dir_path in new_dirs + [existing_dir]:
+            assert(os.path.isdir(dir_path))
+            assert(dir_path in created)
+        # Known directories are not created again
+        os.rmdir(new_dirs[0])
+        make_directories(new_dirs[:1], created=created)
+        assert(not os.path.exists(new_dirs[0]))
+
+    def test_scan_directory(self):
+        os.makedirs(os.path.join(self.tmp_dir, "Sample_P1_101"))
+        with open(os.path.join(self.tmp_dir, "reads.fastq.gz"), 'w') as f:
+            f.write("@read")
+        open(os.path.join(self.tmp_dir, ".hidden"), 'w').close()
+        os.symlink(os.path.join(self.tmp_dir, "missing"), os.path.join(self.tmp_dir, "dangling"))
+        entries = scan_directory(self.tmp_dir, stat_files=True)
+        self.assertEqual([(e.name, e.is_dir) for e in entries],
+                         [("Sample_P1_101", True), ("reads.fastq.gz", False)])
+        self.assertEqual(entries[1].size, 5)
+        self.assertIsNone(scan_directory(self.tmp_dir)[1].size)
+
     def test_curdir_tmpdir(self):
         with curdir_tmpdir() as new_tmp_dir:
             assert(os.path.exists(new_tmp_dir))
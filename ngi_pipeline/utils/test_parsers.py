@@ -1,11 +1,15 @@
 import datetime
+import mock
 import os
 import random
+import shutil
 import tempfile
 import unittest
 
 from .parsers import get_flowcell_id_from_dirtree, parse_lane_from_filename, \
-                                       find_fastq_read_pairs, find_fastq_read_pairs_from_dir
+                                       find_fastq_read_pairs, find_fastq_read_pairs_from_dir, \
+                                       determine_library_prep_from_fcid, get_fcid_libprep_index, \
+                                       determine_libprep_from_uppsala_samplesheet
 from ngi_pipeline.tests import generate_test_data as gtd
 
 class TestCommon(unittest.TestCase):
@@ -48,3 +52,51 @@ class TestCommon(unittest.TestCase):
             open(os.path.join(tmp_dir, file_name), 'w').close()
         expected_output = {"P123_456_AAAAAA_L001": file_list }
         self.assertEqual(expected_output, find_fastq_read_pairs_from_dir(tmp_dir))
+
+
+class TestLibprepFromFcid(unittest.TestCase):
+
+    @mock.patch("ngi_pipeline.utils.parsers.get_charon_session")
+    def test_fcid_libprep_index(self, mock_session):
+        # The run is on the second libprep; the first has none
+        seqruns = {"A": [], "B": [{"seqrunid": "FC1"}, {"seqrunid": "FC2"}]}
+        mock_session.return_value.sample_get_libpreps.return_value = \
+                {"libpreps": [{"libprepid": "A"}, {"libprepid": "B"}]}
+        mock_session.return_value.libprep_get_seqruns.side_effect = \
+                lambda p, s, libprepid: {"seqruns": seqruns[libprepid]}
+        fcid_index = get_fcid_libprep_index("P1", "P1_101")
+        self.assertEqual(fcid_index, {"FC1": "B", "FC2": "B"})
+        self.assertEqual(determine_library_prep_from_fcid("P1", "P1_101", "FC2", fcid_index), "B")
+        with self.assertRaises(ValueError):
+            determine_library_prep_from_fcid("P1", "P1_101", "FC3", fcid_index)
+
+
+class TestUppsalaSamplesheet(unittest.TestCase):
+
+    def setUp(self):
+        self.samplesheet_path = os.path.join(tempfile.mkdtemp(), "SampleSheet.csv")
+        self.write_samplesheet("SX398_NA11993_Nano", mtime=1400000000)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.samplesheet_path))
+
+    def write_samplesheet(self, library_name, mtime):
+        with open(self.samplesheet_path, 'w') as f:
+            f.write("FCID,Lane,SampleID,SampleRef,Index,Description,Control,"
+                    "Recipe,Operator,SampleProject\n")
+            for lane in (1, 2):
+                f.write("C423WACXX,{},NA11993,hg19,ACAGTG,LIBRARY_NAME:{},N,R1,NN,"
+                        "SX398\n".format(lane, library_name))
+        os.utime(self.samplesheet_path, (mtime, mtime))
+
+    def test_libprep_lookup(self):
+        seqrun_id = "140528_D00415_0049_BC423WACXX"
+        self.assertEqual(determine_libprep_from_uppsala_samplesheet(
+                self.samplesheet_path, "SX398", "NA11993", seqrun_id, 2), "SX398_NA11993_Nano")
+        with self.assertRaises(ValueError):
+            determine_libprep_from_uppsala_samplesheet(
+                    self.samplesheet_path, "SX398", "NA11993", seqrun_id, 3)
+        # A re-written samplesheet is read again
+        self.write_samplesheet("SX398_NA11993_Rerun", mtime=1400000060)
+        self.assertEqual(determine_libprep_from_uppsala_samplesheet(
+                self.samplesheet_path, "SX398", "NA11993", seqrun_id, 2), "SX398_NA11993_Rerun")
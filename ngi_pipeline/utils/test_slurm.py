@@ -0,0 +1,69 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ngi_pipeline.utils.slurm import create_sbatch_file, get_queued_slurm_jobs, \
+                                     submit_sbatch
+
+
+class TestSlurm(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Fake sbatch and squeue, first on the PATH
+        self.bin_dir = os.path.join(self.tmp_dir, "bin")
+        os.mkdir(self.bin_dir)
+        self._write_script("sbatch", 'echo "$@" > {}\necho "4242;milou"'.format(
+                                        os.path.join(self.tmp_dir, "sbatch_args")))
+        self._write_script("squeue", 'printf "4242_0\\n4242_2\\n17\\n"')
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.bin_dir + os.pathsep + self.path
+        self.slurm_config = {"account": "a2010002", "partition": "node",
+                             "extra_parameters": ["--qos=seqver"]}
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_script(self, name, body):
+        script_path = os.path.join(self.bin_dir, name)
+        with open(script_path, 'w') as f:
+            f.write("#!/bin/sh\n" + body + "\n")
+        os.chmod(script_path, 0755)
+
+    def test_array_job(self):
+        log_paths = [os.path.join(self.tmp_dir, "run{}.log".format(i)) for i in range(3)]
+        sbatch_path = create_sbatch_file(os.path.join(self.tmp_dir, "job.sbatch"), "piper_fc",
+                                         ["echo run{}".format(i) for i in range(3)],
+                                         log_paths=log_paths, cwds=[self.tmp_dir] * 3,
+                                         slurm_config=self.slurm_config)
+        with open(sbatch_path) as f:
+            sbatch_text = f.read()
+        self.assertIn("#SBATCH -A a2010002\n", sbatch_text)
+        self.assertIn("#SBATCH --qos=seqver\n", sbatch_text)
+        self.assertIn("#SBATCH --array=0-2\n", sbatch_text)
+        # Each array task runs its own command line
+        subprocess.check_call(["bash", sbatch_path],
+                              env=dict(os.environ, SLURM_ARRAY_TASK_ID="1"))
+        self.assertFalse(os.path.exists(log_paths[0]))
+        with open(log_paths[1]) as f:
+            self.assertEqual(f.read(), "run1\n")
+
+    def test_single_job(self):
+        sbatch_path = create_sbatch_file(os.path.join(self.tmp_dir, "job.sbatch"), "piper_s",
+                                         ["echo sample"], slurm_config=self.slurm_config)
+        with open(sbatch_path) as f:
+            self.assertNotIn("--array", f.read())
+        self.assertRaises(ValueError, create_sbatch_file, sbatch_path, "piper_s",
+                          ["echo sample"], slurm_config={})
+
+    def test_submit_and_queue(self):
+        self.assertEqual(submit_sbatch("job.sbatch"), "4242")
+        with open(os.path.join(self.tmp_dir, "sbatch_args")) as f:
+            self.assertEqual(f.read(), "--parsable job.sbatch\n")
+        self.assertEqual(get_queued_slurm_jobs(), set(["4242_0", "4242_2", "17"]))
+        os.environ["PATH"] = self.tmp_dir
+        self.assertRaises(RuntimeError, submit_sbatch, "job.sbatch")
+        self.assertRaises(RuntimeError, get_queued_slurm_jobs)
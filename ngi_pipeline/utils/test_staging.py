@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from .staging import StagingTask, plan_staging, stage_files
+
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, "src")
+        self.dst_dir = os.path.join(self.tmp_dir, "dst")
+        os.makedirs(self.src_dir)
+        os.makedirs(self.dst_dir)
+        self.pairs = []
+        for file_name in ("P1_101_L001_R1.fastq.gz", "P1_101_L001_R2.fastq.gz"):
+            src_file = os.path.join(self.src_dir, file_name)
+            with open(src_file, 'w') as f:
+                f.write("@read\nACGT\n+\nIIII\n")
+            self.pairs.append((src_file, os.path.join(self.dst_dir, file_name)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_plan_staging(self):
+        os.symlink(*self.pairs[0])
+        tasks, skipped = plan_staging(self.pairs + [self.pairs[1]])
+        self.assertEqual(tasks, [StagingTask(*self.pairs[1])])
+        # The second time a dst is given it is skipped as well
+        self.assertEqual(skipped, [StagingTask(*self.pairs[0]), StagingTask(*self.pairs[1])])
+
+    def test_stage_files(self):
+        for strategy in ("symlink", "hardlink", "copy"):
+            tasks, _ = plan_staging(self.pairs)
+            report = stage_files(tasks, strategy=strategy, max_workers=2, checksum=True)
+            self.assertEqual(report.staged, tasks)
+            self.assertEqual(report.failed, [])
+            self.assertEqual(report.bytes, 36)
+            for src, dst in self.pairs:
+                self.assertEqual(os.path.islink(dst), strategy == "symlink")
+                self.assertEqual(os.path.samefile(src, dst), strategy != "copy")
+                os.remove(dst)
+
+    def test_stage_files_failed(self):
+        tasks = [StagingTask(os.path.join(self.src_dir, "missing.fastq.gz"),
+                             os.path.join(self.dst_dir, "missing.fastq.gz"))]
+        report = stage_files(tasks, strategy="symlink")
+        self.assertEqual(len(report.failed), 1)
+        # The dangling link is not left behind
+        self.assertFalse(os.path.lexists(tasks[0].dst))
+        with self.assertRaises(ValueError):
+            stage_files(tasks, strategy="teleport")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Load-test the conductor against a local mock Charon server.
+
+For each project size a synthetic flowcell is run through
+process_demultiplexed_flowcells, and then the local job tracking database is
+filled with one finished job per seqrun and update_charon_with_local_jobs_status
+is run over it. The number of Charon requests, the wall time and the server's
+response times are reported for both stages.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import yaml
+
+from ngi_pipeline.tests.generate_test_data import create_demultiplexed_flowcell, \
+                                                 generate_run_id
+from ngi_pipeline.tests.mock_charon import MockCharonServer
+
+
+def write_config(work_dir, max_workers):
+    config = {"charon": {"max_retries": 1, "backoff_factor": 0.1,
+                         "max_workers": max_workers},
+              "database": {"record_tracking_db_path": os.path.join(work_dir, "tracking.sql")},
+              "analysis": {"top_dir": os.path.join(work_dir, "analysis"),
+                           "workflows": {"NGI": {"analysis_engine": "ngi_pipeline.engines.piper_ngi"}}}}
+    os.makedirs(config["analysis"]["top_dir"])
+    config_file_path = os.path.join(work_dir, "ngi_config.yaml")
+    with open(config_file_path, "w") as f:
+        yaml.dump(config, f)
+    return config_file_path
+
+
+def populate_charon(server, project_id, project_name, n_samples, run_id):
+    server.documents.clear()
+    server.populate(project_id, n_samples=n_samples, project_name=project_name,
+                    seqrun_ids=[run_id], best_practice_analysis="IGN")
+    # Mark the seqruns as analyzed already so that no jobs are launched
+    for key, doc in server.documents.items():
+        if key[0] == "seqrun":
+            doc["alignment_status"] = "DONE"
+    return ["{}_{}".format(project_id, 101 + i) for i in xrange(n_samples)]
+
+
+def fill_tracking_database(analysis_top_dir, project_id, project_name, sample_ids, run_id):
+    """Record one finished job per seqrun; every other one of them failed."""
+    from ngi_pipeline.engines.piper_ngi.database import SeqrunAnalysis, get_db_session
+    from ngi_pipeline.engines.piper_ngi.utils import create_exit_code_file_path
+    workflow = "dna_alignonly"
+    with get_db_session() as session:
+        for num, sample_id in enumerate(sample_ids):
+            exit_code_path = create_exit_code_file_path(workflow, analysis_top_dir,
+                                                        project_name, sample_id,
+                                                        "A", run_id)
+            if not os.path.isdir(os.path.dirname(exit_code_path)):
+                os.makedirs(os.path.dirname(exit_code_path))
+            with open(exit_code_path, "w") as f:
+                f.write(str(num % 2))
+            session.add(SeqrunAnalysis(project_id=project_id, project_name=project_name,
+                                       project_base_path=analysis_top_dir,
+                                       sample_id=sample_id, libprep_id="A",
+                                       seqrun_id=run_id, engine="piper_ngi",
+                                       workflow=workflow, analysis_dir=analysis_top_dir,
+                                       # Made-up process ids; the exit codes are there
+                                       process_id=10000000 + num))
+        session.commit()
+
+
+def run_stage(server, function, *args):
+    del server.requests[:]
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    stats = server.request_stats()
+    stats["wall_time"] = elapsed
+    return stats
+
+
+def print_stats(label, n_samples, stats):
+    print("{:>8} {:>24}: {:8.2f} s {:7} requests  p50 {:6.1f} ms  p95 {:6.1f} ms  "
+          "{}".format(n_samples, label, stats["wall_time"], stats["requests"],
+                      stats["p50"] * 1000, stats["p95"] * 1000,
+                      " ".join("{}={}".format(k, v) for k, v in
+                               sorted(stats["methods"].items()))))
+
+
+def main(sample_counts, lanes, latency, error_rate, max_workers):
+    server = MockCharonServer(latency=latency, error_rate=error_rate).start()
+    work_dir = tempfile.mkdtemp()
+    # These are read when the ngi_pipeline modules are imported
+    os.environ["CHARON_BASE_URL"] = server.base_url
+    os.environ.setdefault("CHARON_API_TOKEN", "benchmark")
+    os.environ["NGI_CONFIG"] = write_config(work_dir, max_workers)
+    from ngi_pipeline.conductor.flowcell import process_demultiplexed_flowcells
+    from ngi_pipeline.database.classes import get_charon_session
+    from ngi_pipeline.engines.piper_ngi.local_process_tracking import \
+            update_charon_with_local_jobs_status
+    from ngi_pipeline.utils.config import load_yaml_config
+    config = load_yaml_config(os.environ["NGI_CONFIG"])
+    analysis_top_dir = config["analysis"]["top_dir"]
+    print("Mock Charon latency {:.0f} ms, error rate {:.0%}, {} lanes per "
+          "sample".format(latency * 1000, error_rate, len(lanes)))
+    try:
+        for size_num, n_samples in enumerate(sample_counts):
+            project_id = "P{}".format(1000 + size_num)
+            project_name = "B.Enchmark_14_{:02d}".format(10 + size_num)
+            run_id = generate_run_id()
+            get_charon_session().cache.clear()
+            sample_ids = populate_charon(server, project_id, project_name,
+                                         n_samples, run_id)
+            fc_dir = create_demultiplexed_flowcell(project_name=project_name,
+                                                   sample_names=sample_ids,
+                                                   lanes=lanes, run_id=run_id,
+                                                   tmp_dir=work_dir)
+            stats = run_stage(server, process_demultiplexed_flowcells, [fc_dir])
+            print_stats("process_flowcells", n_samples, stats)
+            fill_tracking_database(analysis_top_dir, project_id, project_name,
+                                   sample_ids, run_id)
+            stats = run_stage(server, update_charon_with_local_jobs_status)
+            print_stats("update_jobs_status", n_samples, stats)
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--samples", type=int, nargs="+", default=[10, 100, 1000],
+            help="The project sizes to test (default 10 100 1000)")
+    parser.add_argument("-l", "--lanes", type=int, default=2,
+            help="Number of lanes per sample (default 2)")
+    parser.add_argument("--latency", type=float, default=0.005,
+            help="Seconds the mock server waits before each response (default 0.005)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+            help="Share of requests the mock server answers with a 503 (default 0)")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+            help="charon.max_workers for the session (default 8)")
+    args = parser.parse_args()
+    main(args.samples, range(1, args.lanes + 1), args.latency, args.error_rate, args.workers)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Compare creating the analysis directories of a flowcell with a
+safe_makedir per level per fastq file, as setup_analysis_directory_structure
+used to, with one make_directories call for the whole layout."""
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import shutil
+import tempfile
+import time
+
+# CharonSession wants these set at import time; nothing is fetched from Charon
+os.environ.setdefault("CHARON_API_TOKEN", "benchmark")
+os.environ.setdefault("CHARON_BASE_URL", "http://127.0.0.1")
+
+from ngi_pipeline.utils.filesystem import make_directories, safe_makedir
+
+
+def fastq_dirs(top_dir, n_samples, n_lanes):
+    """The project, sample, libprep and seqrun directory of each fastq file
+    (two reads per lane) of a flowcell with one project."""
+    project_dir = os.path.join(top_dir, "DATA", "Y.Mom_14_01")
+    for sample_num in xrange(n_samples):
+        sample_dir = os.path.join(project_dir, "P1_{}".format(101 + sample_num))
+        libprep_dir = os.path.join(sample_dir, "A")
+        seqrun_dir = os.path.join(libprep_dir, "140528_D00415_0049_BC423WACXX")
+        for fastq_file in xrange(n_lanes * 2):
+            yield (project_dir, sample_dir, libprep_dir, seqrun_dir)
+
+
+def per_file(top_dir, n_samples, n_lanes):
+    for dirs in fastq_dirs(top_dir, n_samples, n_lanes):
+        for dir_path in dirs:
+            safe_makedir(dir_path, 0770)
+
+
+def batched(top_dir, n_samples, n_lanes):
+    make_directories(set(dir_path for dirs in fastq_dirs(top_dir, n_samples, n_lanes)
+                         for dir_path in dirs), 0770)
+
+
+def count_syscalls(function, *args):
+    """Count the stat and mkdir calls made; on Lustre/NFS each of these is a
+    round trip to the metadata server."""
+    counts = collections.Counter()
+    originals = dict((name, getattr(os, name)) for name in ("stat", "lstat", "mkdir"))
+    def counted(name):
+        def wrapped(*args, **kwargs):
+            counts[name] += 1
+            return originals[name](*args, **kwargs)
+        return wrapped
+    try:
+        for name in originals:
+            setattr(os, name, counted(name))
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return counts, elapsed
+
+
+def main(n_samples, n_lanes):
+    print("{} samples x {} lanes, {} fastq files".format(n_samples, n_lanes,
+                                                         n_samples * n_lanes * 2))
+    for label, function in (("safe_makedir per file", per_file),
+                            ("make_directories", batched)):
+        for run in ("first run", "rerun"):
+            top_dir = tempfile.mkdtemp()
+            try:
+                if run == "rerun":
+                    # The directories exist already, as when a flowcell is set up again
+                    function(top_dir, n_samples, n_lanes)
+                counts, elapsed = count_syscalls(function, top_dir, n_samples, n_lanes)
+            finally:
+                shutil.rmtree(top_dir)
+            print("{:>22}, {:>9}: {:8.1f} ms, {} stat, {} lstat, {} mkdir "
+                  "calls".format(label, run, elapsed * 1000, counts["stat"],
+                                 counts["lstat"], counts["mkdir"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--samples", type=int, default=384,
+            help="Number of samples in the flowcell (default 384)")
+    parser.add_argument("-l", "--lanes", type=int, default=8,
+            help="Number of lanes per sample (default 8)")
+    args = parser.parse_args()
+    main(args.samples, args.lanes)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Compare parse_casava_directory with the glob-per-level scan it replaced,
+on a synthetic demultiplexed flowcell (by default 8 lanes and 384 samples)."""
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+# CharonSession wants these set at import time; nothing is fetched from Charon
+os.environ.setdefault("CHARON_API_TOKEN", "benchmark")
+os.environ.setdefault("CHARON_BASE_URL", "http://127.0.0.1")
+
+from ngi_pipeline.conductor.flowcell import parse_casava_directory
+from ngi_pipeline.tests.generate_test_data import create_demultiplexed_flowcell
+from ngi_pipeline.utils import filesystem
+
+
+def glob_scan(fc_dir):
+    """The previous implementation: a glob per project, per sample and for
+    the samplesheet of each project, and a stat per fastq file for its size."""
+    projects = []
+    for project_dir in glob.glob(os.path.join(fc_dir, "Unaligned*", "Project_*")):
+        glob.glob(os.path.join(project_dir, "../../SampleSheet.csv"))
+        samples = []
+        for sample_dir in glob.glob(os.path.join(project_dir, "Sample_*")):
+            fastq_files = glob.glob(os.path.join(sample_dir, "*.fastq.gz"))
+            samples.append([(os.path.basename(f), os.stat(f).st_size) for f in fastq_files])
+        projects.append(samples)
+    return projects
+
+
+def count_syscalls(function, fc_dir):
+    """Count the listdir and stat calls made by one scan; on Lustre/NFS each
+    of these is a round trip to the metadata server."""
+    counts = collections.Counter()
+    originals = dict((name, getattr(os, name)) for name in ("listdir", "stat", "lstat"))
+    def counted(name):
+        def wrapped(*args, **kwargs):
+            counts[name] += 1
+            return originals[name](*args, **kwargs)
+        return wrapped
+    try:
+        for name in originals:
+            setattr(os, name, counted(name))
+        function(fc_dir)
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return counts
+
+
+def time_scan(function, fc_dir, repeats):
+    start = time.time()
+    for i in xrange(repeats):
+        function(fc_dir)
+    return (time.time() - start) / repeats
+
+
+def main(n_samples, n_lanes, repeats):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fc_dir = create_demultiplexed_flowcell(n_samples=n_samples,
+                                               lanes=range(1, n_lanes + 1),
+                                               tmp_dir=tmp_dir)
+        n_files = sum(len(files) for _, _, files in os.walk(fc_dir))
+        print("{} samples x {} lanes, {} files; scandir module "
+              "{}".format(n_samples, n_lanes, n_files,
+                          "in use" if filesystem.scandir else "not installed"))
+        for label, function in (("glob", glob_scan),
+                                ("parse_casava_directory", parse_casava_directory)):
+            elapsed = time_scan(function, fc_dir, repeats)
+            counts = count_syscalls(function, fc_dir)
+            print("{:>24}: {:8.1f} ms per scan, {} listdir, {} stat, {} lstat "
+                  "calls".format(label, elapsed * 1000, counts["listdir"],
+                                 counts["stat"], counts["lstat"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--samples", type=int, default=384,
+            help="Number of samples in the flowcell (default 384)")
+    parser.add_argument("-l", "--lanes", type=int, default=8,
+            help="Number of lanes per sample (default 8)")
+    parser.add_argument("-r", "--repeats", type=int, default=5,
+            help="Number of scans to average over (default 5)")
+    args = parser.parse_args()
+    main(args.samples, args.lanes, args.repeats)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Compare building a project tree from Charon serially and concurrently,
+against a local mock Charon server with a fixed per-request latency."""
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+# CharonSession wants these set at import time; the mock server ignores them
+os.environ.setdefault("CHARON_API_TOKEN", "benchmark")
+os.environ.setdefault("CHARON_BASE_URL", "http://127.0.0.1")
+
+from ngi_pipeline.database.classes import CharonSession
+from ngi_pipeline.tests.mock_charon import MockCharonServer
+
+
+def time_project_tree(base_url, project_id, max_workers):
+    # A fresh session with no cache so that each run hits the server
+    charon_session = CharonSession(base_url=base_url,
+                                   config={"charon": {"cache_backend": "none",
+                                                      "pool_maxsize": max_workers}})
+    start = time.time()
+    project_obj = charon_session.project_get_tree(project_id, max_workers=max_workers)
+    return time.time() - start, project_obj
+
+
+def main(n_samples, n_libpreps, n_seqruns, latency, max_workers):
+    server = MockCharonServer(latency=latency).start()
+    try:
+        project_id = "P100"
+        server.populate(project_id, n_samples=n_samples,
+                        n_libpreps=n_libpreps, n_seqruns=n_seqruns)
+        print("{} samples x {} libpreps x {} seqruns, {:.0f} ms "
+              "latency".format(n_samples, n_libpreps, n_seqruns, latency * 1000))
+        for label, workers in (("serial", 1), ("concurrent", max_workers)):
+            del server.requests[:]
+            elapsed, project_obj = time_project_tree(server.base_url, project_id, workers)
+            n_seqrun_objs = sum(1 for sample in project_obj
+                                  for libprep in sample for seqrun in libprep)
+            print("{:>10}: {:7.2f} s, {} requests, {} seqruns "
+                  "(workers={})".format(label, elapsed, len(server.requests),
+                                        n_seqrun_objs, workers))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--samples", type=int, default=200,
+            help="Number of samples in the project (default 200)")
+    parser.add_argument("-l", "--libpreps", type=int, default=2,
+            help="Number of libpreps per sample (default 2)")
+    parser.add_argument("-r", "--seqruns", type=int, default=2,
+            help="Number of seqruns per libprep (default 2)")
+    parser.add_argument("--latency", type=float, default=0.02,
+            help="Seconds the mock server waits before each response (default 0.02)")
+    parser.add_argument("-w", "--workers", type=int, default=16,
+            help="Number of concurrent requests (default 16)")
+    args = parser.parse_args()
+    main(args.samples, args.libpreps, args.seqruns, args.latency, args.workers)
@@ -12,7 +12,7 @@ from ngi_pipeline.conductor.launchers import trigger_sample_level_analysis
 from ngi_pipeline.database.process_tracking import check_update_jobs_status
 from ngi_pipeline.database.communicate import get_project_id_from_name
 
-from ngi_pipeline.database.classes import CharonSession
+from ngi_pipeline.database.classes import get_charon_session
 import json
 
 
@@ -57,7 +57,7 @@ def main(args):
         return 1
     
     
-    charon_session = CharonSession()
+    charon_session = get_charon_session()
 
 
     rndProject = {}
@@ -15,6 +15,7 @@ M.Kaller_14_06
 """
 
 import argparse
+import itertools
 import time
 import os
 
@@ -22,7 +23,7 @@ from ngi_pipeline.conductor.flowcell import process_demultiplexed_flowcell, proc
 from ngi_pipeline.conductor.launchers import launch_analysis_for_samples
 
 from ngi_pipeline.engines.piper_ngi.local_process_tracking import update_charon_with_local_jobs_status
-from ngi_pipeline.database.classes import CharonSession, CharonError
+from ngi_pipeline.database.classes import CharonError, get_charon_session
 from ngi_pipeline.utils.filesystem import recreate_project_from_filesystem
 
 
@@ -71,17 +72,21 @@ def main(demux_fcid_dir, restrict_to_projects=None, restrict_to_samples=None):
         
         #and now a loop to update the DB
         time.sleep(3800)
-        charon_session = CharonSession()
+        charon_session = get_charon_session()
         ####charon_session.project_delete("ND-0522")
         while True:
             update_charon_with_local_jobs_status() ## this updated local_db and charon accordingly
-            # grab all projects from Charon
-            projects_dict = charon_session.projects_get_all()['projects']
-            for project_charon in projects_dict:
-                project_name = project_charon["name"]
+            # grab only the samples still waiting for analysis and with enough
+            # coverage for it (as checked by analyze_sample), project by project
+            new_samples = charon_session.samples_iter(status="NEW", min_coverage=28.4)
+            for projectid, project_samples in itertools.groupby(new_samples,
+                                                                lambda (p, s): p["projectid"]):
+                project_samples = list(project_samples)
+                project_name = project_samples[0][0]["name"]
                 project_dir  = os.path.join("/proj/a2014205/nobackup/NGI/analysis_ready/DATA", project_name)
                 if os.path.isdir(project_dir):
-                    projectObj = recreate_project_from_filesystem(project_dir, None)
+                    sample_ids = [sample["sampleid"] for project, sample in project_samples]
+                    projectObj = recreate_project_from_filesystem(project_dir, sample_ids)
                     launch_analysis_for_samples([projectObj])
             time.sleep(3800)
 
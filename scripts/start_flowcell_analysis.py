@@ -1,7 +1,9 @@
 import argparse
 import os
 
-from ngi_pipeline.conductor.flowcell import process_demultiplexed_flowcell
+from ngi_pipeline.conductor.flowcell import execute_setup_plan, \
+                                            process_demultiplexed_flowcells
+from ngi_pipeline.conductor.plan import SetupPlan
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Launch seqrun-level analysis.")
@@ -13,11 +15,31 @@ if __name__ == '__main__':
                   "Use flag multiple times for multiple samples."))
     parser.add_argument("-f", "--restart-failed", dest="restart_failed_jobs", action="store_true",
             help=("Restart jobs marked as 'FAILED' in Charon"))
-    parser.add_argument("demux_fcid_dir", nargs="?", action="store",
+    parser.add_argument("-w", "--workers", dest="max_workers", type=int,
+            help=("Number of flowcells to set up at the same time "
+                  "(default analysis.flowcell_workers in the config)"))
+    parser.add_argument("--plan-only", dest="plan_path",
+            help=("Only write what would be done (directories, fastq files, "
+                  "Charon records, jobs and their cost) to this JSON file"))
+    parser.add_argument("--from-plan", dest="from_plan_path",
+            help=("Carry out a plan written earlier with --plan-only "
+                  "instead of processing flowcells"))
+    parser.add_argument("demux_fcid_dirs", nargs="*", action="store",
             help=("The path to the Illumina demultiplexed fc directories "
                   "to process."))
     args_ns = parser.parse_args()
-    process_demultiplexed_flowcell(args_ns.demux_fcid_dir,
-                                   args_ns.restrict_to_projects,
-                                   args_ns.restrict_to_samples,
-                                   args_ns.restart_failed_jobs)
+    if args_ns.from_plan_path:
+        execute_setup_plan(SetupPlan.load(args_ns.from_plan_path),
+                           restart_failed_jobs=args_ns.restart_failed_jobs)
+    elif not args_ns.demux_fcid_dirs:
+        parser.error("No demultiplexed flowcell directories given")
+    else:
+        plan = process_demultiplexed_flowcells(args_ns.demux_fcid_dirs,
+                                               args_ns.restrict_to_projects,
+                                               args_ns.restrict_to_samples,
+                                               args_ns.restart_failed_jobs,
+                                               max_workers=args_ns.max_workers,
+                                               plan_only=bool(args_ns.plan_path))
+        if args_ns.plan_path:
+            plan.save(args_ns.plan_path)
+            print(plan.summary())
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""Watch the INBOX and start the analysis of each demultiplexed flowcell as
+soon as it has been delivered."""
+import argparse
+
+from ngi_pipeline.conductor.watcher import watch_flowcells
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-i", "--inbox", dest="inbox_dir",
+            help=("The directory flowcells are delivered to "
+                  "(default project.INBOX in the config)"))
+    parser.add_argument("--poll", dest="use_inotify", action="store_false", default=None,
+            help=("Poll the inbox instead of using inotify"))
+    parser.add_argument("-e", "--process-existing", action="store_true",
+            help=("Also process the finished flowcells already in the inbox"))
+    parser.add_argument("-c", "--config", dest="config_file_path",
+            help=("The path to the NGI configuration file"))
+    args_ns = parser.parse_args()
+    watch_flowcells(args_ns.inbox_dir, args_ns.use_inotify,
+                    args_ns.process_existing,
+                    config_file_path=args_ns.config_file_path)